@@ -0,0 +1,120 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import MAGIC_NUMBER
+from marshal import dumps, loads
+from os import cpu_count, path, walk
+from types import CodeType
+from typing import Iterable, Iterator, List, Tuple
+import sys
+
+from cache import Cache, cached_decompile_to_str, cached_instructions_to_str
+
+SOURCE_SUFFIXES = (".py", ".pyc")
+
+# Expands directories into their .py/.pyc files, sorted so output order never changes between runs
+def find_files(paths: Iterable[str]) -> List[str]:
+	files = []
+
+	for name in paths:
+		if path.isdir(name):
+			for root, dirs, filenames in walk(name):
+				dirs.sort()
+				files.extend(path.join(root, filename) for filename in sorted(filenames) if filename.endswith(SOURCE_SUFFIXES))
+		else:
+			files.append(name)
+
+	return files
+
+def load_code(filename: str) -> CodeType:
+	if filename.endswith(".pyc"):
+		with open(filename, "rb") as file:
+			data = file.read()
+
+		if data[:4] != MAGIC_NUMBER:
+			raise ValueError(f"{filename} was compiled by a different version of Python")
+
+		return loads(data[16:]) # Skip magic, flags, and the source mtime/hash
+
+	with open(filename, "rb") as file:
+		return compile(file.read(), filename, "exec", dont_inherit = True)
+
+# Every code object in obj, parents before their children
+def walk_code(obj: CodeType) -> Iterator[Tuple[List[str], CodeType]]:
+	pending = [(None, obj)]
+
+	while pending:
+		headers, code = pending.pop()
+		yield headers, code
+
+		next_headers = [code.co_name] if headers is None else headers + [code.co_name]
+		pending.extend((next_headers, const) for const in reversed(code.co_consts) if hasattr(const, "co_code"))
+
+_caches = {} # Cache directory -> Cache, kept for the life of each worker
+
+def _decompile(job: Tuple[List[str], bytes, bool, str]) -> str:
+	headers, marshalled, instructions_only, cache_directory = job
+	code = loads(marshalled)
+
+	if cache_directory not in _caches:
+		_caches[cache_directory] = Cache(directory = cache_directory)
+	cache = _caches[cache_directory]
+
+	if instructions_only:
+		return cached_instructions_to_str(code, cache)
+
+	return cached_decompile_to_str(code, headers, cache)
+
+def _jobs(files: List[str], instructions_only: bool, cache_directory: str) -> Iterator[Tuple[str, Tuple[List[str], bytes, bool, str]]]:
+	for filename in files:
+		try:
+			code = load_code(filename)
+		except (OSError, SyntaxError, ValueError) as e:
+			print(f"Skipping {filename}: {e}", file = sys.stderr)
+			continue
+
+		for headers, nested in walk_code(code):
+			yield filename, (headers, dumps(nested), instructions_only, cache_directory)
+
+# Decompiles every code object in the files across a pool of processes
+# Results stream back as (filename, text) in the same order as a serial run
+# Passing cache_directory keeps results on disk so unchanged code objects are skipped next time
+def decompile_files(paths: Iterable[str], workers: int = None, instructions_only: bool = False, cache_directory: str = None) -> Iterator[Tuple[str, str]]:
+	if workers is None:
+		workers = cpu_count() or 1
+
+	pending = deque()
+	jobs = _jobs(find_files(paths), instructions_only, cache_directory)
+
+	with ProcessPoolExecutor(workers) as executor:
+		# Keep a bounded window of work queued so memory stays flat on large trees
+		for filename, job in jobs:
+			pending.append((filename, executor.submit(_decompile, job)))
+
+			if len(pending) >= workers * 4:
+				filename, future = pending.popleft()
+				yield filename, future.result()
+
+		while pending:
+			filename, future = pending.popleft()
+			yield filename, future.result()
+
+def main():
+	parser = ArgumentParser(description = "Decompiles every code object in .py/.pyc files and directories")
+	parser.add_argument("paths", nargs = "+", help = "Files or directories to decompile")
+	parser.add_argument("-j", "--jobs", type = int, default = None, help = "Number of worker processes (default: all cores)")
+	parser.add_argument("-i", "--instructions-only", action = "store_true", help = "Only output the instructions")
+	parser.add_argument("-c", "--cache", default = None, help = "Directory to keep decompiled results in between runs")
+	args = parser.parse_args()
+
+	last_filename = None
+
+	for filename, text in decompile_files(args.paths, args.jobs, args.instructions_only, args.cache):
+		if filename != last_filename:
+			print(f"# {filename}")
+			last_filename = filename
+
+		print(text, end = "\n\n")
+
+if __name__ == "__main__":
+	main()
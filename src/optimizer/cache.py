@@ -0,0 +1,170 @@
+from collections import OrderedDict
+from hashlib import sha256
+from importlib.util import MAGIC_NUMBER
+from os import getpid, listdir, makedirs, path, replace
+from pickle import dump, load, UnpicklingError, HIGHEST_PROTOCOL
+from shutil import rmtree
+from types import CodeType
+from typing import Any, Callable, Hashable
+import re
+
+from decompiler import build_tree, decompile_instructions_to_str, decompile_to_str
+from structures import Body
+
+# Bumped whenever what's kept in the cache changes shape
+FORMAT = 1
+
+# Digest of the code that works out what's cached, so results from an older decompiler or optimizer are never served
+def _sources_digest(folder: str) -> str:
+	digest = sha256()
+	for name in sorted(listdir(folder)):
+		if name.endswith(".py"):
+			with open(path.join(folder, name), "rb") as file:
+				digest.update(name.encode() + b"\0" + file.read())
+	return digest.hexdigest()[:16]
+
+VERSION = f"{FORMAT}-{_sources_digest(path.dirname(path.realpath(__file__)))}"
+
+def _update(digest, const: Any):
+	if hasattr(const, "co_code"):
+		digest.update(b"<code>")
+		_update_code(digest, const)
+	elif isinstance(const, (tuple, frozenset)):
+		digest.update(f"<{type(const).__name__} {len(const)}>".encode())
+		items = const if isinstance(const, tuple) else sorted(const, key = repr) # Set order changes between runs
+		for item in items:
+			_update(digest, item)
+	else:
+		# Type is included so 1, 1.0 and True don't share an entry
+		digest.update(f"{type(const).__qualname__}:{const!r}\0".encode())
+
+def _update_code(digest, obj: CodeType):
+	digest.update(len(obj.co_code).to_bytes(4, "little"))
+	digest.update(obj.co_code)
+	_update(digest, obj.co_consts)
+	_update(digest, obj.co_names)
+	_update(digest, obj.co_varnames) # Shown in the disassembly text
+
+# Hash of everything the analysis of obj depends on, including the interpreter's bytecode version
+def code_key(obj: CodeType) -> str:
+	digest = sha256(MAGIC_NUMBER)
+	_update_code(digest, obj)
+	return digest.hexdigest()
+
+class LRUCache:
+
+	def __init__(self, maxsize: int = 1024):
+		self.maxsize = maxsize
+		self.hits = self.misses = 0
+		self.__items = OrderedDict()
+
+	def __len__(self): return self.__items.__len__()
+
+	def __contains__(self, key: Hashable): return key in self.__items
+
+	def get(self, key: Hashable, default: Any = None) -> Any:
+		try:
+			value = self.__items[key]
+		except KeyError:
+			self.misses += 1
+			return default
+
+		self.__items.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key: Hashable, value: Any):
+		self.__items[key] = value
+		self.__items.move_to_end(key)
+
+		while self.__items.__len__() > self.maxsize:
+			self.__items.popitem(last = False)
+
+	def clear(self):
+		self.__items.clear()
+
+# Names of the folders DiskCache keeps entries in, the interpreter's magic number then the VERSION that wrote them, which older ones don't have
+_FOLDER = re.compile(r"[0-9a-f]{8}(-\d+-[0-9a-f]{16})?")
+
+class DiskCache:
+
+	def __init__(self, directory: str, version: str = VERSION):
+		self.root = directory
+		# Entries from another interpreter or another version of this code live in a different folder and are never read
+		self.directory = path.join(directory, f"{MAGIC_NUMBER.hex()}-{version}")
+
+	def __file(self, key: str) -> str:
+		return path.join(self.directory, key[-2:], key + ".pickle")
+
+	def get(self, key: str, default: Any = None) -> Any:
+		try:
+			with open(self.__file(key), "rb") as file:
+				return load(file)
+		except (OSError, EOFError, UnpicklingError):
+			return default
+
+	def put(self, key: str, value: Any):
+		filename = self.__file(key)
+		makedirs(path.dirname(filename), exist_ok = True)
+
+		# Write then rename so other processes never read half an entry
+		temporary = f"{filename}.{getpid()}.tmp"
+		with open(temporary, "wb") as file:
+			dump(value, file, HIGHEST_PROTOCOL)
+		replace(temporary, filename)
+
+	# Deletes entries written by other versions of Python or of this code, anything else in the directory is left alone
+	def clear_stale(self):
+		if not path.isdir(self.root):
+			return
+
+		for version in listdir(self.root):
+			folder = path.join(self.root, version)
+			if folder != self.directory and _FOLDER.fullmatch(version) and path.isdir(folder):
+				rmtree(folder, ignore_errors = True) # Another process could be clearing it too
+
+class Cache:
+
+	def __init__(self, maxsize: int = 1024, directory: str = None):
+		self.memory = LRUCache(maxsize)
+		self.disk = DiskCache(directory) if directory is not None else None
+
+		if self.disk is not None:
+			self.disk.clear_stale()
+
+	def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+		value = self.memory.get(key)
+		if value is not None:
+			return value
+
+		if self.disk is not None:
+			value = self.disk.get(key)
+
+		if value is None:
+			value = compute()
+
+			if self.disk is not None:
+				self.disk.put(key, value)
+
+		self.memory.put(key, value)
+		return value
+
+default_cache = Cache()
+
+def enable_disk_cache(directory: str, maxsize: int = 1024):
+	global default_cache
+	default_cache = Cache(maxsize, directory)
+
+# The returned trees are shared between callers so they must not be modified
+def cached_build_tree(obj: CodeType, cache: Cache = None) -> Body:
+	cache = default_cache if cache is None else cache
+	return cache.get_or_compute("tree-" + code_key(obj), lambda: build_tree(obj.co_code))
+
+def cached_instructions_to_str(obj: CodeType, cache: Cache = None) -> str:
+	cache = default_cache if cache is None else cache
+	return cache.get_or_compute("dis-" + code_key(obj), lambda: decompile_instructions_to_str(obj))
+
+def cached_decompile_to_str(obj: CodeType, headers = None, cache: Cache = None) -> str:
+	cache = default_cache if cache is None else cache
+	key = "full-" + sha256(f"{code_key(obj)}:{obj.co_name}:{headers!r}:{obj.co_freevars!r}:{obj.co_cellvars!r}".encode()).hexdigest()
+	return cache.get_or_compute(key, lambda: decompile_to_str(obj, headers, recursive = False))
@@ -1,372 +1,301 @@
-from opcode import opname
+from array import array
+from bisect import bisect_right
+from dataclasses import dataclass
+from opcode import opname, opmap, stack_effect, hasjabs, hasjrel, HAVE_ARGUMENT, EXTENDED_ARG
 from types import CodeType
-from typing import List, Tuple, Union
+from typing import Iterator, List
+import sys
 
 from structures import *
-
-def find_n_values_on_stack(codes: bytes, index: int) -> int:
-	if "grow" not in dir(find_n_values_on_stack):
-		find_n_values_on_stack.grow = {
-			135: lambda oparg: 1,
-			124: lambda oparg: 1,
-			100: lambda oparg: 1,
-			71:  lambda oparg: 1,
-			92:  lambda oparg: oparg - 1,
-			94:  lambda oparg: (oparg & 0xFF == 0xFF) + (oparg >> 8),
-			101: lambda oparg: 1,
-			116: lambda oparg: 1,
-			148: lambda oparg: 1,
-			136: lambda oparg: 1,
-			109: lambda oparg: 1,
-			160: lambda oparg: 1,
-		}
-
-	if "shrink" not in dir(find_n_values_on_stack):
-		find_n_values_on_stack.shrink = {
-			125: lambda oparg: 1,
-			1:   lambda oparg: 1,
-			19:  lambda oparg: 1,
-			20:  lambda oparg: 1,
-			16:  lambda oparg: 1,
-			27:  lambda oparg: 1,
-			26:  lambda oparg: 1,
-			22:  lambda oparg: 1,
-			23:  lambda oparg: 1,
-			24:  lambda oparg: 1,
-			25:  lambda oparg: 1,
-			62:  lambda oparg: 1,
-			63:  lambda oparg: 1,
-			64:  lambda oparg: 1,
-			65:  lambda oparg: 1,
-			66:  lambda oparg: 1,
-			145: lambda oparg: 1,
-			146: lambda oparg: 1,
-			67:  lambda oparg: 1,
-			57:  lambda oparg: 1,
-			17:  lambda oparg: 1,
-			29:  lambda oparg: 1,
-			28:  lambda oparg: 1,
-			59:  lambda oparg: 1,
-			55:  lambda oparg: 1,
-			56:  lambda oparg: 1,
-			75:  lambda oparg: 1,
-			76:  lambda oparg: 1,
-			77:  lambda oparg: 1,
-			78:  lambda oparg: 1,
-			79:  lambda oparg: 1,
-			70:  lambda oparg: 1,
-			130: lambda oparg: oparg,
-			83:  lambda oparg: 1,
-			72:  lambda oparg: 1,
-			86:  lambda oparg: 1,
-			89:  lambda oparg: 3,
-			90:  lambda oparg: 1,
-			95:  lambda oparg: 2,
-			96:  lambda oparg: 1,
-			97:  lambda oparg: 1,
-			137: lambda oparg: 1,
-			157: lambda oparg: oparg - 1,
-			102: lambda oparg: oparg - 1,
-			103: lambda oparg: oparg - 1,
-			104: lambda oparg: oparg - 1,
-			105: lambda oparg: oparg * 2 - 1,
-			156: lambda oparg: oparg,
-			147: lambda oparg: 2,
-			107: lambda oparg: 1,
-			108: lambda oparg: 1,
-			84:  lambda oparg: 1,
-			114: lambda oparg: 1,
-			115: lambda oparg: 1,
-			161: lambda oparg: oparg + 1,
-			131: lambda oparg: oparg,
-			141: lambda oparg: oparg + 1,
-			142: lambda oparg: ((oparg & 0x01) == 0x01) + 1,
-			132: lambda oparg: ((oparg & 0x08) == 0x08) + ((oparg & 0x04) == 0x04) + ((oparg & 0x02) == 0x02) + ((oparg & 0x01) == 0x01),
-			133: lambda oparg: (oparg == 3) + 1,
-			155: lambda oparg: ((oparg & 0x04) == 0x04),
-		}
-
-	if "unsupported" not in dir(find_n_values_on_stack):
-		find_n_values_on_stack.unsupported = [ # This stuff normally requires reading the stack during runtime
-			111, 112, 52, 50, 51, 54
-		]
-
-	if "values_needed" not in dir(find_n_values_on_stack):
-		find_n_values_on_stack.values_needed = {
-			9: lambda oparg: 0,
-			135: lambda oparg: 0,
-			124: lambda oparg: 0,
-			100: lambda oparg: 0,
-			125: lambda oparg: 1,
-			1: lambda oparg: 1,
-			2: lambda oparg: 2,
-			3: lambda oparg: 3,
-			6: lambda oparg: 4,
-			4: lambda oparg: 1,
-			5: lambda oparg: 2,
-			10: lambda oparg: 1,
-			11: lambda oparg: 1,
-			12: lambda oparg: 1,
-			15: lambda oparg: 1,
-			19: lambda oparg: 2,
-			20: lambda oparg: 2,
-			16: lambda oparg: 2,
-			27: lambda oparg: 2,
-			26: lambda oparg: 2,
-			22: lambda oparg: 2,
-			23: lambda oparg: 2,
-			24: lambda oparg: 2,
-			25: lambda oparg: 2,
-			62: lambda oparg: 2,
-			63: lambda oparg: 2,
-			64: lambda oparg: 2,
-			65: lambda oparg: 2,
-			66: lambda oparg: 2,
-			145: lambda oparg: 1,
-			146: lambda oparg: 1,
-			67: lambda oparg: 2,
-			57: lambda oparg: 2,
-			17: lambda oparg: 2,
-			29: lambda oparg: 2,
-			28: lambda oparg: 2,
-			59: lambda oparg: 2,
-			55: lambda oparg: 2,
-			56: lambda oparg: 2,
-			75: lambda oparg: 2,
-			76: lambda oparg: 2,
-			77: lambda oparg: 2,
-			78: lambda oparg: 2,
-			79: lambda oparg: 2,
-			60: lambda oparg: 3,
-			61: lambda oparg: 2,
-			70: lambda oparg: 1,
-			130: lambda oparg: oparg,
-			83: lambda oparg: 1,
-			50: lambda oparg: 1,
-			51: lambda oparg: 1,
-			73: lambda oparg: 1,
-			72: lambda oparg: 2,
-			86: lambda oparg: 1,
-			89: lambda oparg: 3,
-			# 54: lambda oparg: 3 or 4, # stack inspection needed
-			71: lambda oparg: 0,
-			90: lambda oparg: 1,
-			91: lambda oparg: 0,
-			92: lambda oparg: 1,
-			94: lambda oparg: 1,
-			95: lambda oparg: 2,
-			96: lambda oparg: 1,
-			97: lambda oparg: 1,
-			98: lambda oparg: 0,
-			101: lambda oparg: 0,
-			116: lambda oparg: 0,
-			126: lambda oparg: 0,
-			138: lambda oparg: 0,
-			148: lambda oparg: 0,
-			136: lambda oparg: 0,
-			137: lambda oparg: 1,
-			157: lambda oparg: oparg,
-			102: lambda oparg: oparg,
-			103: lambda oparg: oparg,
-			104: lambda oparg: oparg,
-			105: lambda oparg: oparg * 2,
-			85: lambda oparg: 0,
-			156: lambda oparg: oparg + 1,
-			147: lambda oparg: oparg + 2,
-			106: lambda oparg: 1,
-			107: lambda oparg: 2,
-			108: lambda oparg: 2,
-			84: lambda oparg: 1,
-			109: lambda oparg: 1,
-			110: lambda oparg: 0,
-			114: lambda oparg: 1,
-			115: lambda oparg: 1,
-			111: lambda oparg: 1,
-			112: lambda oparg: 1,
-			113: lambda oparg: 0,
-			68: lambda oparg: 1,
-			69: lambda oparg: 1,
-			93: lambda oparg: 1,
-			52: lambda oparg: 1,
-			160: lambda oparg: 1,
-			161: lambda oparg: oparg + 2,
-			131: lambda oparg: oparg + 1,
-			141: lambda oparg: oparg + 2,
-			142: lambda oparg: 2 + ((oparg & 0x01) == 0x01),
-			132: lambda oparg: 1 + ((oparg & 0x08) == 0x08) + ((oparg & 0x04) == 0x04) + ((oparg & 0x02) == 0x02) + ((oparg & 0x01) == 0x01),
-			133: lambda oparg: 2 + (oparg == 3),
-			155: lambda oparg: 1 + ((oparg & 0x04) == 0x04),
-			144: lambda oparg: 0
-		}
-
-	values_on_stack = 0
-
-	while index >= 0:
-		wants = find_n_values_on_stack.values_needed[codes[index]](codes[index + 1])
-
-		if codes[index] in find_n_values_on_stack.grow:
-			values_on_stack += find_n_values_on_stack.grow[codes[index]](codes[index + 1])
-		elif codes[index] in find_n_values_on_stack.shrink:
-			values_on_stack -= find_n_values_on_stack.shrink[codes[index]](codes[index + 1])
-		elif codes[index] in find_n_values_on_stack.unsupported:
-			raise NotImplementedError(f"Cannot support {opname[codes[index]]} ({codes[index]}) yet")
-
-		if values_on_stack >= wants:
-			break
-
-		index -= 2
-
-	return index
-
-def build_tree(codes: bytes, start_index: int = 0, stop_index: int = -1) -> Union[Body, Tuple[Body, int]]:
-	main_instructs = Body(list())
-
-	data = Segment(list())
-
-	def find_contitional(index: int) -> int: # Returns the start index
-		return find_n_values_on_stack(codes, index)
-
-	def branch(index: int, opcode: int, oparg: int, true_first: bool) -> int:
-		if data.instructions.__len__():
-			if main_instructs.content.__len__() and isinstance(main_instructs.content[-1], Segment):
-				main_instructs.content[-1].instructions.extend(data.instructions)
+from flow import ControlFlowGraph, build_graph
+from wordcode import CACHE, ConditionalJumps, ForwardJumps, JumpKinds, LoopJumps, Returns, Terminators, TrueJumps, argument_at, decode, jump_target, name_index
+
+# Values each instruction leaves on the stack when it doesn't jump, keyed by name as the numbering changes between versions
+# What it reads off of the stack is worked out from this and the interpreter's own stack_effect, so ValuesNeeded follows each version's opcodes
+_values_left = {name: lambda oparg: 0 for name in (
+	"POP_TOP", "STORE_FAST", "STORE_NAME", "STORE_GLOBAL", "STORE_DEREF", "STORE_ATTR", "STORE_SUBSCR", "DELETE_ATTR", "DELETE_SUBSCR",
+	"LIST_APPEND", "SET_ADD", "MAP_ADD", "LIST_EXTEND", "SET_UPDATE", "DICT_UPDATE", "DICT_MERGE", "PRINT_EXPR", "IMPORT_STAR",
+	"RETURN_VALUE", "RAISE_VARARGS", "RERAISE", "POP_EXCEPT", "GEN_START",
+	"POP_JUMP_IF_FALSE", "POP_JUMP_IF_TRUE", "JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP",
+	"POP_JUMP_FORWARD_IF_FALSE", "POP_JUMP_FORWARD_IF_TRUE", "POP_JUMP_FORWARD_IF_NONE", "POP_JUMP_FORWARD_IF_NOT_NONE",
+	"POP_JUMP_BACKWARD_IF_FALSE", "POP_JUMP_BACKWARD_IF_TRUE", "POP_JUMP_BACKWARD_IF_NONE", "POP_JUMP_BACKWARD_IF_NOT_NONE"
+)}
+_values_left.update({name: lambda oparg: 1 for name in (
+	"UNARY_POSITIVE", "UNARY_NEGATIVE", "UNARY_NOT", "UNARY_INVERT", "BINARY_OP", "BINARY_POWER", "BINARY_MULTIPLY", "BINARY_MATRIX_MULTIPLY",
+	"BINARY_TRUE_DIVIDE", "BINARY_FLOOR_DIVIDE", "BINARY_MODULO", "BINARY_ADD", "BINARY_SUBTRACT", "BINARY_SUBSCR", "BINARY_LSHIFT",
+	"BINARY_RSHIFT", "BINARY_AND", "BINARY_XOR", "BINARY_OR", "INPLACE_POWER", "INPLACE_MULTIPLY", "INPLACE_MATRIX_MULTIPLY",
+	"INPLACE_TRUE_DIVIDE", "INPLACE_FLOOR_DIVIDE", "INPLACE_MODULO", "INPLACE_ADD", "INPLACE_SUBTRACT", "INPLACE_LSHIFT", "INPLACE_RSHIFT",
+	"INPLACE_AND", "INPLACE_XOR", "INPLACE_OR", "COMPARE_OP", "IS_OP", "CONTAINS_OP",
+	"BUILD_STRING", "BUILD_TUPLE", "BUILD_LIST", "BUILD_SET", "BUILD_MAP", "BUILD_CONST_KEY_MAP", "BUILD_SLICE", "LIST_TO_TUPLE", "FORMAT_VALUE",
+	"LOAD_ATTR", "IMPORT_NAME", "GET_ITER", "GET_YIELD_FROM_ITER", "GET_AITER", "GET_AWAITABLE", "YIELD_VALUE", "YIELD_FROM", "MAKE_FUNCTION",
+	"CALL_FUNCTION", "CALL_FUNCTION_KW", "CALL_FUNCTION_EX", "CALL_METHOD", "CALL"
+)})
+_values_left.update({
+	"ROT_TWO": lambda oparg: 2,
+	"ROT_THREE": lambda oparg: 3,
+	"ROT_FOUR": lambda oparg: 4,
+	"ROT_N": lambda oparg: oparg,
+	"SWAP": lambda oparg: oparg,
+	"DUP_TOP": lambda oparg: 2,
+	"DUP_TOP_TWO": lambda oparg: 4,
+	"COPY": lambda oparg: oparg + 1,
+	"UNPACK_SEQUENCE": lambda oparg: oparg,
+	"UNPACK_EX": lambda oparg: (oparg & 0xFF) + (oparg >> 8) + 1,
+	"FOR_ITER": lambda oparg: 2,         # The iterator stays under the next value
+	"LOAD_METHOD": lambda oparg: 2,      # The method and self, or NULL and the attribute
+	"IMPORT_FROM": lambda oparg: 2,      # The module stays under the name
+	"GET_ANEXT": lambda oparg: 2,
+	"GET_LEN": lambda oparg: 2,
+	"BEFORE_WITH": lambda oparg: 2,
+	"BEFORE_ASYNC_WITH": lambda oparg: 2,
+	"SETUP_WITH": lambda oparg: 2,
+	"PUSH_EXC_INFO": lambda oparg: 2,
+	"CHECK_EXC_MATCH": lambda oparg: 2,
+	"PRECALL": lambda oparg: 2           # stack_effect counts the arguments as taken here and the callable as taken by CALL
+})
+_values_left = {opmap[name]: left for name, left in _values_left.items() if opmap.get(name, 256) < 256}
+
+# These normally require reading the stack during runtime
+Unsupported = frozenset(opmap[name] for name in ("JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP", "BEFORE_ASYNC_WITH", "GET_AITER", "GET_ANEXT", "END_ASYNC_FOR") if name in opmap)
+
+def _build_table(effect, opcodes = range(256), table: array = None) -> array:
+	# Flat table indexed by (opcode << 8) | oparg
+	if table is None:
+		table = array("h", bytes(2 * 256 * 256))
+
+	for opcode in opcodes:
+		row = opcode << 8
+		try:
+			if opcode < HAVE_ARGUMENT:
+				table[row:row + 256] = array("h", (effect(opcode, 0),)) * 256
 			else:
-				main_instructs.content.append(Segment(data.instructions))
-			data.instructions = []
-
-		split_on = int(find_contitional(index) / 2)
+				for oparg in range(256):
+					table[row | oparg] = effect(opcode, oparg)
+		except ValueError: # Opcode doesn't exist for this interpreter
+			continue
+
+	return table
+
+def _stack_effect(jump: bool):
+	def effect(opcode: int, oparg: int) -> int:
+		if opcode < HAVE_ARGUMENT:
+			return stack_effect(opcode)
+		return stack_effect(opcode, oparg, jump = jump)
+	return effect
+
+# Net change to the stack depth for falling through to the next instruction
+StackEffect = _build_table(_stack_effect(False))
+
+# Net change to the stack depth for taking the jump
+JumpStackEffect = _build_table(_stack_effect(True), hasjabs + hasjrel, array("h", StackEffect))
+
+# Arguments past a byte (from EXTENDED_ARG) fall outside the tables and are worked out directly
+_fall_through_effect = _stack_effect(False)
+_jump_effect = _stack_effect(True)
+
+def _values_needed(opcode: int, oparg: int) -> int:
+	return _values_left[opcode](oparg) - _fall_through_effect(opcode, oparg)
+
+# Number of values the instruction needs to already be on the stack, 0 for the loads and the ones that aren't known
+ValuesNeeded = _build_table(_values_needed, _values_left)
+
+# Net change to the stack depth of an instruction, for taking its jump when jump is set
+def stack_effect_of(opcode: int, oparg: int, jump: bool = False) -> int:
+	if oparg < 256:
+		return (JumpStackEffect if jump else StackEffect)[opcode << 8 | oparg]
+	return (_jump_effect if jump else _fall_through_effect)(opcode, oparg)
+
+def _values_needed_by(opcode: int, oparg: int) -> int:
+	if oparg < 256:
+		return ValuesNeeded[opcode << 8 | oparg]
+	return _values_needed(opcode, oparg) if opcode in _values_left else 0
+
+# Depth of the stack before each instruction, indexed by offset / 2
+def stack_depths(codes: bytes) -> array:
+	opcodes, args = decode(codes)
+	depths = array("i", bytes(4 * opcodes.__len__()))
+	targets = {}
+	depth = 0
+	reachable = True
+
+	for position in range(opcodes.__len__()):
+		opcode = opcodes[position]
+		oparg = args[position]
+		index = position << 1
+
+		if not reachable and index in targets:
+			depth = targets[index]
+
+		depths[position] = depth
+
+		if oparg < 256:
+			key = opcode << 8 | oparg
+			if JumpKinds[opcode]:
+				targets.setdefault(jump_target(opcode, oparg, index), depth + JumpStackEffect[key])
+			depth += StackEffect[key]
+		else:
+			if JumpKinds[opcode]:
+				targets.setdefault(jump_target(opcode, oparg, index), depth + _jump_effect(opcode, oparg))
+			depth += _fall_through_effect(opcode, oparg)
 
-		values: Segment = main_instructs.content[-1]
-		first_value_index = values.instructions[0].id
+		reachable = opcode not in Terminators
 
-		condition = Segment(values.instructions[split_on - int(first_value_index / 2):int((index - first_value_index) / 2)])
+	return depths
 
-		values.instructions = values.instructions[:split_on - int(first_value_index / 2)]
+# Returns the index of the first instruction that builds the values 'index' consumes
+def find_n_values_on_stack(codes: bytes, index: int, depths: array = None) -> int:
+	if depths is None:
+		depths = stack_depths(codes)
 
-		if not values.instructions.__len__():
-			del main_instructs.content[-1]
+	position = index >> 1
+	wants = depths[position] - _values_needed_by(codes[index], argument_at(codes, index))
 
-		true = build_tree(codes, index + 2, oparg)
+	while position >= 0:
+		if codes[position << 1] in Unsupported:
+			raise NotImplementedError(f"Cannot support {opname[codes[position << 1]]} ({codes[position << 1]}) yet")
 
-		if isinstance(true, Tuple):
-			true = true[0]
+		if depths[position] <= wants:
+			break
 
-		if true.content.__len__() and isinstance(true.content[-1], Segment) and true.content[-1].instructions.__len__():
-			possible_jump: Instruction = true.content[-1].instructions[-1]
-			if (possible_jump.opcode == 113 and possible_jump.oparg == condition[0].id):
-				main_instructs.content.append(While(condition, true, Instruction(codes[index], codes[index + 1], index)))
-				return oparg - index
+		position -= 1
 
-			if possible_jump.opcode == 110:
-				false = build_tree(codes, oparg, possible_jump.id + possible_jump.oparg + 2)
+	return position << 1
 
-				if isinstance(false, Tuple):
-					false_move = false[1]
-					false = false[0]
+FOR_ITER = opmap["FOR_ITER"]
 
-				main_instructs.content.append(Branch(condition, true, false, Instruction(codes[index], codes[index + 1], index), true_first))
+# What a region of instructions is the body of
+_ROOT, _TRUE, _FALSE, _LOOP = range(4)
 
-				return (oparg - index) + false_move
+@dataclass(eq = False)
+class _Region:
+	body: Body
+	index: int
+	stop: int
+	kind: int = _ROOT
+	parent: "_Region" = None
+	conditional: Segment = None
+	omitted: Instruction = None
+	true: Body = None
 
-		main_instructs.content.append(If(condition, true, Instruction(codes[index], codes[index + 1], index), true_first))
-		return oparg - index
+# Grows the trailing view of body to cover position instead of copying instructions around
+def _append(body: Body, stream: InstructionStream, position: int):
+	if body.content.__len__() and isinstance(body.content[-1], Segment) and body.content[-1].instructions.stop == position:
+		body.content[-1].instructions.stop += 1
+	else:
+		body.content.append(Segment(stream.view(position, position + 1)))
 
-	def for_iter(index: int, opcode: int, oparg: int) -> int:
-		if len(data.instructions):
-			main_instructs.content.append(Segment(data.instructions))
-			data.instructions = []
+# Removes the instructions from 'start' onwards out of the trailing segment of body
+def _split_conditional(body: Body, stream: InstructionStream, start: int) -> Segment:
+	if not body.content.__len__() or not isinstance(body.content[-1], Segment):
+		return Segment(stream.view(0, 0))
 
-		split_on = int(find_contitional(index) / 2)
+	values: InstructionView = body.content[-1].instructions
+	split_on = min(max(values.start, start >> 1), values.stop)
 
-		values: Segment = main_instructs.content[-1]
-		first_value_index = values.instructions[0].id
+	condition = Segment(stream.view(split_on, values.stop))
+	values.stop = split_on
 
-		condition = values.instructions[split_on - int(first_value_index / 2):int((index - first_value_index) / 2)]
+	if not values.__len__():
+		del body.content[-1]
 
-		values.instructions = values.instructions[:split_on - first_value_index]
+	return condition
 
-		if not values.instructions.__len__():
-			del main_instructs.content[-1]
+def _last_instruction(body: Body) -> Instruction:
+	if body.content.__len__() and isinstance(body.content[-1], Segment) and body.content[-1].instructions.__len__():
+		return body.content[-1].instructions[-1]
 
-		loop = build_tree(codes, index + 2, index + 2 + oparg)[0]
+def build_tree(codes: bytes, start_index: int = 0, stop_index: int = -1, depths: array = None, graph: ControlFlowGraph = None) -> Body:
+	if depths is None:
+		depths = stack_depths(codes)
 
-		main_instructs.content.append(For(condition, loop, Instruction(opcode, oparg, index)))
+	if graph is None:
+		graph = build_graph(codes)
 
-		return oparg + 2
+	if stop_index == -1:
+		stop_index = len(codes)
 
-	def jump_forward(index: int, opcode: int, oparg: int) -> int:
-		data.instructions.append(Instruction(opcode, oparg, index))
-		return oparg
+	stream = InstructionStream(codes)
+	targets = sorted(graph.targets)
+	root = _Region(Body(list()), start_index, stop_index)
+	regions = [root]
 
-	def default(index: int, opcode: int, oparg: int) -> int:
-		data.instructions.append(Instruction(opcode, oparg, index))
-		return 2
+	# Every instruction is visited once by the innermost region containing it
+	while regions.__len__():
+		region = regions[-1]
 
-	def search(index: int) -> int:
-		i = index
+		if region.index >= region.stop:
+			regions.pop()
+			parent = region.parent
 
-		while index < codes.__len__() and (stop_index == -1 or index < stop_index):
-			opcode, oparg = codes[index:index + 2]
+			if region.kind == _TRUE:
+				possible_jump = _last_instruction(region.body)
 
-			if opcode in (114, 115):
-				index += branch(index, opcode, oparg, opcode == 114)
+				if possible_jump is not None and possible_jump.opcode in LoopJumps and region.conditional.instructions.__len__() and \
+					graph.jumps.get(possible_jump.id) == region.conditional.instructions.start << 1:
+					parent.body.content.append(While(region.conditional, region.body, region.omitted))
+					parent.index = region.stop
 
-			elif opcode in (110,):
-				index += jump_forward(index, opcode, oparg)
-				break
+				elif possible_jump is not None and possible_jump.opcode in ForwardJumps and possible_jump.id in graph.jumps:
+					false_stop = min(graph.jumps[possible_jump.id], parent.stop)
+					regions.append(_Region(Body(list()), region.stop, max(false_stop, region.stop), _FALSE, parent, region.conditional, region.omitted, region.body))
 
-			elif opcode in (93,):
-				index += for_iter(index, opcode, oparg)
+				else:
+					parent.body.content.append(If(region.conditional, region.body, region.omitted, region.omitted.opcode not in TrueJumps))
+					parent.index = region.stop
 
-			elif opcode in (83,):
-				index += default(index, opcode, oparg)
-				break
+			elif region.kind == _FALSE:
+				# The arm right after the test runs when it fails for a jump taken on true
+				true_first = region.omitted.opcode not in TrueJumps
+				true, false = (region.true, region.body) if true_first else (region.body, region.true)
+				parent.body.content.append(Branch(region.conditional, true, false, region.omitted, true_first))
+				parent.index = region.stop
 
-			else:
-				index += default(index, opcode, oparg)
+			elif region.kind == _LOOP:
+				parent.body.content.append(For(region.conditional, region.body, region.omitted))
+				parent.index = region.stop
 
-		return index - i
+			continue
 
-	total_move = search(start_index)
+		index = region.index
+		opcode = stream.opcodes[index >> 1]
+		oparg = stream.args[index >> 1]
+		target = graph.jumps.get(index, -1)
 
-	if len(data.instructions):
-		main_instructs.content.append(data)
+		# A conditional's body runs up to its target even past the end of the body it's in, the shared target of an or is still part of it
+		if opcode in ConditionalJumps and target > index:
+			conditional = _split_conditional(region.body, stream, find_n_values_on_stack(codes, index, depths))
+			regions.append(_Region(Body(list()), index + 2, target, _TRUE, region, conditional, Instruction(opcode, oparg, index)))
 
-	if total_move < len(codes):
-		if total_move + 4 == len(codes):
-			instructions = [Instruction(100, 0, total_move), Instruction(83, 0, total_move + 2)]
+		elif opcode == FOR_ITER:
+			conditional = _split_conditional(region.body, stream, find_n_values_on_stack(codes, index, depths))
+			regions.append(_Region(Body(list()), index + 2, min(target, region.stop), _LOOP, region, conditional, Instruction(opcode, oparg, index)))
 
-			if isinstance(main_instructs.content[-1], Segment):
-				main_instructs.content[-1].instructions.extend(instructions)
-			else:
-				main_instructs.content.append(Segment(instructions))
+		else:
+			_append(region.body, stream, index >> 1)
+			region.index = index + 2
 
-			return main_instructs
+			# Leaving a nested body, only code something jumps to can still be reached
+			if region.kind != _ROOT and (opcode in Returns or opcode in ForwardJumps):
+				following = bisect_right(targets, index)
+				region.index = targets[following] if following < targets.__len__() and targets[following] < region.stop else region.stop
 
-		return (main_instructs, total_move)
-	else:
-		return main_instructs
+	return root.body
 
 def test(obj: object, display_bytes: bool = False):
 	codes = obj.__code__.co_code
 
 	if display_bytes:
-		seg = Segment(list())
-		for i in range(0, len(codes), 2):
-			seg.instructions.append(Instruction(codes[i], codes[i + 1], i))
-		print(Body([seg]).display())
+		stream = InstructionStream(codes)
+		print(Body([Segment(stream.view(0, len(stream)))]).display())
 
 	tree = build_tree(codes)
 
 	print("\nDISPLAYING TREE\n")
+	tree.write(sys.stdout)
 
-	try:
-		print(tree.display())
-	except AttributeError:
-		print("Hit on", tree[1])
-		print("FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL")
-		print(tree[0].display())
-		print("FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL FAIL")
+_const_loads = frozenset((opmap["LOAD_CONST"],))
+_name_accesses = frozenset(opmap[name] for name in ("STORE_NAME", "LOAD_NAME", "LOAD_GLOBAL", "STORE_GLOBAL"))
+_local_accesses = frozenset(opmap[name] for name in ("LOAD_FAST", "STORE_FAST"))
 
 # Decompiles a CodeType to only its instructions
 def decompile_instructions_to_str(obj: CodeType) -> str:
@@ -374,32 +303,40 @@ def decompile_instructions_to_str(obj: CodeType) -> str:
 
 	if hasattr(obj, "co_code"):
 		codes = obj.co_code
-		longest_instruction_name = len(opname[max(codes[::2], key = lambda code: len(opname[code]))])
-		longest_instruction_code =  len(str(max(codes[::2])))
-		longest_argument = len(str(max(codes[1::2])))
+		opcodes, args = decode(codes)
+		shown = [position for position in range(opcodes.__len__()) if opcodes[position] != CACHE]
+
+		if not shown:
+			return output_str
+
+		longest_instruction_name = max(len(opname[opcodes[position]]) for position in shown)
+		longest_instruction_code = len(str(max(opcodes[position] for position in shown)))
+		longest_argument = len(str(max(args[position] if opcodes[position] != EXTENDED_ARG else codes[(position << 1) + 1] for position in shown)))
 		longest_instruction_number = len(str(len(codes)))
 
-		for i in range(0, len(codes), 2):
-			instruction = codes[i]
+		for position in shown:
+			i = position << 1
+			instruction = opcodes[position]
+			argument = args[position] if instruction != EXTENDED_ARG else codes[i + 1] # Prefixes show their own byte
 
-			output_str += f"{i:<{longest_instruction_number}} {instruction:<{longest_instruction_code}} {codes[i + 1]:<{longest_argument}} - {opname[instruction]}"
+			output_str += f"{i:<{longest_instruction_number}} {instruction:<{longest_instruction_code}} {argument:<{longest_argument}} - {opname[instruction]}"
 
-			if instruction in (100, 90, 101, 97, 125, 124, 116):
+			if instruction in _const_loads or instruction in _name_accesses or instruction in _local_accesses:
 				output_str += " " * (longest_instruction_name - len(opname[instruction]) + 1)
-				if instruction == 100 and hasattr(obj, "co_consts"):
-					const_load_value = obj.co_consts[codes[i + 1]]
+				if instruction in _const_loads and hasattr(obj, "co_consts"):
+					const_load_value = obj.co_consts[argument]
 					if hasattr(const_load_value, "co_code"):
 						const_name = const_load_value.co_name
 						const_type = "Code"
 					else:
-						const_name = str(obj.co_consts[codes[i + 1]])
-						const_type = type(obj.co_consts[codes[i + 1]]).__name__
+						const_name = str(const_load_value)
+						const_type = type(const_load_value).__name__
 					output_str += f" {const_name} ({const_type})"
-				elif instruction in (90, 101, 116, 97):
-					names_name = obj.co_names[codes[i + 1]]
+				elif instruction in _name_accesses:
+					names_name = obj.co_names[name_index(instruction, argument)]
 					output_str += f" \"{names_name}\""
-				elif instruction in (125, 124):
-					names_name = obj.co_varnames[codes[i + 1]]
+				elif instruction in _local_accesses:
+					names_name = obj.co_varnames[argument]
 					output_str += f" \"{names_name}\""
 
 			output_str += "\n"
@@ -407,35 +344,25 @@ def decompile_instructions_to_str(obj: CodeType) -> str:
 
 	return output_str.rstrip("\n")
 
-# Decompiles, recursively, a CodeType
-def decompile_to_str(obj: CodeType, headers = None) -> str:
+# Decompiles, recursively unless told otherwise, a CodeType
+def decompile_to_str(obj: CodeType, headers = None, recursive: bool = True) -> str:
 	output_str = ""
+	consts = []
+	nested = []
 
 	if hasattr(obj, "co_consts"):
-		consts = list(obj.co_consts)
-		if headers is None:
-			next_headers = [obj.co_name]
-		else:
-			next_headers = headers + [obj.co_name]
-
-		disassemblable = []
-
-		for i in range(len(consts)):
-			const = consts[i]
+		for const in obj.co_consts:
 			if hasattr(const, "co_code"):
-				disassemblable.append(i)
-				consts[i] = f"{const.co_name} (Code)"
+				nested.append(const)
+				consts.append(f"{const.co_name} (Code)")
 			else:
-				consts[i] = f"{str(const)} ({type(const).__name__})"
-
-		for i in disassemblable:
-			decompile_to_str(consts[i], next_headers)
+				consts.append(f"{str(const)} ({type(const).__name__})")
 
 	if hasattr(obj, "co_code"):
 		if type(headers) is not list:
 			output_str += f"Disassemble of: {obj.co_name}\n"
 		else:
-			output_str += "Disassemble of:" + " -> ".join(headers) + f"->{obj.co_name}\n"
+			output_str += "Disassemble of: " + " -> ".join(headers + [obj.co_name]) + "\n"
 
 		if len(consts):
 			output_str += "Consts\n\t" + "\n\t".join(consts) + "\n\n"
@@ -454,6 +381,12 @@ def decompile_to_str(obj: CodeType, headers = None) -> str:
 
 		output_str += decompile_instructions_to_str(obj)
 
+	if recursive and nested:
+		next_headers = [obj.co_name] if headers is None else headers + [obj.co_name]
+
+		for const in nested:
+			output_str = output_str.rstrip("\n") + "\n\n" + decompile_to_str(const, next_headers)
+
 	return output_str.rstrip("\n")
 
 # Decompiles 'codes' (CodeType's)
@@ -636,4 +569,37 @@ if __name__ == "__main__":
 		if a == c or (our_b == 2 and our_b == 3):
 			return 2
 
-	test(test_12, True)
\ No newline at end of file
+	test(test_12, True)
+
+	# Every conditional jump has to find the values it tests, on 3.11 these are the POP_JUMP_FORWARD_IF_* jumps after BINARY_OP and CALL
+	def conditionals(body: Body) -> Iterator[Code]:
+		for code in body.content:
+			if isinstance(code, Loop):
+				yield code
+				yield from conditionals(code.loop)
+			elif isinstance(code, If):
+				yield code
+				yield from conditionals(code.exec)
+			elif isinstance(code, Branch):
+				yield code
+				yield from conditionals(code.true)
+				yield from conditionals(code.false)
+
+	internal = next(const for const in test_12.__code__.co_consts if isinstance(const, CodeType))
+	for case in (test_1, test_2, test_3, test_4, test_5, test_7, test_8, test_9, test_10, test_11, test_12, internal):
+		code = case if isinstance(case, CodeType) else case.__code__
+		for conditional in conditionals(build_tree(code.co_code)):
+			assert conditional.conditional.__len__(), f"The {opname[conditional.omitted.opcode]} at {conditional.omitted.id} in {code.co_name} has no test"
+
+	# An If's body starts right after its jump even when the jump's target is past the end of the body it's in, the way the recursive
+	# build_tree split them, so the return an or and the test after it both jump to stays in the innermost If
+	for case in (test_1, test_2, test_3, test_4, test_5, test_7, test_8, test_9, test_10, test_11, test_12, internal):
+		code = case if isinstance(case, CodeType) else case.__code__
+		opcodes = code.co_code[::2]
+		for conditional in conditionals(build_tree(code.co_code)):
+			if isinstance(conditional, If):
+				first = next(instructions_in(conditional.exec), None)
+				after = conditional.omitted.id + 2
+				while opcodes[after >> 1] in (CACHE, EXTENDED_ARG):
+					after += 2
+				assert first is not None and first.id == after, f"The If at {conditional.omitted.id} in {code.co_name} doesn't start its body at {after}"
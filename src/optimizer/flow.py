@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List
+
+from wordcode import CACHE, InlineCaches, JumpKinds, Terminators, decode, jump_target
+
+@dataclass(eq = False)
+class BasicBlock:
+	start: int # Offset of the first instruction
+	stop: int  # Offset after the last instruction
+	successors: List["BasicBlock"] = field(default_factory = list)
+	predecessors: List["BasicBlock"] = field(default_factory = list)
+
+	def __len__(self): return (self.stop - self.start) >> 1
+
+	def __repr__(self):
+		return f"<Block {self.start}:{self.stop} -> {[block.start for block in self.successors]}>"
+
+@dataclass(eq = False)
+class ControlFlowGraph:
+	codes: bytes
+	blocks: List[BasicBlock]
+	jumps: Dict[int, int]          # Offset of a jump -> offset it jumps to
+	targets: Dict[int, List[int]]  # Offset jumped to -> offsets of the jumps
+	block_at: Dict[int, BasicBlock] # Offset of a block's first instruction -> block
+
+	def block_of(self, index: int) -> BasicBlock:
+		while index not in self.block_at:
+			index -= 2
+
+		return self.block_at[index]
+
+# handlers are the offsets exceptions are caught at, from wordcode.exception_table, they start blocks of their own
+def build_graph(codes: bytes, handlers: Iterable[int] = ()) -> ControlFlowGraph:
+	opcodes, args = decode(codes)
+	length = len(codes)
+	leaders = bytearray(length + 2 + 2 * max(InlineCaches))
+	leaders[0] = 1
+	for handler in handlers:
+		if 0 <= handler < length:
+			leaders[handler] = 1
+	jumps = {}
+	targets = {}
+
+	# Single forward pass to index every jump and mark where blocks start
+	for position in range(opcodes.__len__()):
+		opcode = opcodes[position]
+		index = position << 1
+		after = index + 2 + 2 * InlineCaches[opcode]
+
+		# After a terminator the next instruction can only be reached by a jump
+		if not JumpKinds[opcode]:
+			if opcode in Terminators:
+				leaders[after] = 1
+			continue
+
+		target = jump_target(opcode, args[position], index)
+
+		if target < 0 or target >= length:
+			continue
+
+		jumps[index] = target
+		targets.setdefault(target, []).append(index)
+		leaders[target] = leaders[after] = 1
+
+	blocks = []
+	block_at = {}
+	start = 0
+
+	for index in range(2, length + 2, 2):
+		if leaders[index] or index >= length:
+			block = BasicBlock(start, min(index, length))
+			blocks.append(block)
+			block_at[start] = block
+			start = index
+
+			if index >= length:
+				break
+
+	for i, block in enumerate(blocks):
+		last = block.stop - 2
+		while last > block.start and opcodes[last >> 1] == CACHE:
+			last -= 2
+
+		if last in jumps and jumps[last] in block_at:
+			block.successors.append(block_at[jumps[last]])
+
+		if opcodes[last >> 1] not in Terminators and i + 1 < len(blocks):
+			block.successors.append(blocks[i + 1])
+
+		for successor in block.successors:
+			successor.predecessors.append(block)
+
+	return ControlFlowGraph(codes, blocks, jumps, targets, block_at)
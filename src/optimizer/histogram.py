@@ -0,0 +1,253 @@
+from array import array
+from opcode import EXTENDED_ARG
+from time import perf_counter_ns
+from types import CodeType
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+from quantiphy import Quantity
+import sys
+
+from decompiler import build_tree
+from structures import Body, Branch, Code, For, If, Instruction, Loop, Segment, instructions_in
+from wordcode import ConditionalJumps, instructions, jump_target
+
+"""
+Counts how many times every instruction of a function runs and how long it takes
+
+Frames of the tracked code objects are traced with f_trace_opcodes so every instruction sends an opcode event,
+the time from one event to the next is charged to the instruction that was running, including anything it called
+Only one call out of every few is traced, the rest run at full speed with no local trace function at all,
+and the counts are scaled back up by the share of calls that were traced
+Conditional jumps also count how often they went to their target, for the taken and not taken counts of every branch
+The counts are then laid over the tree from build_tree so If, For and While blocks show how often they ran
+"""
+
+EVERY = 16 # Trace one call out of this many
+
+def _render(nanoseconds: float) -> str:
+	return Quantity(nanoseconds / 1e9, "s").render(prec = 3)
+
+class OpcodeHistogram:
+
+	def __init__(self, code: CodeType):
+		self.code = code
+		self.counts = array("Q", bytes(code.co_code.__len__() * 4)) # Executions seen, by offset >> 1
+		self.times = array("Q", bytes(code.co_code.__len__() * 4))  # Nanoseconds spent, by offset >> 1
+		self.taken = array("Q", bytes(code.co_code.__len__() * 4))  # Times a conditional jump went to its target, by offset >> 1
+		self.targets = array("l", [-1]) * (code.co_code.__len__() >> 1) # Position each conditional jump goes to
+		self.calls = 0  # Calls of the code, traced or not
+		self.traced = 0 # Calls that were traced
+		self.__tree = None
+
+		codes = code.co_code
+		for offset, opcode, arg in instructions(codes):
+			if opcode in ConditionalJumps:
+				while codes[offset] == EXTENDED_ARG:
+					offset += 2
+				self.targets[offset >> 1] = jump_target(opcode, arg, offset) >> 1
+
+	# Calls per traced call, what the sampled counts are multiplied by
+	@property
+	def scale(self) -> float:
+		return self.calls / self.traced if self.traced else 0.0
+
+	def count(self, offset: int) -> float:
+		return self.counts[offset >> 1] * self.scale
+
+	def time(self, offset: int) -> float:
+		return self.times[offset >> 1] * self.scale
+
+	@property
+	def total_time(self) -> float:
+		return sum(self.times) * self.scale
+
+	# (offset, estimated executions, estimated nanoseconds) of the instructions that took the most time
+	def hottest(self, n: int = 10) -> List[Tuple[int, float, float]]:
+		offsets = sorted(range(self.times.__len__()), key = self.times.__getitem__, reverse = True)[:n]
+		return [(position << 1, self.count(position << 1), self.time(position << 1)) for position in offsets if self.counts[position]]
+
+	# Offset of every conditional jump that ran -> (times it jumped, times it fell through)
+	def branches(self) -> Dict[int, Tuple[float, float]]:
+		scale = self.scale
+		return {position << 1: (self.taken[position] * scale, (self.counts[position] - self.taken[position]) * scale)
+			for position, target in enumerate(self.targets) if target >= 0 and self.counts[position]}
+
+	# Offset of the FOR_ITER or test of every loop that ran -> (times it was started, times round it)
+	# A loop left with a break isn't seen leaving, so a while loop started over after one is undercounted
+	def loops(self) -> Dict[int, Tuple[float, float]]:
+		trips = {}
+
+		def visit(body: Body):
+			for node in body.content:
+				if isinstance(node, Loop):
+					iterations = self.hits(node.loop)
+					if isinstance(node, For) and node.conditional.__len__():
+						entries = self.hits(node.conditional)
+					else:
+						entries = max(self.count(node.omitted.id) - iterations, 0.0)
+
+					if entries or iterations:
+						trips[node.omitted.id] = (entries, iterations)
+					visit(node.loop)
+				elif isinstance(node, If):
+					visit(node.exec)
+				elif isinstance(node, Branch):
+					visit(node.true)
+					visit(node.false)
+
+		visit(self.tree)
+		return trips
+
+	@property
+	def tree(self) -> Body:
+		if self.__tree is None:
+			self.__tree = build_tree(self.code.co_code)
+		return self.__tree
+
+	# Executions of a node, counted at its first instruction
+	def hits(self, node: Union[Code, Body, Instruction]) -> float:
+		first = next(instructions_in(node), None)
+		return 0.0 if first is None else self.count(first.id)
+
+	# Nanoseconds spent in every instruction of a node
+	def node_time(self, node: Union[Code, Body, Instruction]) -> float:
+		return sum(self.time(instruction.id) for instruction in instructions_in(node))
+
+	def __instruction_line(self, instruction: Instruction, tabs: str) -> str:
+		return f"{self.count(instruction.id):>12.0f} {_render(self.time(instruction.id)):>9}  {tabs}{instruction!r}"
+
+	def __header(self, tabs: str, text: str) -> str:
+		return f"{'':>12} {'':>9}  {tabs}{text}"
+
+	# Same layout as Code.lines with the executions and time of every instruction in front
+	# and the hit counts of every block after its header
+	def lines(self, body: Body = None, indent: int = 0) -> Iterator[str]:
+		if body is None:
+			body = self.tree
+			yield self.__header("", f"{self.code.co_name}: {self.calls} calls, {self.traced} traced, {_render(self.total_time)}")
+
+		tabs = "\t" * indent
+
+		for node in body.content:
+			if isinstance(node, Segment):
+				for instruction in node:
+					yield self.__instruction_line(instruction, tabs)
+				continue
+
+			yield self.__header(tabs, "Conditional->")
+			for instruction in node.conditional:
+				yield self.__instruction_line(instruction, tabs + "\t")
+
+			if isinstance(node, Loop):
+				name = "While" if node.omitted.opcode != 93 else "Loop" # FOR_ITER
+				yield self.__instruction_line(node.omitted, tabs).rstrip() + f"  [{name}: {self.hits(node.loop):.0f} iterations, {_render(self.node_time(node))}]"
+				yield from self.lines(node.loop, indent + 1)
+				continue
+
+			yield self.__instruction_line(node.omitted, tabs + "\t")
+			runs = self.count(node.omitted.id)
+
+			if isinstance(node, If):
+				yield self.__header(tabs, f"If {'True' if node.if_true else 'False'}->  [{self.hits(node.exec):.0f} of {runs:.0f}, {_render(self.node_time(node))}]")
+				yield from self.lines(node.exec, indent + 1)
+			elif isinstance(node, Branch):
+				arms = (("True", node.true), ("False", node.false))
+				for name, arm in (arms if node.true_first else reversed(arms)):
+					yield self.__header(tabs, f"{name} Branch->  [{self.hits(arm):.0f} of {runs:.0f}, {_render(self.node_time(arm))}]")
+					yield from self.lines(arm, indent + 1)
+
+	def display(self) -> str:
+		return "\n".join(self.lines())
+
+	def __str__(self) -> str:
+		return self.display()
+
+# Every code object in code, nested functions and comprehensions included
+def _nested_codes(code: CodeType) -> Iterator[CodeType]:
+	yield code
+	for const in code.co_consts:
+		if isinstance(const, CodeType):
+			yield from _nested_codes(const)
+
+# Collects an OpcodeHistogram for each of the targets while it's active, or for all code that runs when there are none
+# Only traces the thread it's entered on, and puts back whatever trace function was there before
+class OpcodeTracer:
+
+	def __init__(self, *targets: Union[Callable, CodeType], every: int = EVERY, nested: bool = True):
+		if every < 1:
+			raise ValueError("every has to be at least 1")
+
+		self.every = every
+		self.everything = not targets
+		self.histograms: Dict[CodeType, OpcodeHistogram] = {}
+
+		for target in targets:
+			code = target if isinstance(target, CodeType) else target.__code__
+			for child in (_nested_codes(code) if nested else (code,)):
+				self.histograms[child] = OpcodeHistogram(child)
+
+		self.__previous = None
+
+	def __getitem__(self, target: Union[Callable, CodeType]) -> OpcodeHistogram:
+		return self.histograms[target if isinstance(target, CodeType) else target.__code__]
+
+	def __call(self, frame, event: str, arg: Any):
+		histogram = self.histograms.get(frame.f_code)
+		if histogram is None:
+			if not self.everything:
+				return None
+			histogram = self.histograms[frame.f_code] = OpcodeHistogram(frame.f_code)
+
+		histogram.calls += 1
+		if (histogram.calls - 1) % self.every:
+			return None # Not sampled, the frame runs without a local trace function
+
+		histogram.traced += 1
+		frame.f_trace_lines = False
+		frame.f_trace_opcodes = True
+
+		counts = histogram.counts
+		times = histogram.times
+		taken = histogram.taken
+		targets = histogram.targets
+		last = -1
+		last_time = 0
+
+		def trace(frame, event: str, arg: Any):
+			nonlocal last, last_time
+			now = perf_counter_ns()
+
+			if last >= 0:
+				times[last] += now - last_time
+
+			if event == "opcode":
+				position = frame.f_lasti >> 1
+				if last >= 0 and targets[last] == position:
+					taken[last] += 1
+				last = position
+				counts[last] += 1
+			elif event == "return":
+				last = -1
+
+			last_time = perf_counter_ns() # The trace function's own time isn't charged to anything
+			return trace
+
+		return trace
+
+	def __enter__(self) -> "OpcodeTracer":
+		self.__previous = sys.gettrace()
+		sys.settrace(self.__call)
+		return self
+
+	def __exit__(self, *exception):
+		sys.settrace(self.__previous)
+
+	def display(self) -> str:
+		return "\n\n".join(histogram.display() for histogram in self.histograms.values() if histogram.calls)
+
+# Calls function(*args, **kwargs) with its instructions counted
+# Returns what it returned and the histogram of its own code
+def histogram(function: Callable, *args, every: int = 1, **kwargs) -> Tuple[Any, OpcodeHistogram]:
+	with OpcodeTracer(function, every = every) as tracer:
+		result = function(*args, **kwargs)
+
+	return result, tracer[function]
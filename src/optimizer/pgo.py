@@ -0,0 +1,128 @@
+from dataclasses import dataclass, field
+from hashlib import sha256
+from types import CodeType
+from typing import Any, Callable, Dict, Tuple
+import json
+
+from cache import code_key
+from histogram import OpcodeHistogram, OpcodeTracer
+
+"""
+Profiles for profile guided optimization
+
+An instrumented run under OpcodeTracer records how often every conditional jump was taken and how many times round
+every loop went, these are kept per code object under its code_key so a profile only ever applies to the exact code it was
+recorded from, and can be saved as JSON to feed the optimizer in a later run
+"""
+
+HOT = 0.01 # Share of all the instructions run in the profile a code object needs to be worth the aggressive passes
+
+@dataclass(eq = False)
+class CodeProfile:
+	name: str
+	calls: float = 0.0
+	executed: float = 0.0 # Instructions run
+	branches: Dict[int, Tuple[float, float]] = field(default_factory = dict) # Offset of a conditional jump -> (times taken, times not taken)
+	loops: Dict[int, Tuple[float, float]] = field(default_factory = dict)    # Offset of a FOR_ITER or while test -> (times started, times round)
+
+	# Average number of times round the loop each time it's started
+	def trips(self, offset: int) -> float:
+		entries, iterations = self.loops.get(offset, (0.0, 0.0))
+		return iterations / entries if entries else iterations
+
+	def merge(self, other: "CodeProfile"):
+		self.calls += other.calls
+		self.executed += other.executed
+		for counts, others in ((self.branches, other.branches), (self.loops, other.loops)):
+			for offset, (first, second) in others.items():
+				had_first, had_second = counts.get(offset, (0.0, 0.0))
+				counts[offset] = (had_first + first, had_second + second)
+
+	def to_json(self) -> dict:
+		return {"name": self.name, "calls": self.calls, "executed": self.executed,
+			"branches": {str(offset): list(counts) for offset, counts in self.branches.items()},
+			"loops": {str(offset): list(counts) for offset, counts in self.loops.items()}}
+
+	@staticmethod
+	def from_json(data: dict) -> "CodeProfile":
+		return CodeProfile(data["name"], data["calls"], data["executed"],
+			{int(offset): tuple(counts) for offset, counts in data["branches"].items()},
+			{int(offset): tuple(counts) for offset, counts in data["loops"].items()})
+
+	@staticmethod
+	def from_histogram(histogram: OpcodeHistogram) -> "CodeProfile":
+		try:
+			loops = histogram.loops()
+		except NotImplementedError:
+			loops = {} # Has operands the decompiler can't follow yet
+
+		return CodeProfile(histogram.code.co_name, float(histogram.calls), sum(histogram.counts) * histogram.scale, histogram.branches(), loops)
+
+class Profile:
+
+	def __init__(self, codes: Dict[str, CodeProfile] = None, threshold: float = HOT):
+		self.codes = {} if codes is None else codes # code_key -> CodeProfile
+		self.threshold = threshold
+
+	def __len__(self): return self.codes.__len__()
+
+	def __contains__(self, code: CodeType): return code_key(code) in self.codes
+
+	def get(self, code: CodeType) -> CodeProfile:
+		return self.codes.get(code_key(code))
+
+	def add(self, code: CodeType, counts: CodeProfile):
+		key = code_key(code)
+		if key in self.codes:
+			self.codes[key].merge(counts)
+		else:
+			self.codes[key] = counts
+
+	# Adds the counts of every code object the tracer saw run
+	def record(self, tracer: OpcodeTracer):
+		for code, histogram in tracer.histograms.items():
+			if histogram.traced:
+				self.add(code, CodeProfile.from_histogram(histogram))
+
+	@property
+	def executed(self) -> float:
+		return sum(counts.executed for counts in self.codes.values())
+
+	# Whether the code ran enough of the profile's instructions to spend the aggressive passes on
+	# Code the profile never saw run is cold
+	def hot(self, code: CodeType) -> bool:
+		counts = self.get(code)
+		total = self.executed
+		return counts is not None and total > 0 and counts.executed / total >= self.threshold
+
+	# Changes whenever any count does, for caching what was optimized with the profile
+	def digest(self) -> str:
+		return sha256(json.dumps(self.to_json(), sort_keys = True).encode()).hexdigest()
+
+	def to_json(self) -> dict:
+		return {"threshold": self.threshold, "codes": {key: counts.to_json() for key, counts in self.codes.items()}}
+
+	@staticmethod
+	def from_json(data: dict) -> "Profile":
+		return Profile({key: CodeProfile.from_json(counts) for key, counts in data["codes"].items()}, data["threshold"])
+
+	def save(self, filename: str):
+		with open(filename, "w") as file:
+			json.dump(self.to_json(), file, indent = "\t", sort_keys = True)
+
+	@staticmethod
+	def load(filename: str) -> "Profile":
+		with open(filename) as file:
+			return Profile.from_json(json.load(file))
+
+# Calls function(*args, **kwargs) with all the code it runs counted
+# Returns what it returned and the profile of the run, added to profile when one is given
+def record(function: Callable, *args, profile: Profile = None, every: int = 1, **kwargs) -> Tuple[Any, Profile]:
+	if profile is None:
+		profile = Profile()
+
+	with OpcodeTracer(every = every) as tracer:
+		result = function(*args, **kwargs)
+
+	profile.record(tracer)
+	return result, profile
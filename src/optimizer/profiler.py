@@ -1,73 +1,288 @@
-from time import process_time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from math import ceil, erfc, sqrt
+from random import Random
+from time import perf_counter_ns
 from os import devnull
 from types import CodeType
-from typing import List, Tuple
+from typing import Callable, Iterator, List, Sequence, Tuple
 from quantiphy import Quantity
+import builtins
+import gc
 import sys
 
-def _average_of(items: list):
-	return sum(items) / len(items)
+from timings import Buffer, as_buffer, buffer, count_above, count_below, extremes, mean, numpy, ordered, refine, scale
 
-# Remove large deviations from data
-def _refine(items: list) -> List[object]:
-	# Calculate the standard deviation
-	average = _average_of(items)
-	sum_of_squared_deviations = 0
-	for item in items:
-		sum_of_squared_deviations += (item - average) ** 2
-	standard_deviation = (sum_of_squared_deviations / len(items)) ** 0.5
-	del average, sum_of_squared_deviations
-
-	# Purge items
-	return [item for item in items if abs(item - average) < standard_deviation]
-
-# Profiles compiled code and calculates statistics about the runtimes
-# If tolerance <= 0: returns min, max, and average
-# Else returns min, max, average, # of close to min speeds, # of close to max speeds
-def profile(compiled_code: CodeType, runs: int = 512, tolerance: float = 5, refinements: int = 1) -> Tuple[float]:
-	"""
-
-	"""
-
-	speeds: List[float] = []
+SAMPLES = 64          # Timed samples per benchmark
+WARMUPS = 4           # Untimed samples run first to fill caches
+MIN_TIME = 1_000_000  # Nanoseconds a single sample should at least take
+MAX_LOOPS = 1 << 24   # Most runs of the code put into a single sample
+RESAMPLES = 2000      # Bootstrap resamples for confidence intervals
 
+# Remove any output from code
+@contextmanager
+def _silenced() -> Iterator[None]:
 	with open(devnull, "w") as null:
-		# Remove any output from code
 		saved_stdout = sys.stdout
 		saved_stderr = sys.stderr
 		try:
 			sys.stdout = sys.stderr = null
-
-			for _ in range(runs):
-				start_time = process_time()
-				exec(compiled_code) # Unsafe
-				end_time = process_time()
-				speeds.append(end_time - start_time)
-
+			yield
 		finally:
 			sys.stdout = saved_stdout
 			sys.stderr = saved_stderr
 
+# Garbage collection is paused while timing so a collection doesn't land in a random sample
+@contextmanager
+def _no_collection() -> Iterator[None]:
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+
+# Globals the code runs in, kept apart from the profiler's own
+def _namespace() -> dict:
+	return {"__builtins__": builtins, "__name__": "__benchmark__"}
+
+# Nanoseconds taken by running the code loops times back to back
+def _time(compiled_code: CodeType, loops: int, namespace: dict) -> int:
+	iterations = range(loops)
+	start_time = perf_counter_ns()
+	for _ in iterations:
+		exec(compiled_code, namespace) # Unsafe
+	return perf_counter_ns() - start_time
+
+# Smallest step perf_counter_ns can measure
+def timer_resolution() -> int:
+	resolution = None
+
+	for _ in range(64):
+		start_time = perf_counter_ns()
+		while (end_time := perf_counter_ns()) == start_time:
+			pass
+
+		if resolution is None or end_time - start_time < resolution:
+			resolution = end_time - start_time
+
+	return resolution
+
+# Number of runs of the code that fit in a sample of at least min_time nanoseconds
+# Short samples are dominated by the timer's resolution and the cost of reading it
+def calibrate(compiled_code: CodeType, min_time: int = MIN_TIME, namespace: dict = None) -> int:
+	if namespace is None:
+		namespace = _namespace()
+
+	min_time = max(min_time, timer_resolution() * 1000)
+	loops = 1
+
+	while loops < MAX_LOOPS:
+		elapsed = _time(compiled_code, loops, namespace)
+		if elapsed >= min_time:
+			break
+
+		# Once a sample is long enough to trust, jump close to the target instead of doubling
+		if elapsed >= min_time // 16:
+			loops = ceil(loops * min_time * 1.1 / elapsed)
+		else:
+			loops *= 2
+
+	return min(loops, MAX_LOOPS)
+
+# Value below which q percent of the ordered values fall, interpolating between neighbours
+def percentile(ordered: Sequence[float], q: float) -> float:
+	if ordered.__len__() == 0:
+		raise ValueError("percentile of no values")
+
+	position = (ordered.__len__() - 1) * q / 100.0
+	lower = int(position)
+	upper = min(lower + 1, ordered.__len__() - 1)
+	return float(ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower))
+
+def median(values: Sequence[float]) -> float:
+	return percentile(ordered(values), 50)
+
+# Confidence interval of statistic(*groups) by resampling each group with replacement
+def bootstrap(statistic: Callable[..., float], *groups: Sequence[float], confidence: float = 0.95, resamples: int = RESAMPLES, seed: int = 0) -> Tuple[float, float]:
+	# Fixed seed so the same samples always give the same interval
+	if numpy is not None:
+		generator = numpy.random.default_rng(seed)
+		groups = [as_buffer(group) for group in groups]
+		resample = lambda group: group[generator.integers(0, group.__len__(), group.__len__())]
+	else:
+		random = Random(seed)
+		resample = lambda group: as_buffer(random.choices(group, k = group.__len__()))
+
+	estimates = sorted(statistic(*(resample(group) for group in groups)) for _ in range(resamples))
+	tail = (1.0 - confidence) * 50.0
+	return percentile(estimates, tail), percentile(estimates, 100.0 - tail)
+
+# Two sided p-value of the Mann-Whitney U test, the chance of the samples differing this much if both came from the same distribution
+# Timings are skewed with a long tail so a rank test fits better than a t-test
+def mann_whitney(first: Sequence[float], second: Sequence[float]) -> float:
+	n1, n2 = first.__len__(), second.__len__()
+	if n1 == 0 or n2 == 0:
+		raise ValueError("mann_whitney needs samples in both groups")
+
+	# Tied values all share the average of their ranks
+	if numpy is not None:
+		values, inverse, counts = numpy.unique(numpy.concatenate((as_buffer(first), as_buffer(second))), return_inverse = True, return_counts = True)
+		ranks = numpy.cumsum(counts) - (counts - 1) / 2.0
+		rank_sum = float(numpy.sum(ranks[inverse[:n1]]))
+		tie_correction = float(numpy.sum(counts.astype(numpy.float64) ** 3 - counts))
+	else:
+		ranked = sorted([(value, 0) for value in first] + [(value, 1) for value in second])
+		rank_sum = 0.0
+		tie_correction = 0.0
+		i = 0
+
+		while i < ranked.__len__():
+			j = i
+			while j + 1 < ranked.__len__() and ranked[j + 1][0] == ranked[i][0]:
+				j += 1
+
+			rank = (i + j) / 2.0 + 1
+			ties = j - i + 1
+			tie_correction += ties ** 3 - ties
+			rank_sum += rank * sum(1 for k in range(i, j + 1) if ranked[k][1] == 0)
+			i = j + 1
+
+	u = rank_sum - n1 * (n1 + 1) / 2.0
+	n = n1 + n2
+	variance = n1 * n2 / 12.0 * ((n + 1) - tie_correction / (n * (n - 1)))
+
+	if variance <= 0:
+		return 1.0 # Every value is the same
+
+	z = (abs(u - n1 * n2 / 2.0) - 0.5) / sqrt(variance) # With continuity correction
+	return min(1.0, erfc(max(z, 0.0) / sqrt(2)))
+
+def _render(nanoseconds: float) -> str:
+	return Quantity(nanoseconds / 1e9, "s").render(prec = 4, strip_zeros = False)
+
+@dataclass(eq = False)
+class Measurement:
+	samples: Buffer      # Nanoseconds per run of the code, one value per sample
+	loops: int           # Runs of the code timed together in each sample
+	warmups: int         # Untimed samples run first
+
+	def __post_init__(self):
+		self.samples = as_buffer(self.samples)
+		self.ordered = ordered(self.samples)
+
+	def __len__(self): return self.samples.__len__()
+
+	def percentile(self, q: float) -> float:
+		return percentile(self.ordered, q)
+
+	@property
+	def median(self) -> float: return percentile(self.ordered, 50)
+
+	@property
+	def iqr(self) -> float: return percentile(self.ordered, 75) - percentile(self.ordered, 25)
+
+	@property
+	def minimum(self) -> float: return float(self.ordered[0])
+
+	@property
+	def maximum(self) -> float: return float(self.ordered[-1])
+
+	@property
+	def mean(self) -> float: return mean(self.samples)
+
+	# Bootstrapped confidence interval of the median
+	def interval(self, confidence: float = 0.95) -> Tuple[float, float]:
+		return bootstrap(median, self.samples, confidence = confidence)
+
+	def __str__(self):
+		low, high = self.interval()
+		return f"Median: {_render(self.median)} [95% CI {_render(low)} - {_render(high)}], IQR: {_render(self.iqr)}, " \
+			f"P5/P95: {_render(self.percentile(5))} / {_render(self.percentile(95))} ({self.__len__()} samples of {self.loops} loops)"
+
+@dataclass(eq = False)
+class Comparison:
+	before: Measurement
+	after: Measurement
+	p_value: float             # From the Mann-Whitney U test
+	speedups: Tuple[float, float] # Bootstrapped confidence interval of the speedup
+	alpha: float
+
+	# How many times faster after is than before, by their medians
+	@property
+	def speedup(self) -> float: return self.before.median / self.after.median
+
+	# True when the difference is unlikely to be noise
+	@property
+	def significant(self) -> bool: return self.p_value < self.alpha
+
+	def __str__(self):
+		verdict = ("Faster" if self.speedup > 1 else "Slower") if self.significant else "No significant difference"
+		return f"Before: {self.before}\nAfter:  {self.after}\n" \
+			f"Speedup: {self.speedup:.4f}x [{(1 - self.alpha) * 100:g}% CI {self.speedups[0]:.4f}x - {self.speedups[1]:.4f}x], p = {self.p_value:.4g} ({verdict})"
+
+# Runs each code object in turn for every sample so drift in the machine's speed hits them equally
+def _sample_interleaved(codes: Sequence[CodeType], loops: Sequence[int], namespaces: Sequence[dict], samples: int, warmups: int) -> List[Buffer]:
+	times = [buffer(samples) for _ in codes]
+
+	with _silenced(), _no_collection():
+		for _ in range(warmups):
+			for compiled_code, count, namespace in zip(codes, loops, namespaces):
+				_time(compiled_code, count, namespace)
+
+		for sample in range(samples):
+			for compiled_code, count, namespace, results in zip(codes, loops, namespaces, times):
+				results[sample] = _time(compiled_code, count, namespace) / count
+
+	return times
+
+def benchmark(compiled_code: CodeType, samples: int = SAMPLES, warmups: int = WARMUPS, min_time: int = MIN_TIME, loops: int = None) -> Measurement:
+	namespace = _namespace()
+
+	if loops is None:
+		with _silenced():
+			loops = calibrate(compiled_code, min_time, namespace)
+
+	return Measurement(_sample_interleaved((compiled_code,), (loops,), (namespace,), samples, warmups)[0], loops, warmups)
+
+# Benchmarks both code objects and tests whether after really runs at a different speed than before
+def compare(before_code: CodeType, after_code: CodeType, samples: int = SAMPLES, warmups: int = WARMUPS, min_time: int = MIN_TIME, alpha: float = 0.05) -> Comparison:
+	codes = (before_code, after_code)
+	namespaces = (_namespace(), _namespace())
+
+	with _silenced():
+		loops = [calibrate(compiled_code, min_time, namespace) for compiled_code, namespace in zip(codes, namespaces)]
+
+	before_times, after_times = _sample_interleaved(codes, loops, namespaces, samples, warmups)
+	before = Measurement(before_times, loops[0], warmups)
+	after = Measurement(after_times, loops[1], warmups)
+
+	speedups = bootstrap(lambda first, second: median(first) / median(second), before_times, after_times, confidence = 1 - alpha)
+	return Comparison(before, after, mann_whitney(before_times, after_times), speedups, alpha)
+
+# Profiles compiled code and calculates statistics about the runtimes
+# Every run is the time of one execution in seconds, averaged over a calibrated number of loops
+# If tolerance <= 0: returns min, max, and average
+# Else returns min, max, average, # of close to min speeds, # of close to max speeds
+def profile(compiled_code: CodeType, runs: int = 512, tolerance: float = 5, refinements: int = 1) -> Tuple[float]:
+	speeds: Buffer = scale(benchmark(compiled_code, runs).samples, 1e-9)
+
 	for _ in range(refinements):
-		speeds = _refine(speeds)
+		refined = refine(speeds)
+		if refined.__len__(): # Identical speeds have no deviation to keep within
+			speeds = refined
 
-	min_speed = min(speeds)
-	max_speed = max(speeds)
+	min_speed, max_speed = extremes(speeds)
 
 	if tolerance > 0:
-		close_to_min_speed = 0
-		close_to_max_speed = 0
-
 		speed_range = max_speed - min_speed # Range
 		max_percent = max_speed - speed_range * (tolerance / 100.0) # Max - Tolerance * Range
 		min_percent = min_speed + speed_range * (tolerance / 100.0) # Min + Tolerance * Range
 
-		for speed in speeds:
-			if speed < min_percent:
-				close_to_min_speed += 1
-			elif speed > max_percent:
-				close_to_max_speed += 1
+		close_to_min_speed = count_below(speeds, min_percent)
+		close_to_max_speed = count_above(speeds, max_percent)
 
-		return (min_speed, max_speed, _average_of(speeds), close_to_min_speed, close_to_max_speed)
+		return (min_speed, max_speed, mean(speeds), close_to_min_speed, close_to_max_speed)
 
-	return (min_speed, max_speed, _average_of(speeds))
\ No newline at end of file
+	return (min_speed, max_speed, mean(speeds))
@@ -0,0 +1,92 @@
+from array import array
+from contextlib import contextmanager
+from marshal import dumps, loads
+from multiprocessing import Pool, Queue
+from os import cpu_count
+from types import CodeType
+from typing import Dict, Iterator, List, Tuple
+import os
+
+from timings import to_array
+from profiler import MIN_TIME, SAMPLES, WARMUPS, Comparison, Measurement, benchmark, bootstrap, mann_whitney, median
+
+_cpus = None # Queue of CPUs that are free for a worker to pin itself to
+
+def _initialize(cpus: Queue):
+	global _cpus
+	_cpus = cpus
+
+# Keeps the worker on one CPU for the job so it isn't migrated mid sample or sharing a core with another worker
+@contextmanager
+def _pinned() -> Iterator[None]:
+	if _cpus is None:
+		yield
+		return
+
+	cpu = _cpus.get()
+	try:
+		os.sched_setaffinity(0, {cpu})
+		yield
+	finally:
+		_cpus.put(cpu)
+
+def _calibrate(job: Tuple[str, bytes, int]) -> Tuple[str, int]:
+	name, marshalled, min_time = job
+	with _pinned():
+		return name, benchmark(loads(marshalled), 0, 0, min_time).loops
+
+def _sample(job: Tuple[str, bytes, int, int, int]) -> Tuple[str, array]:
+	name, marshalled, loops, samples, warmups = job
+	with _pinned():
+		return name, to_array(benchmark(loads(marshalled), samples, warmups, loops = loops).samples)
+
+def available_cpus() -> List[int]:
+	if hasattr(os, "sched_getaffinity"):
+		return sorted(os.sched_getaffinity(0))
+	return list(range(cpu_count() or 1))
+
+# Benchmarks every code object in separate worker processes and merges each one's samples
+# Every job gets a fresh process so one variant's garbage, caches and warmed up state never carry over to another
+# Samples are split into chunks per variant and the chunks of all variants are interleaved across the workers
+def run_benchmarks(codes: Dict[str, CodeType], samples: int = SAMPLES, warmups: int = WARMUPS, min_time: int = MIN_TIME, loops: int = None, workers: int = None, chunks: int = None, pin: bool = True) -> Dict[str, Measurement]:
+	cpus = available_cpus()
+
+	if workers is None:
+		workers = cpus.__len__()
+	if chunks is None:
+		chunks = workers
+	chunks = max(1, min(chunks, samples))
+
+	free_cpus = None
+	if pin and hasattr(os, "sched_setaffinity"):
+		free_cpus = Queue()
+		for i in range(workers):
+			free_cpus.put(cpus[i % cpus.__len__()])
+
+	marshalled = {name: dumps(code) for name, code in codes.items()}
+	times = {name: array("d") for name in codes}
+
+	with Pool(workers, _initialize, (free_cpus,), maxtasksperchild = 1) as pool:
+		# Every chunk of a variant runs the same number of loops per sample so their samples can be merged
+		if loops is None:
+			counts = dict(pool.imap_unordered(_calibrate, [(name, code, min_time) for name, code in marshalled.items()]))
+		else:
+			counts = {name: loops for name in codes}
+
+		jobs = []
+		for chunk in range(chunks):
+			size = samples // chunks + (chunk < samples % chunks)
+			jobs.extend((name, code, counts[name], size, warmups) for name, code in marshalled.items())
+
+		for name, chunk_times in pool.imap_unordered(_sample, jobs):
+			times[name].extend(chunk_times)
+
+	return {name: Measurement(times[name], counts[name], warmups) for name in codes}
+
+# Same as profiler.compare but each variant is sampled in its own worker processes
+def compare(before_code: CodeType, after_code: CodeType, samples: int = SAMPLES, warmups: int = WARMUPS, min_time: int = MIN_TIME, alpha: float = 0.05, workers: int = None, pin: bool = True) -> Comparison:
+	results = run_benchmarks({"before": before_code, "after": after_code}, samples, warmups, min_time, workers = workers, pin = pin)
+	before, after = results["before"], results["after"]
+
+	speedups = bootstrap(lambda first, second: median(first) / median(second), before.samples, after.samples, confidence = 1 - alpha)
+	return Comparison(before, after, mann_whitney(before.samples, after.samples), speedups, alpha)
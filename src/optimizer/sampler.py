@@ -0,0 +1,275 @@
+from bisect import bisect_right
+from collections import Counter
+from dataclasses import dataclass
+from dis import findlinestarts
+from os import path
+from threading import Event, Thread, get_ident
+from time import perf_counter_ns
+from types import CodeType
+from typing import Dict, Iterable, Iterator, List, TextIO, Tuple, Union
+import sys
+
+from decompiler import build_tree
+from structures import Body, Branch, Code, If, Instruction, Loop, Segment
+
+"""
+Samples what every thread is running from a background thread, for code that can't be slowed down by tracing
+
+A few hundred times a second the stacks of the other threads are read from sys._current_frames() as (code, f_lasti) pairs
+and kept in a ring buffer of a fixed size, so a long run keeps its most recent samples instead of growing without end
+Nothing runs in the sampled threads themselves, the cost is only the time the sampler holds the GIL to copy the stacks
+which overhead measures against the time sampled
+"""
+
+FREQUENCY = 200     # Samples a second
+CAPACITY = 1 << 16  # Samples kept, older ones are overwritten
+DEPTH = 128         # Most frames kept of a stack, the innermost ones
+
+Stack = Tuple[Tuple[CodeType, int], ...] # (code, f_lasti) of every frame, innermost first
+
+@dataclass(eq = False)
+class FunctionSamples:
+	code: CodeType
+	own: int   # Samples with it running
+	total: int # Samples with it anywhere on the stack
+
+	@property
+	def name(self) -> str: return _frame_name(self.code)
+
+def _frame_name(code: CodeType) -> str:
+	return f"{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Sampler:
+
+	def __init__(self, frequency: float = FREQUENCY, capacity: int = CAPACITY, depth: int = DEPTH, threads: Iterable[int] = None):
+		if frequency <= 0 or capacity < 1 or depth < 1:
+			raise ValueError("frequency, capacity and depth have to be positive")
+
+		self.interval = 1.0 / frequency
+		self.depth = depth
+		self.threads = None if threads is None else frozenset(threads) # Idents of the threads to sample, all of them when None
+		self.samples: List[Tuple[int, Stack]] = [None] * capacity      # (thread ident, stack), a ring buffer
+		self.position = 0 # Samples ever taken, the next one goes in at position % capacity
+		self.busy = 0     # Nanoseconds spent taking samples
+		self.elapsed = 0  # Nanoseconds between starting and stopping
+		self.__stopping = Event()
+		self.__thread = None
+		self.__started = 0
+		self.__lines = {}
+
+	def __len__(self): return min(self.position, self.samples.__len__())
+
+	# Samples in the order they were taken
+	def __iter__(self) -> Iterator[Tuple[int, Stack]]:
+		capacity = self.samples.__len__()
+		for position in range(max(0, self.position - capacity), self.position):
+			yield self.samples[position % capacity]
+
+	# Samples lost to the ring buffer wrapping around
+	@property
+	def dropped(self) -> int: return max(0, self.position - self.samples.__len__())
+
+	# Share of the time sampled that the sampler held up the program
+	@property
+	def overhead(self) -> float:
+		elapsed = self.elapsed if self.__thread is None else perf_counter_ns() - self.__started
+		return self.busy / elapsed if elapsed else 0.0
+
+	def __sample(self, own: int):
+		start = perf_counter_ns()
+		depth = self.depth
+		capacity = self.samples.__len__()
+
+		for ident, frame in sys._current_frames().items():
+			if ident == own or (self.threads is not None and ident not in self.threads):
+				continue
+
+			stack = []
+			while frame is not None and stack.__len__() < depth:
+				stack.append((frame.f_code, frame.f_lasti))
+				frame = frame.f_back
+
+			self.samples[self.position % capacity] = (ident, tuple(stack))
+			self.position += 1
+
+		self.busy += perf_counter_ns() - start
+
+	# Sleeps until the next tick is due rather than for a whole interval so the time taken sampling doesn't slow the rate down
+	def __run(self):
+		own = get_ident()
+		interval = int(self.interval * 1e9)
+		due = perf_counter_ns() + interval
+
+		while not self.__stopping.wait(max(0, due - perf_counter_ns()) / 1e9):
+			self.__sample(own)
+			due += interval
+			now = perf_counter_ns()
+			if due < now:
+				due = now + interval # Fell behind, probably waiting on the GIL, skip the ticks that were missed
+
+	def start(self) -> "Sampler":
+		if self.__thread is not None:
+			raise RuntimeError("The sampler is already running")
+
+		self.__stopping.clear()
+		self.__started = perf_counter_ns()
+		self.__thread = Thread(target = self.__run, name = "Sampler", daemon = True)
+		self.__thread.start()
+		return self
+
+	def stop(self):
+		if self.__thread is None:
+			return
+
+		self.__stopping.set()
+		self.__thread.join()
+		self.__thread = None
+		self.elapsed += perf_counter_ns() - self.__started
+
+	def __enter__(self) -> "Sampler":
+		return self.start()
+
+	def __exit__(self, *exception):
+		self.stop()
+
+	def clear(self):
+		self.samples = [None] * self.samples.__len__()
+		self.position = self.busy = self.elapsed = 0
+
+	# Samples per function, the most time spent in it first
+	def functions(self) -> List[FunctionSamples]:
+		own = Counter()
+		total = Counter()
+
+		for _, stack in self:
+			if stack:
+				own[stack[0][0]] += 1
+			total.update({code for code, _ in stack}) # Recursion only counts once
+
+		return sorted((FunctionSamples(code, own[code], count) for code, count in total.items()), key = lambda function: (-function.own, -function.total))
+
+	# Samples at each offset of the code, counting the samples where it was calling something when inclusive
+	def offsets(self, code: CodeType, inclusive: bool = True) -> Counter:
+		counts = Counter()
+
+		for _, stack in self:
+			seen = set()
+			for code_at, offset in (stack if inclusive else stack[:1]):
+				if code_at is code and offset not in seen:
+					seen.add(offset)
+					counts[offset] += 1
+
+		return counts
+
+	# Samples in each node of the code's tree from build_tree, inclusive of what the node called
+	def nodes(self, code: CodeType, tree: Body = None) -> Dict[Union[Code, Body], int]:
+		if tree is None:
+			tree = build_tree(code.co_code)
+
+		counts = self.offsets(code)
+		totals = {}
+
+		def visit(node: Union[Code, Body]) -> int:
+			if isinstance(node, Body):
+				total = sum(visit(child) for child in node.content)
+			elif isinstance(node, Segment):
+				total = sum(counts[instruction.id] for instruction in node)
+			else:
+				total = sum(counts[instruction.id] for instruction in node.conditional) + counts[node.omitted.id]
+				if isinstance(node, Loop):
+					total += visit(node.loop)
+				elif isinstance(node, If):
+					total += visit(node.exec)
+				elif isinstance(node, Branch):
+					total += visit(node.true) + visit(node.false)
+
+			totals[node] = total
+			return total
+
+		visit(tree)
+		return totals
+
+	# The code's tree with the samples of every instruction in front and of every block after its header
+	def lines(self, code: CodeType) -> Iterator[str]:
+		tree = build_tree(code.co_code)
+		counts = self.offsets(code)
+		totals = self.nodes(code, tree)
+		whole = max(totals[tree], 1)
+
+		def instruction(instruction: Instruction, tabs: str) -> str:
+			return f"{counts[instruction.id]:>8} {counts[instruction.id] / whole:>7.1%}  {tabs}{instruction!r}"
+
+		def header(tabs: str, text: str, node: Union[Code, Body]) -> str:
+			return f"{'':>8} {'':>7}  {tabs}{text}  [{totals[node]} samples, {totals[node] / whole:.1%}]"
+
+		def walk(body: Body, indent: int) -> Iterator[str]:
+			tabs = "\t" * indent
+
+			for node in body.content:
+				if isinstance(node, Segment):
+					for each in node:
+						yield instruction(each, tabs)
+					continue
+
+				yield header(tabs, "Conditional->", node)
+				for each in node.conditional:
+					yield instruction(each, tabs + "\t")
+
+				if isinstance(node, Loop):
+					yield instruction(node.omitted, tabs) + f"  [{'While' if node.omitted.opcode != 93 else 'Loop'}: {totals[node.loop]} samples]" # FOR_ITER
+					yield from walk(node.loop, indent + 1)
+					continue
+
+				yield instruction(node.omitted, tabs + "\t")
+
+				if isinstance(node, If):
+					yield header(tabs, f"If {'True' if node.if_true else 'False'}->", node.exec)
+					yield from walk(node.exec, indent + 1)
+				elif isinstance(node, Branch):
+					arms = (("True", node.true), ("False", node.false))
+					for name, arm in (arms if node.true_first else reversed(arms)):
+						yield header(tabs, f"{name} Branch->", arm)
+						yield from walk(arm, indent + 1)
+
+		yield f"{_frame_name(code)}: {totals[tree]} samples"
+		yield from walk(tree, 0)
+
+	def display(self, code: CodeType) -> str:
+		return "\n".join(self.lines(code))
+
+	# Table of the functions seen the most, by the samples with them running
+	def summary(self, count: int = 20) -> str:
+		samples = max(self.__len__(), 1)
+		rows = [f"{'Own':>8} {'Own %':>7} {'Total':>8} {'Total %':>7}  Function"]
+		rows.extend(f"{function.own:>8} {function.own / samples:>7.1%} {function.total:>8} {function.total / samples:>7.1%}  {function.name}" for function in self.functions()[:count])
+		rows.append(f"{self.__len__()} samples, {self.dropped} dropped, {self.overhead:.2%} overhead")
+		return "\n".join(rows)
+
+	def __line(self, code: CodeType, offset: int) -> int:
+		if code not in self.__lines:
+			starts = list(findlinestarts(code))
+			self.__lines[code] = ([start for start, _ in starts], [line for _, line in starts])
+
+		offsets, lines = self.__lines[code]
+		index = bisect_right(offsets, offset) - 1
+		return lines[index] if index >= 0 else code.co_firstlineno
+
+	# Stacks in the collapsed format flamegraph.pl and speedscope read, "outer;inner count" with the outermost frame first
+	# With lines every frame is split up by the line it was on
+	def collapsed(self, lines: bool = False) -> Iterator[str]:
+		stacks = Counter()
+
+		for _, stack in self:
+			if lines:
+				frames = (f"{code.co_name} ({path.basename(code.co_filename)}:{self.__line(code, offset)})" for code, offset in reversed(stack))
+			else:
+				frames = (_frame_name(code) for code, _ in reversed(stack))
+			stacks[";".join(frame.replace(";", ":") for frame in frames)] += 1
+
+		for stack, count in stacks.most_common():
+			yield f"{stack} {count}"
+
+	def write_collapsed(self, file: TextIO, lines: bool = False):
+		for line in self.collapsed(lines):
+			file.write(line)
+			file.write("\n")
@@ -1,13 +1,19 @@
+from array import array
+from bisect import bisect_left
 from dataclasses import dataclass
-from typing import List, Any
+from typing import Any, Iterator, List, Sequence, TextIO, Tuple, Union
 from types import CodeType
 from opcode import opname
 
-@dataclass(eq = False)
+from wordcode import CACHE, decode
+
 class Instruction:
-	opcode: int
-	oparg: int
-	id: int = -1
+	__slots__ = ("opcode", "oparg", "id")
+
+	def __init__(self, opcode: int, oparg: int, id: int = -1):
+		self.opcode = opcode
+		self.oparg = oparg
+		self.id = id
 
 	def __repr__(self):
 		if self.id == -1:
@@ -15,11 +21,98 @@ class Instruction:
 
 		return f"[{self.id:<3}] {self.opcode:<3} {self.oparg:>2} {opname[self.opcode]}"
 
+# Every instruction of a co_code decoded once, the opcodes are kept as bytes and the arguments
+# as bytes too unless EXTENDED_ARG made some of them wider than a byte
+class InstructionStream:
+	__slots__ = ("codes", "opcodes", "args", "shown")
+
+	def __init__(self, codes: bytes):
+		self.codes = codes
+		self.opcodes, self.args = decode(codes)
+		# Positions of everything but inline caches, None when there aren't any caches so every position is shown
+		self.shown = array("I", (position for position, opcode in enumerate(self.opcodes) if opcode != CACHE)) if CACHE >= 0 and CACHE in self.opcodes else None
+
+	def __len__(self): return self.opcodes.__len__()
+
+	def __getitem__(self, position: int) -> Instruction:
+		return Instruction(self.opcodes[position], self.args[position], position << 1)
+
+	def view(self, start: int, stop: int) -> "InstructionView":
+		return InstructionView(self, start, stop)
+
+# A range of positions in a stream, Instructions are only created when they are read
+# Inline caches are never shown, so they're left out of its length and indexes as well as when it's iterated over
+class InstructionView:
+	__slots__ = ("stream", "start", "stop")
+
+	def __init__(self, stream: InstructionStream, start: int, stop: int):
+		self.stream = stream
+		self.start = start
+		self.stop = stop
+
+	# Indexes into the stream's shown positions of the first instruction in the view and of the first one after it
+	def __bounds(self) -> Tuple[int, int]:
+		shown = self.stream.shown
+		return bisect_left(shown, self.start), bisect_left(shown, max(self.start, self.stop))
+
+	def __len__(self):
+		if self.stream.shown is None:
+			return max(0, self.stop - self.start)
+
+		first, last = self.__bounds()
+		return last - first
+
+	def __getitem__(self, key: Union[int, slice]) -> Union[Instruction, "InstructionView"]:
+		length = self.__len__()
+
+		if isinstance(key, slice):
+			start, stop, step = key.indices(length)
+			if step != 1:
+				raise ValueError("Views can only be sliced contiguously")
+
+			stop = max(start, stop)
+			if self.stream.shown is None:
+				return InstructionView(self.stream, self.start + start, self.start + stop)
+
+			# Caches after the last instruction taken stay with it
+			first = self.__bounds()[0]
+			shown = self.stream.shown
+			return InstructionView(self.stream, shown[first + start] if start < length else self.stop, shown[first + stop] if stop < length else self.stop)
+
+		if key < 0:
+			key += length
+
+		if key < 0 or key >= length:
+			raise IndexError("Instruction view index out of range")
+
+		if self.stream.shown is None:
+			return self.stream[self.start + key]
+		return self.stream[self.stream.shown[self.__bounds()[0] + key]]
+
+	def __iter__(self):
+		stream = self.stream
+		if stream.shown is None:
+			for position in range(self.start, self.stop):
+				yield stream[position]
+		else:
+			first, last = self.__bounds()
+			for position in stream.shown[first:last]:
+				yield stream[position]
+
 @dataclass(eq = False, init = False)
 class Code:
 
+	def lines(self, indent: int = 0) -> Iterator[str]:
+		raise NotImplementedError("All subclasses must implement lines([indent: int = 0])")
+
 	def display(self, indent: int = 0) -> str:
-		raise NotImplementedError("All subclasses must implement display([indent: int = 0])")
+		return "\n".join(self.lines(indent))
+
+	# Streams the display to a file one line at a time
+	def write(self, file: TextIO, indent: int = 0):
+		for line in self.lines(indent):
+			file.write(line)
+			file.write("\n")
 
 	def __str__(self) -> str:
 		return self.display()
@@ -31,31 +124,34 @@ class Code:
 class Body:
 	content: List[Code]
 
-	def display(self, indent: int = 0) -> str:
+	def lines(self, indent: int = 0) -> Iterator[str]:
 		if not self.content.__len__():
-			return "\t" * indent + "Empty Body"
+			yield "\t" * indent + "Empty Body"
+			return
 
-		output = ""
 		for code in self.content:
-			output += f"{code.display(indent)}\n"
+			yield from code.lines(indent)
 
-		return output.rstrip("\n")
+	display = Code.display
+	write = Code.write
 
 @dataclass(eq = False)
 class Segment(Code):
-	instructions: List[Instruction]
+	instructions: Sequence[Instruction] # Either a list or an InstructionView
 
 	def __len__(self): return self.instructions.__len__()
 
-	def display(self, indent: int = 0) -> str:
+	def __iter__(self): return self.instructions.__iter__()
+
+	def lines(self, indent: int = 0) -> Iterator[str]:
+		tabs = "\t" * indent
+
 		if not self.instructions.__len__():
-			return "\t" * indent + "Empty Segment"
+			yield tabs + "Empty Segment"
+			return
 
-		output = ""
 		for instruction in self.instructions:
-			output += "\t" * indent + f"{instruction}\n"
-
-		return output.rstrip("\n")
+			yield tabs + instruction.__repr__()
 
 @dataclass(eq = False)
 class Branch(Code):
@@ -67,20 +163,23 @@ class Branch(Code):
 
 	def __len__(self): return self.conditional.__len__() + self.true.__len__() + self.false.__len__() + 1
 
-	def display(self, indent: int = 0):
-		output = "\t" * indent + "Conditional->\n"
+	def lines(self, indent: int = 0) -> Iterator[str]:
+		tabs = "\t" * indent
 
-		output += self.conditional.display(indent + 1) + "\n"
-		output += "\t" * (indent + 1) + self.omitted.__repr__() + "\n"
+		yield tabs + "Conditional->"
+		yield from self.conditional.lines(indent + 1)
+		yield tabs + "\t" + self.omitted.__repr__()
 
 		if self.true_first:
-			output += "\t" * indent + f"True Branch->\n{self.true.display(indent + 1)}\n"
-			output += "\t" * indent + f"False Branch->\n{self.false.display(indent + 1)}\n"
+			yield tabs + "True Branch->"
+			yield from self.true.lines(indent + 1)
+			yield tabs + "False Branch->"
+			yield from self.false.lines(indent + 1)
 		else:
-			output += "\t" * indent + f"False Branch->\n{self.false.display(indent + 1)}\n"
-			output += "\t" * indent + f"True Branch->\n{self.true.display(indent + 1)}\n"
-
-		return output.rstrip("\n")
+			yield tabs + "False Branch->"
+			yield from self.false.lines(indent + 1)
+			yield tabs + "True Branch->"
+			yield from self.true.lines(indent + 1)
 
 @dataclass(eq = False)
 class If(Code):
@@ -91,11 +190,14 @@ class If(Code):
 
 	def __len__(self): return self.conditional.__len__() + self.exec.__len__() + 1
 
-	def display(self, indent: int = 0):
-		return "\t" * indent + "Conditional->\n" + \
-			self.conditional.display(indent + 1) + "\n" + \
-			"\t" * (indent + 1) + self.omitted.__repr__() + "\n" + \
-			"\t" * indent + f"If {'True' if self.if_true else 'False'}->\n" + self.exec.display(indent + 1)
+	def lines(self, indent: int = 0) -> Iterator[str]:
+		tabs = "\t" * indent
+
+		yield tabs + "Conditional->"
+		yield from self.conditional.lines(indent + 1)
+		yield tabs + "\t" + self.omitted.__repr__()
+		yield tabs + f"If {'True' if self.if_true else 'False'}->"
+		yield from self.exec.lines(indent + 1)
 
 @dataclass(eq = False)
 class Loop(Code):
@@ -105,31 +207,50 @@ class Loop(Code):
 
 	def __len__(self): return self.conditional.__len__() + self.loop.__len__() + self.omitted is not None
 
-@dataclass(eq = False)
-class For(Loop):
+	def _loop_lines(self, indent: int, name: str) -> Iterator[str]:
+		tabs = "\t" * indent
 
-	def display(self, indent: int = 0):
-		output = "\t" * indent + "Conditional->\n"
+		yield tabs + "Conditional->"
 		for instruction in self.conditional:
-			output += "\t" * (indent + 1) + instruction.__repr__() + "\n"
+			yield tabs + "\t" + instruction.__repr__()
 
-		output += "\t" * indent + f"Loop->\t{self.omitted}\n"
-		output += f"{self.loop.display(indent + 1)}\n"
-
-		return output.rstrip("\n")
+		yield tabs + f"{name}->\t{self.omitted}"
+		yield from self.loop.lines(indent + 1)
 
 @dataclass(eq = False)
-class While(Loop):
+class For(Loop):
 
-	def display(self, indent: int = 0):
-		output = "\t" * indent + "Conditional->\n"
-		for instruction in self.conditional:
-			output += "\t" * (indent + 1) + instruction.__repr__() + "\n"
+	def lines(self, indent: int = 0) -> Iterator[str]:
+		return self._loop_lines(indent, "Loop")
 
-		output += "\t" * indent + f"While->\t{self.omitted}\n"
-		output += f"{self.loop.display(indent + 1)}\n"
+@dataclass(eq = False)
+class While(Loop):
 
-		return output.rstrip("\n")
+	def lines(self, indent: int = 0) -> Iterator[str]:
+		return self._loop_lines(indent, "While")
+
+# Every instruction of a node in the order they're laid out in, omitted ones included
+def instructions_in(node: Union[Code, Body, Instruction]) -> Iterator[Instruction]:
+	if isinstance(node, Instruction):
+		yield node
+	elif isinstance(node, Body):
+		for code in node.content:
+			yield from instructions_in(code)
+	elif isinstance(node, Segment):
+		yield from node
+	elif isinstance(node, Loop):
+		yield from node.conditional
+		yield node.omitted
+		yield from instructions_in(node.loop)
+	elif isinstance(node, If):
+		yield from node.conditional
+		yield node.omitted
+		yield from instructions_in(node.exec)
+	elif isinstance(node, Branch):
+		yield from node.conditional
+		yield node.omitted
+		yield from instructions_in(node.true if node.true_first else node.false)
+		yield from instructions_in(node.false if node.true_first else node.true)
 
 @dataclass(eq = False)
 class Function:
@@ -0,0 +1,91 @@
+from array import array
+from itertools import compress
+from operator import and_, mul
+from typing import Sequence, Tuple, Union
+
+# NumPy is optional, without it every operation runs through C level builtins over array('d')
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+Buffer = Union[array, "numpy.ndarray"]
+
+# Preallocated buffer of size zeroed doubles for timing samples to be written into
+def buffer(size: int) -> Buffer:
+	if numpy is not None:
+		return numpy.zeros(size)
+	return array("d", bytes(8 * size))
+
+# Buffer holding values, shared with them when they already are one
+def as_buffer(values: Sequence[float]) -> Buffer:
+	if numpy is not None:
+		if isinstance(values, array):
+			return numpy.frombuffer(values, dtype = numpy.float64)
+		return numpy.asarray(values, dtype = numpy.float64)
+
+	if isinstance(values, array) and values.typecode == "d":
+		return values
+	return array("d", values)
+
+# Values as an array('d') for sending between processes
+def to_array(values: Buffer) -> array:
+	if isinstance(values, array):
+		return values
+	return array("d", numpy.ascontiguousarray(values, dtype = numpy.float64).tobytes())
+
+def scale(values: Buffer, factor: float) -> Buffer:
+	if numpy is not None:
+		return values * factor
+	return array("d", map(float(factor).__mul__, values))
+
+def ordered(values: Buffer) -> Buffer:
+	if numpy is not None:
+		return numpy.sort(values)
+	return array("d", sorted(values))
+
+def mean(values: Buffer) -> float:
+	if numpy is not None:
+		return float(numpy.mean(values))
+	return sum(values) / values.__len__()
+
+# Population standard deviation
+def deviation(values: Buffer, average: float = None) -> float:
+	if average is None:
+		average = mean(values)
+
+	if numpy is not None:
+		return float(numpy.sqrt(numpy.mean(numpy.square(values - average))))
+
+	# Shifting by the average first keeps the squares from losing precision
+	shifted = array("d", map(float(-average).__add__, values))
+	return (sum(map(mul, shifted, shifted)) / values.__len__()) ** 0.5
+
+# Values strictly between low and high
+def within(values: Buffer, low: float, high: float) -> Buffer:
+	if numpy is not None:
+		return values[(values > low) & (values < high)]
+	low, high = float(low), float(high) # An int's comparisons give NotImplemented for floats
+	return array("d", compress(values, map(and_, map(low.__lt__, values), map(high.__gt__, values))))
+
+# Remove large deviations from data, anything a standard deviation or more from the mean
+def refine(values: Buffer) -> Buffer:
+	average = mean(values)
+	spread = deviation(values, average)
+	return within(values, average - spread, average + spread)
+
+def count_below(values: Buffer, bound: float) -> int:
+	if numpy is not None:
+		return int(numpy.count_nonzero(values < bound))
+	return sum(map(float(bound).__gt__, values))
+
+def count_above(values: Buffer, bound: float) -> int:
+	if numpy is not None:
+		return int(numpy.count_nonzero(values > bound))
+	return sum(map(float(bound).__lt__, values))
+
+# Smallest and largest value
+def extremes(values: Buffer) -> Tuple[float, float]:
+	if numpy is not None:
+		return float(numpy.min(values)), float(numpy.max(values))
+	return min(values), max(values)
@@ -0,0 +1,132 @@
+from opcode import EXTENDED_ARG, hasconst, hasfree, haslocal, hasname, opmap, opname
+from types import CodeType
+from typing import Dict, Tuple
+
+from decompiler import stack_effect_of
+from flow import build_graph
+from wordcode import VERSION, JumpKinds, Terminators, exception_table, instructions, jump_target, name_index
+
+"""
+Checks that rewritten code can run before it takes the place of the original
+
+The stack is simulated over the control flow graph with the same stack effects that find_n_values_on_stack uses
+Every block has to be reached with the same number of values on the stack no matter which way it's reached from,
+the stack can never go below empty and no path can run past the last instruction
+On 3.11 every instruction covered by co_exceptiontable also reaches its handler, with the depth the table gives
+"""
+
+# Before 3.9 a finally block is a subroutine run by CALL_FINALLY and by an exception with different values under it
+# Those blocks keep the deepest stack they're reached with, the same as the compiler does
+_SUBROUTINES = "CALL_FINALLY" in opmap
+
+# A 3.10 generator is started with the value first sent to it on the stack, which its GEN_START pops
+# On 3.11 it's resumed after its RETURN_GENERATOR with that value, which the POP_TOP after it pops
+_GEN_START = opmap.get("GEN_START", -1)
+_RETURN_GENERATOR = opmap.get("RETURN_GENERATOR", -1)
+
+# (opcode, argument, offset of the opcode itself) of every instruction, keyed by the offset its EXTENDED_ARG prefixes start at
+def _program(codes: bytes) -> Dict[int, Tuple[int, int, int]]:
+	program = {}
+
+	for offset, opcode, arg in instructions(codes):
+		position = offset
+		while codes[position] == EXTENDED_ARG:
+			position += 2
+		program[offset] = (opcode, arg, position)
+
+	return program
+
+# Number of values on the stack when each reachable block starts, keyed by the block's offset
+# Along with the most values the stack ever holds
+def block_depths(code: CodeType) -> Tuple[Dict[int, int], int]:
+	codes = code.co_code
+	table = exception_table(code)
+	graph = build_graph(codes, [handler for _, _, handler, _, _ in table])
+	program = _program(codes)
+
+	# Offset of each instruction covered by the table -> (handler, values on the stack when it's reached)
+	handlers = {}
+	for start, stop, handler, depth, lasti in table:
+		for offset in range(start, stop, 2):
+			handlers[offset] = (handler, depth + lasti + 1)
+	depths = {0: int(codes.__len__() > 0 and codes[0] == _GEN_START)}
+	work = [0]
+	maximum = depths[0]
+
+	def reach(target: int, depth: int, source: int):
+		if depth < 0:
+			raise ValueError(f"{code.co_name} pops more values than are on the stack reaching {target} from {source}")
+		if target not in graph.block_at:
+			raise ValueError(f"{code.co_name} jumps to {target} from {source} which isn't the start of an instruction")
+
+		if target not in depths or (_SUBROUTINES and depth > depths[target]):
+			depths[target] = depth
+			work.append(target)
+		elif depths[target] != depth and not _SUBROUTINES:
+			raise ValueError(f"{code.co_name} reaches {target} with both {depths[target]} and {depth} values on the stack")
+
+	while work:
+		block = graph.block_at[work.pop()]
+		depth = depths[block.start]
+		opcode = None
+
+		for offset in range(block.start, block.stop, 2):
+			if offset not in program:
+				continue # EXTENDED_ARG prefixes and inline caches
+
+			opcode, arg, position = program[offset]
+			if opname[opcode].startswith("<"):
+				raise ValueError(f"{code.co_name} has an unknown opcode {opcode} at {offset}")
+
+			if position in handlers:
+				handler, caught = handlers[position]
+				reach(handler, caught, offset)
+				maximum = max(maximum, caught)
+
+			if JumpKinds[opcode]:
+				target = jump_target(opcode, arg, position)
+				jumped = depth + stack_effect_of(opcode, arg, True)
+				reach(target, jumped, offset)
+				maximum = max(maximum, jumped)
+
+			depth += stack_effect_of(opcode, arg) + (opcode == _RETURN_GENERATOR)
+			if depth < 0:
+				raise ValueError(f"{opname[opcode]} at {offset} in {code.co_name} pops more values than are on the stack")
+			maximum = max(maximum, depth)
+
+		if opcode is not None and opcode not in Terminators:
+			if block.stop >= codes.__len__():
+				raise ValueError(f"{code.co_name} runs off the end of its code")
+			reach(block.stop, depth, block.stop - 2)
+
+	return depths, maximum
+
+# Fewest stack slots the code can run with
+def stack_size(code: CodeType) -> int:
+	return block_depths(code)[1]
+
+# Raises a ValueError when the code couldn't run, checked before it takes the place of a function's code
+def verify_code(code: CodeType):
+	program = _program(code.co_code)
+	free = code.co_cellvars.__len__() + code.co_freevars.__len__()
+	if VERSION >= (3, 11): # Cells are numbered on from the locals, a cell that's also an argument keeps the argument's slot
+		free = code.co_nlocals + sum(1 for name in code.co_cellvars if name not in code.co_varnames) + code.co_freevars.__len__()
+
+	if not program:
+		raise ValueError(f"{code.co_name} has no instructions")
+	if code.co_nlocals != code.co_varnames.__len__():
+		raise ValueError(f"{code.co_name} has {code.co_nlocals} locals but {code.co_varnames.__len__()} names for them")
+
+	for offset, (opcode, arg, _) in program.items():
+		if opcode in hasconst and arg >= code.co_consts.__len__():
+			raise ValueError(f"{opname[opcode]} at {offset} loads constant {arg} of {code.co_consts.__len__()}")
+		if opcode in haslocal and arg >= code.co_nlocals:
+			raise ValueError(f"{opname[opcode]} at {offset} uses local {arg} of {code.co_nlocals}")
+		if opcode in hasname and name_index(opcode, arg) >= code.co_names.__len__():
+			raise ValueError(f"{opname[opcode]} at {offset} uses name {arg} of {code.co_names.__len__()}")
+		if opcode in hasfree and arg >= free:
+			raise ValueError(f"{opname[opcode]} at {offset} uses cell {arg} of {free}")
+
+	needed = stack_size(code)
+	if code.co_stacksize < needed:
+		raise ValueError(f"{code.co_name} needs {needed} stack slots but only has {code.co_stacksize}")
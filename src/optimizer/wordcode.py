@@ -0,0 +1,280 @@
+from array import array
+from opcode import opname, opmap, hasjabs, hasjrel, EXTENDED_ARG
+from typing import Iterable, Iterator, List, Sequence, Tuple, Union
+import opcode
+import sys
+
+"""
+Decoding and encoding of co_code for the running interpreter
+
+	3.6 - 3.9  Jump arguments are byte offsets
+	3.10       Jump arguments count instructions (2 bytes each)
+	3.11+      Instructions are followed by inline CACHE entries and relative jumps can go backwards
+
+Arguments larger than a byte are built by EXTENDED_ARG prefixes, each adding another 8 bits
+"""
+
+VERSION = sys.version_info[:2]
+
+# Bytes per unit of a jump argument
+JUMP_UNIT = 2 if VERSION >= (3, 10) else 1
+
+CACHE = opmap.get("CACHE", -1)
+
+# Number of CACHE entries following each opcode
+InlineCaches = bytearray(256)
+
+_inline_cache_entries = getattr(opcode, "_inline_cache_entries", None)
+if isinstance(_inline_cache_entries, dict):
+	for name, entries in _inline_cache_entries.items():
+		if opmap.get(name, 256) < 256:
+			InlineCaches[opmap[name]] = entries
+elif _inline_cache_entries is not None:
+	for code, entries in enumerate(_inline_cache_entries[:256]):
+		InlineCaches[code] = entries
+del _inline_cache_entries
+
+# How each opcode's argument turns into a jump target
+NOT_JUMP, ABSOLUTE, FORWARD, BACKWARD = range(4)
+
+JumpKinds = bytearray(256)
+for code in hasjabs:
+	JumpKinds[code] = ABSOLUTE
+for code in hasjrel:
+	JumpKinds[code] = BACKWARD if "JUMP_BACKWARD" in opname[code] else FORWARD
+del code
+
+# Jump going the other way for the relative jumps that have one, what a jump is turned into when it's laid out pointing the wrong way
+# Relative jumps only go forwards before 3.11, where JUMP_FORWARD goes back as a JUMP_ABSOLUTE
+Turned = {}
+for code, kind in enumerate(JumpKinds):
+	if kind == FORWARD or kind == BACKWARD:
+		other = opname[code].replace("FORWARD", "BACKWARD") if kind == FORWARD else opname[code].replace("BACKWARD", "FORWARD")
+		if other != opname[code] and opmap.get(other, 256) < 256:
+			Turned[code] = opmap[other]
+if "JUMP_ABSOLUTE" in opmap:
+	Turned[opmap["JUMP_FORWARD"]] = opmap["JUMP_ABSOLUTE"]
+del code, kind
+
+def _named(*names: str) -> frozenset:
+	return frozenset(opmap[name] for name in names if opmap.get(name, 256) < 256)
+
+# Opcodes grouped by what they do so analysis doesn't depend on a version's numbering
+ConditionalJumps = frozenset(code for name, code in opmap.items() if code < 256 and name.startswith("POP_JUMP_"))
+TrueJumps = frozenset(code for code in ConditionalJumps if opname[code].endswith(("IF_TRUE", "IF_NOT_NONE"))) # Jump taken when the test passes
+LoopJumps = _named("JUMP_ABSOLUTE", "JUMP_BACKWARD", "JUMP_BACKWARD_NO_INTERRUPT")
+ForwardJumps = _named("JUMP_FORWARD")
+Returns = _named("RETURN_VALUE", "RETURN_CONST")
+Raises = _named("RAISE_VARARGS", "RERAISE")
+UnconditionalJumps = LoopJumps | ForwardJumps
+Terminators = UnconditionalJumps | Returns | Raises
+
+# Byte offset that an instruction at offset jumps to, -1 if it doesn't jump
+def jump_target(code: int, arg: int, offset: int) -> int:
+	kind = JumpKinds[code]
+
+	if kind == NOT_JUMP:
+		return -1
+	if kind == ABSOLUTE:
+		return arg * JUMP_UNIT
+
+	after = offset + 2 + 2 * InlineCaches[code]
+	return after + arg * JUMP_UNIT if kind == FORWARD else after - arg * JUMP_UNIT
+
+# Argument needed to jump from the instruction at offset to target
+def jump_argument(code: int, target: int, offset: int) -> int:
+	kind = JumpKinds[code]
+
+	if kind == ABSOLUTE:
+		return target // JUMP_UNIT
+
+	after = offset + 2 + 2 * InlineCaches[code]
+	return (target - after if kind == FORWARD else after - target) // JUMP_UNIT
+
+# Splits co_code into the opcode and full argument of each 2 byte unit
+# EXTENDED_ARG units stay in place so position * 2 is always the offset
+def decode(codes: bytes) -> Tuple[bytes, Union[bytes, array]]:
+	opcodes = codes[::2]
+	position = opcodes.find(EXTENDED_ARG)
+
+	if position == -1:
+		return opcodes, codes[1::2] # Every argument fits in its byte
+
+	args = array("I")
+	args.extend(codes[1::2])
+
+	while position != -1:
+		if position + 1 < args.__len__():
+			args[position + 1] |= (args[position] << 8) & 0xFFFFFFFF
+		position = opcodes.find(EXTENDED_ARG, position + 1)
+
+	return opcodes, args
+
+# (offset, opcode, argument) of every real instruction, skipping prefixes and inline caches
+def instructions(codes: bytes) -> Iterator[Tuple[int, int, int]]:
+	opcodes, args = decode(codes)
+	position = 0
+	length = opcodes.__len__()
+
+	while position < length:
+		code = opcodes[position]
+
+		if code == EXTENDED_ARG or code == CACHE:
+			position += 1
+			continue
+
+		# Offset of a prefixed instruction is that of its first EXTENDED_ARG
+		start = position
+		while start > 0 and opcodes[start - 1] == EXTENDED_ARG:
+			start -= 1
+
+		yield start << 1, code, args[position]
+		position += 1 + InlineCaches[code]
+
+# Number of code units an instruction takes up, including its prefixes and caches
+def instruction_size(code: int, arg: int) -> int:
+	size = 1
+	while arg > 0xFF:
+		arg >>= 8
+		size += 1
+
+	return size + InlineCaches[code]
+
+# Turns (opcode, argument) pairs back into co_code with EXTENDED_ARG prefixes and empty caches
+# sizes can give instructions more prefixes than their argument needs, the extra ones hold 0
+def encode(pairs: Iterable[Tuple[int, int]], sizes: Sequence[int] = None) -> bytes:
+	output = bytearray()
+
+	for i, (code, arg) in enumerate(pairs):
+		if arg < 0:
+			arg = 0
+
+		prefixes = instruction_size(code, arg) - 1 - InlineCaches[code]
+		if sizes is not None:
+			prefixes = max(prefixes, sizes[i] - 1 - InlineCaches[code])
+
+		for shift in range(8 * prefixes, 0, -8):
+			output.append(EXTENDED_ARG)
+			output.append((arg >> shift) & 0xFF)
+
+		output.append(code)
+		output.append(arg & 0xFF)
+
+		if InlineCaches[code]:
+			output += bytes(2 * InlineCaches[code])
+
+	return bytes(output)
+
+# Some arguments keep flags in their low bits on newer versions
+NameShifts = bytearray(256)
+if VERSION >= (3, 11):
+	NameShifts[opmap["LOAD_GLOBAL"]] = 1
+if VERSION >= (3, 12):
+	NameShifts[opmap["LOAD_ATTR"]] = 1
+	NameShifts[opmap["LOAD_SUPER_ATTR"]] = 2
+
+# Index into co_names used by an instruction
+def name_index(code: int, arg: int) -> int:
+	return arg >> NameShifts[code]
+
+# Full argument of the instruction at index, without decoding the rest of co_code
+def argument_at(codes: bytes, index: int) -> int:
+	arg = codes[index + 1]
+	shift = 8
+	index -= 2
+
+	while index >= 0 and codes[index] == EXTENDED_ARG:
+		arg |= codes[index + 1] << shift
+		shift += 8
+		index -= 2
+
+	return arg
+
+# (start, stop, handler, depth, lasti) of every range of co_exceptiontable, the offsets are in bytes with stop after the last instruction covered
+# An exception raised in the range pops the stack down to depth, pushes the offset it was raised at when lasti is set and then the exception
+# Before 3.11 handlers are set up by SETUP_* instructions instead and there are none
+def exception_table(code) -> List[Tuple[int, int, int, int, bool]]:
+	table = getattr(code, "co_exceptiontable", b"")
+	entries = []
+	position = 0
+
+	# Numbers are written 6 bits at a time with the most significant first, 64 set when more follow, 128 marks the start of an entry
+	def number() -> int:
+		nonlocal position
+		value = table[position] & 63
+		while table[position] & 64:
+			position += 1
+			value = (value << 6) | (table[position] & 63)
+		position += 1
+		return value
+
+	while position < table.__len__():
+		start = number() << 1
+		stop = start + (number() << 1)
+		handler = number() << 1
+		depth_lasti = number()
+		entries.append((start, stop, handler, depth_lasti >> 1, bool(depth_lasti & 1)))
+
+	return entries
+
+# Name of the code attribute holding the line table written by encode_lines
+LINE_TABLE = "co_lnotab" if VERSION < (3, 10) else "co_linetable"
+
+# Line table of code length bytes long from the (offset, line) of each instruction that starts a new line
+#	3.6 - 3.9  co_lnotab, pairs of bytes added to the offset and the line from where the last line started
+#	3.10       co_linetable, pairs of bytes covered by a line and the change to the line, -128 covering bytes without a line
+def encode_lines(first_line: int, starts: Iterable[Tuple[int, int]], length: int) -> bytes:
+	if VERSION >= (3, 11):
+		raise NotImplementedError("Line tables with column positions can't be written yet")
+
+	output = bytearray()
+	previous_offset, previous_line = 0, first_line
+
+	if VERSION < (3, 10):
+		for offset, line in starts:
+			if line == previous_line:
+				continue
+
+			step, change = offset - previous_offset, line - previous_line
+			while step > 255:
+				output += bytes((255, 0))
+				step -= 255
+			while change > 127 or change < -128:
+				part = 127 if change > 0 else -128
+				output += bytes((step, part & 0xFF))
+				step, change = 0, change - part
+
+			output += bytes((step, change & 0xFF))
+			previous_offset, previous_line = offset, line
+
+		return bytes(output)
+
+	# Bytes covered by each line, None for bytes that aren't on any line
+	ranges = []
+	position, current = 0, None
+	for offset, line in starts:
+		if line == current:
+			continue
+		if offset > position:
+			ranges.append((offset - position, current))
+		position, current = offset, line
+	if length > position:
+		ranges.append((length - position, current))
+
+	for step, line in ranges:
+		if line is None:
+			change = -128
+		else:
+			change, previous_line = line - previous_line, line
+			while change > 127 or change < -127:
+				part = 127 if change > 0 else -127
+				output += bytes((0, part & 0xFF))
+				change -= part
+
+		while step > 254:
+			output += bytes((254, change & 0xFF))
+			step -= 254
+			change = -128 if line is None else 0
+		output += bytes((step, change & 0xFF))
+
+	return bytes(output)
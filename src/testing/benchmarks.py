@@ -0,0 +1,450 @@
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from math import exp, log
+from os import path
+from time import perf_counter_ns
+from types import CodeType
+from typing import Dict, List, Tuple
+import builtins
+import json
+import platform
+import sys
+
+sys.path.append(path.join(path.dirname(path.dirname(path.realpath(__file__))), "optimizer"))
+from bytecodes import WRITABLE, Peepholes, available_passes, default_passes, optimize_all
+from profiler import compare, mann_whitney, median
+
+"""
+Benchmarks of the optimizer on functions like the ones it's meant for
+
+Every benchmark is a module that defines its functions and then calls them into result, it's timed as it is and with every
+function in it optimized, and the time the optimizer itself takes is timed too
+Each run is added to a JSON history and checked against the last few runs that passed on the same Python with the same passes,
+a speedup whose confidence interval fell below theirs or an optimizer that got slower by more than the tolerances given fails the run
+Pythons whose bytecode the optimizer can't rewrite are skipped, there'd be nothing optimized to time
+"""
+
+@dataclass(frozen = True)
+class Benchmark:
+	name: str
+	source: str # Module source that leaves what it worked out in result
+
+Corpus = (
+	Benchmark("numeric_loop", """
+def numeric_loop(n):
+	total = 0
+	seconds = 60 * 60 * 24
+	for i in range(n):
+		total += (i * seconds) % 7 + abs(i - n // 2)
+	return total
+
+result = numeric_loop(2000)
+"""),
+
+	Benchmark("while_counter", """
+def while_counter(n):
+	count = 0
+	steps = 0
+	limit = 2 ** 10
+	while count < n:
+		count += 3
+		if count % limit == 0:
+			steps += 2
+		steps += 1
+	return steps
+
+result = while_counter(6000)
+"""),
+
+	Benchmark("fibonacci_swap", """
+def fibonacci_swap(n):
+	a, b = 0, 1
+	for _ in range(n):
+		a, b = b, a + b
+	return a % 1000003
+
+result = fibonacci_swap(1500)
+"""),
+
+	Benchmark("string_building", """
+def string_building(words):
+	parts = []
+	separator = "-" * 3
+	for word in words:
+		parts.append(word.upper() + separator + str(len(word)))
+	return ",".join(parts)
+
+result = string_building(["alpha", "beta", "gamma", "delta"] * 100)
+"""),
+
+	Benchmark("string_formatting", """
+def string_formatting(n):
+	text = ""
+	for i in range(n):
+		if i % 2:
+			text += f"{i:04d};"
+		else:
+			text += str(i) + ";"
+	return text
+
+result = len(string_formatting(1000))
+"""),
+
+	Benchmark("word_counts", """
+def word_counts(text):
+	counts = {}
+	for word in text.split():
+		word = word.lower()
+		counts[word] = counts.get(word, 0) + 1
+	return sorted(counts.items())
+
+result = word_counts("the quick brown fox jumps over the lazy dog The Dog barks " * 60)
+"""),
+
+	# test_4 of decompiler's __main__, every test is on constants so it folds down to a return
+	Benchmark("constant_conditionals", """
+def test_4():
+	a = 500
+	b = 300
+	if a >= 500:
+		if b >= 800:
+			return 0
+		elif b >= 200:
+			return 1
+		else:
+			return 2
+	elif a >= 300:
+		if b >= 800:
+			return 3
+		elif b >= 200:
+			return 4
+		else:
+			return 5
+	else:
+		if b >= 800:
+			return 6
+		elif b >= 200:
+			return 7
+		else:
+			return 8
+
+def run():
+	total = 0
+	for _ in range(500):
+		total += test_4()
+	return total
+
+result = run()
+"""),
+
+	# test_4 with its values passed in, so the tests are all still made
+	Benchmark("nested_conditionals", """
+def nested_conditionals(a, b):
+	low = 100 + 100
+	high = 400 * 2
+	if a >= 500:
+		if b >= high:
+			return 0
+		elif b >= low:
+			return 1
+		else:
+			return 2
+	elif a >= 300:
+		if b >= high:
+			return 3
+		elif b >= low:
+			return 4
+		else:
+			return 5
+	else:
+		if b >= high:
+			return 6
+		elif b >= low:
+			return 7
+		else:
+			return 8
+
+def run():
+	total = 0
+	for a in range(100, 700, 25):
+		for b in range(100, 900, 25):
+			total += nested_conditionals(a, b)
+	return total
+
+result = run()
+"""),
+
+	# test_12 of decompiler's __main__, an inner function whose tests are on constants
+	Benchmark("closures", """
+def test_12():
+	def test_12_internal():
+		b = 20
+
+		if b > 5:
+			b = 50
+
+		while b > 90:
+			b -= 2
+
+		return b
+
+	a = 60
+	c = 20
+
+	our_b = test_12_internal()
+
+	if a == c or (our_b == 2 and our_b == 3):
+		return 2
+
+def run():
+	hits = 0
+	for _ in range(300):
+		if test_12() is None:
+			hits += 1
+	return hits
+
+result = run()
+"""),
+
+	Benchmark("closure_calls", """
+def closure_calls(n):
+	offset = 7
+
+	def shifted(x):
+		scale = 2 * 3
+		return x * scale + offset
+
+	total = 0
+	for i in range(n):
+		total += shifted(i)
+	return total
+
+result = closure_calls(1500)
+"""),
+
+	Benchmark("invariant_attributes", """
+class Point:
+	def __init__(self, x, y):
+		self.x = x
+		self.y = y
+
+def invariant_attributes(points, origin):
+	total = 0.0
+	for point in points:
+		total += (point.x - origin.x) ** 2 + (point.y - origin.y) ** 2
+	return round(total, 6)
+
+result = invariant_attributes([Point(i, i * 2) for i in range(300)], Point(3, 4))
+"""),
+
+	Benchmark("list_filtering", """
+def list_filtering(values):
+	kept = []
+	for value in values:
+		if value % 3 == 0 and value % 5 != 0:
+			kept.append(value * value)
+		elif isinstance(value, int) and value > 900:
+			kept.append(-value)
+	return sum(kept)
+
+result = list_filtering(list(range(1000)))
+"""),
+
+	Benchmark("generator_builtins", """
+def clamped_lengths(words, limit):
+	for word in words:
+		yield min(len(word), limit) + abs(len(word) - limit)
+
+result = sum(clamped_lengths(["word" * (i % 7) for i in range(1500)], 12))
+"""),
+)
+
+@dataclass
+class Result:
+	optimize_time: float # Nanoseconds the optimizer takes over the whole module, the fastest of its repeats as anything slower is noise
+	optimize_times: List[float] # Every repeat, so later runs can test whether the optimizer really got slower
+	before: float        # Nanoseconds a run of the module takes, the median of the samples
+	after: float
+	speedup: float
+	speedup_low: float   # Confidence interval of the speedup
+	speedup_high: float
+	p_value: float
+	significant: bool
+
+@dataclass
+class Settings:
+	passes: Tuple[str, ...]
+	samples: int = 32
+	repeats: int = 20          # Times the optimizer is timed on each benchmark
+	alpha: float = 0.05
+	max_slowdown: float = 0.05 # Share the speedup can fall by before it's a regression
+	max_growth: float = 0.5    # Share the optimizer's time can grow by before it's a regression
+	min_speedup: float = None  # Any speedup below this fails, whatever the history says
+	baseline_runs: int = 5     # Earlier passing runs the baseline is the median of
+
+def _namespace() -> dict:
+	return {"__builtins__": builtins, "__name__": "__benchmark__"}
+
+def _optimized(module: CodeType, passes: Tuple[str, ...]) -> CodeType:
+	peepholes = [name for name in passes if name in Peepholes]
+	consts = tuple(optimize_all(const, peepholes, "hoist_invariants" in passes, hoist_attributes = "hoist_attributes" in passes) if hasattr(const, "co_code") else const for const in module.co_consts)
+	return module.replace(co_consts = consts)
+
+def _result_of(module: CodeType) -> str:
+	namespace = _namespace()
+	exec(module, namespace) # Unsafe
+	return repr(namespace.get("result"))
+
+def run(benchmark: Benchmark, settings: Settings) -> Result:
+	module = compile(benchmark.source, f"<{benchmark.name}>", "exec")
+
+	times = []
+	for _ in range(settings.repeats):
+		start = perf_counter_ns()
+		optimized = _optimized(module, settings.passes)
+		times.append(perf_counter_ns() - start)
+
+	expected, gotten = _result_of(module), _result_of(optimized)
+	if expected != gotten:
+		raise AssertionError(f"{benchmark.name} gives {gotten} optimized instead of {expected}")
+
+	comparison = compare(module, optimized, settings.samples, alpha = settings.alpha)
+	return Result(min(times), times, comparison.before.median, comparison.after.median, comparison.speedup,
+		comparison.speedups[0], comparison.speedups[1], comparison.p_value, comparison.significant)
+
+def _environment(settings: Settings) -> dict:
+	return {"python": platform.python_version(), "implementation": platform.python_implementation(), "passes": sorted(settings.passes)}
+
+def load_history(filename: str) -> List[dict]:
+	if filename is None or not path.exists(filename):
+		return []
+
+	with open(filename) as file:
+		return json.load(file)["runs"]
+
+def save_history(filename: str, runs: List[dict]):
+	with open(filename, "w") as file:
+		json.dump({"runs": runs}, file, indent = "\t")
+
+# Latest runs that passed on the same Python with the same passes, runs elsewhere aren't comparable
+def baseline(runs: List[dict], settings: Settings) -> List[dict]:
+	environment = _environment(settings)
+	comparable = [earlier for earlier in runs if earlier["passed"] and all(earlier[key] == value for key, value in environment.items())]
+	return comparable[-settings.baseline_runs:] if settings.baseline_runs > 0 else []
+
+# Each benchmark's result over the baseline runs that have it, the median of every number so one lucky or unlucky run can't set it
+# The optimizer's time is counted in runs of the unoptimized module timed alongside it, so a machine that's slower all day doesn't look
+# like a slower optimizer, and the repeats of every baseline run are pooled to test against
+def _baseline_results(base: List[dict]) -> Dict[str, dict]:
+	merged = {}
+
+	for name in {name for earlier in base for name in earlier["results"]}:
+		previous = [earlier["results"][name] for earlier in base if name in earlier["results"]]
+		merged[name] = {key: median([result[key] for result in previous]) for key in ("speedup", "speedup_low", "speedup_high", "optimize_time")}
+		merged[name]["optimize_cost"] = median([result["optimize_time"] / result["before"] for result in previous])
+		merged[name]["optimize_costs"] = [time / result["before"] for result in previous for time in result.get("optimize_times", ())]
+	return merged
+
+# What's got worse than the baseline by more than the settings let it
+# The speedup only counts as fallen when its whole confidence interval is under the baseline's, so noise alone doesn't fail a run,
+# and the optimizer only when its fastest repeat costs more than the tolerance lets it and its repeats are significantly slower than the baseline's
+def regressions(results: Dict[str, Result], base: List[dict], settings: Settings) -> List[str]:
+	problems = []
+	merged = _baseline_results(base)
+
+	for name, result in results.items():
+		if settings.min_speedup is not None and result.speedup < settings.min_speedup:
+			problems.append(f"{name}: speedup {result.speedup:.4f}x is below the minimum of {settings.min_speedup:.4f}x")
+
+		if name not in merged:
+			continue
+
+		previous = merged[name]
+		if result.speedup_high < previous["speedup_low"] * (1 - settings.max_slowdown):
+			problems.append(f"{name}: speedup fell from {previous['speedup']:.4f}x [CI {previous['speedup_low']:.4f}x - {previous['speedup_high']:.4f}x] "
+				f"to {result.speedup:.4f}x [CI {result.speedup_low:.4f}x - {result.speedup_high:.4f}x]")
+
+		cost = result.optimize_time / result.before
+		slower = not previous["optimize_costs"] or mann_whitney([time / result.before for time in result.optimize_times], previous["optimize_costs"]) < settings.alpha
+		if cost > previous["optimize_cost"] * (1 + settings.max_growth) and slower:
+			problems.append(f"{name}: optimizing took {result.optimize_time / 1e6:.3f} ms or {cost:.2f} runs of the module, "
+				f"up from {previous['optimize_time'] / 1e6:.3f} ms or {previous['optimize_cost']:.2f} runs")
+
+	return problems
+
+def main():
+	parser = ArgumentParser(description = "Times the optimizer and the code it makes over a corpus of functions and checks for regressions")
+	parser.add_argument("names", nargs = "*", help = "Benchmarks to run (default: all of them)")
+	parser.add_argument("-p", "--passes", default = None, help = f"Comma separated passes to run out of {', '.join(available_passes())} (default: {', '.join(default_passes())})")
+	parser.add_argument("-o", "--history", default = "benchmarks.json", help = "JSON file the results are added to and compared against (default: benchmarks.json)")
+	parser.add_argument("--samples", type = int, default = 32, help = "Timed samples of each benchmark before and after optimizing (default: 32)")
+	parser.add_argument("--repeats", type = int, default = 20, help = "Times the optimizer is timed on each benchmark (default: 20)")
+	parser.add_argument("--max-slowdown", type = float, default = 0.05, help = "Share a speedup can fall by before it fails (default: 0.05)")
+	parser.add_argument("--max-growth", type = float, default = 0.5, help = "Share the optimizer's time can grow by before it fails (default: 0.5)")
+	parser.add_argument("--min-speedup", type = float, default = None, help = "Fail any benchmark with a lower speedup than this")
+	parser.add_argument("--baseline-runs", type = int, default = 5, help = "Earlier passing runs to take the baseline from (default: 5)")
+	parser.add_argument("--no-save", action = "store_true", help = "Check against the history without adding this run to it")
+	parser.add_argument("--list", action = "store_true", help = "Only print the names of the benchmarks")
+	args = parser.parse_args()
+
+	if args.list:
+		print("\n".join(benchmark.name for benchmark in Corpus))
+		return
+
+	passes = default_passes() if args.passes is None else [name for name in args.passes.split(",") if name]
+	unknown = [name for name in passes if name not in available_passes()]
+	if unknown:
+		parser.error(f"unknown passes: {', '.join(unknown)}")
+
+	benchmarks = [benchmark for benchmark in Corpus if not args.names or benchmark.name in args.names]
+	missing = set(args.names) - {benchmark.name for benchmark in benchmarks}
+	if missing:
+		parser.error(f"unknown benchmarks: {', '.join(sorted(missing))}")
+
+	if not WRITABLE:
+		print(f"Python {platform.python_version()} bytecode can't be optimized, nothing to benchmark")
+		return
+
+	settings = Settings(tuple(passes), args.samples, args.repeats, 0.05, args.max_slowdown, args.max_growth, args.min_speedup, args.baseline_runs)
+	runs = load_history(args.history)
+	base = baseline(runs, settings)
+
+	results = {}
+	failures = []
+	print(f"{'Benchmark':<24} {'Optimize':>10} {'Before':>10} {'After':>10} {'Speedup':>9}  95% CI")
+
+	for benchmark in benchmarks:
+		try:
+			result = results[benchmark.name] = run(benchmark, settings)
+		except Exception as e:
+			failures.append(f"{benchmark.name}: {type(e).__name__}: {e}")
+			continue
+
+		print(f"{benchmark.name:<24} {result.optimize_time / 1e6:>7.3f} ms {result.before / 1e3:>7.2f} us {result.after / 1e3:>7.2f} us "
+			f"{result.speedup:>8.4f}x  {result.speedup_low:.4f}x - {result.speedup_high:.4f}x{'' if result.significant else ' (not significant)'}")
+
+	if results:
+		mean = exp(sum(log(result.speedup) for result in results.values()) / results.__len__())
+		print(f"Speedup: {mean:.4f}x geometric mean over {results.__len__()} benchmarks")
+
+	failures.extend(regressions(results, base, settings))
+	if not base:
+		print("No earlier run to compare against")
+	elif base.__len__() == 1:
+		print(f"Compared against the run of {base[0]['date']}")
+	else:
+		print(f"Compared against the median of {base.__len__()} runs from {base[0]['date']} to {base[-1]['date']}")
+
+	for failure in failures:
+		print(f"Regression: {failure}")
+
+	if not args.no_save:
+		runs.append(dict(_environment(settings), date = datetime.now(timezone.utc).isoformat(timespec = "seconds"), passed = not failures,
+			settings = {"samples": settings.samples, "repeats": settings.repeats}, results = {name: asdict(result) for name, result in results.items()}))
+		save_history(args.history, runs)
+
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()
@@ -1,11 +1,34 @@
-from opcode import opname
-from types import CodeType
+from bisect import bisect_left
+from hashlib import sha256
+from importlib.abc import MetaPathFinder
+from importlib.machinery import PathFinder, SourceFileLoader
+from importlib.util import MAGIC_NUMBER, cache_from_source
+from marshal import dumps, loads
+from collections import deque
+from dis import findlinestarts
+from opcode import cmp_op, opmap, opname
+from operator import add, eq, floordiv, ge, getitem, gt, iadd, ifloordiv, ilshift, imod, imul, ipow, irshift, is_, is_not, isub, itruediv, le, lshift, lt, mod, mul, ne, neg, not_, pos, pow, rshift, sub, truediv
+from inspect import CO_ASYNC_GENERATOR, CO_COROUTINE, CO_GENERATOR, CO_ITERABLE_COROUTINE, CO_OPTIMIZED, CO_VARARGS, CO_VARKEYWORDS
+from types import CodeType, FunctionType
 from time import process_time
-from os import devnull
-from typing import Tuple
+from os import cpu_count, devnull, path
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Tuple
 from quantiphy import Quantity
+from warnings import warn
+import builtins
 import sys
 
+sys.path.append(path.join(path.dirname(path.dirname(path.realpath(__file__))), "optimizer"))
+from wordcode import BACKWARD, EXTENDED_ARG, VERSION, FORWARD, LINE_TABLE, InlineCaches, JumpKinds, NameShifts, Terminators, Turned, UnconditionalJumps, decode, encode, encode_lines, instruction_size, instructions, jump_argument, jump_target, name_index
+from runner import run_benchmarks
+from timings import buffer, count_above, count_below, extremes, mean, refine, scale
+from decompiler import build_tree
+from structures import Body, Branch, For, If, Loop, Segment
+from cache import code_key
+from verifier import stack_size, verify_code
+from pgo import CodeProfile, Profile
+import cache
+
 ValuesOnTheStack = {
 	  1: 1,        2: 2,        3: 1,           4: 1,
 	  5: 2,        6: 4,        9: 0,          10: 1,
@@ -15,28 +38,28 @@ ValuesOnTheStack = {
 	 27: 2,       28: 2,       29: 2,          48: 3,
 	 49: 3,       50: 1,       51: 1,          52: 1,
 	 54: (2, 3),  55: 2,       56: 2,          57: 2,
-	 59: 2,       60: 3,       61: 2,          63: 2,
-	 64: 2,       65: 2,       66: 2,          67: 2,
-	 68: 1,       69: 1,       70: 1,          71: 0,
-	 72: 2,       73: 1,       74: 0,          75: 2,
-	 76: 2,       77: 2,       78: 2,          79: 2,
-	 82: 1,       83: 1,       84: 1,          85: 0,
-	 86: 1,       87: 0,       89: 3,          90: 1,
-	 91: 0,       92: 1,       93: 1,          94: 1,
-	 95: 2,       96: 1,       97: 1,          98: 0,
-	100: 0,      101: 0,      102: None,      103: None,
-	104: None,   105: None,   106: 1,         107: 2,
-	108: 2,      109: 1,      110: 0,         111: 1,
-	112: 1,      113: 0,      114: 1,         115: 1,
-	116: 0,      117: 2,      118: 2,         121: 2,
-	122: 0,      124: 0,      125: 1,         126: 0,
-	130: (0, 1), 131: None,   132: (2, 3),    133: (2, 3),
-	135: 0,      136: 0,      137: 1,         138: 0,
-	141: 1,      142: (2, 3), 143: 1,         144: 0,
-	145: 1,      146: 1,      147: 2,         148: 0,
-	154: 1,      155: (1, 2), 156: (1, None), 157: None,
-	160: 1,      161: None,   162: 2,         163: 2,
-	164: 2,      165: 2
+	 59: 2,       60: 3,       61: 2,          62: 2,
+	 63: 2,       64: 2,       65: 2,          66: 2,
+	 67: 2,       68: 1,       69: 1,          70: 1,
+	 71: 0,       72: 2,       73: 1,          74: 0,
+	 75: 2,       76: 2,       77: 2,          78: 2,
+	 79: 2,       82: 1,       83: 1,          84: 1,
+	 85: 0,       86: 1,       87: 0,          89: 3,
+	 90: 1,       91: 0,       92: 1,          93: 1,
+	 94: 1,       95: 2,       96: 1,          97: 1,
+	 98: 0,      100: 0,      101: 0,         102: None,
+	103: None,   104: None,   105: None,      106: 1,
+	107: 2,      108: 2,      109: 1,         110: 0,
+	111: 1,      112: 1,      113: 0,         114: 1,
+	115: 1,      116: 0,      117: 2,         118: 2,
+	121: 2,      122: 0,      124: 0,         125: 1,
+	126: 0,      130: (0, 1), 131: None,      132: (2, 3),
+	133: (2, 3), 135: 0,      136: 0,         137: 1,
+	138: 0,      141: 1,      142: (2, 3),    143: 1,
+	144: 0,      145: 1,      146: 1,         147: 2,
+	148: 0,      154: 1,      155: (1, 2),    156: (1, None),
+	157: None,   160: 1,      161: None,      162: 2,
+	163: 2,      164: 2,      165: 2
 }
 
 ArgumentsNeeded = {
@@ -87,6 +110,9 @@ class Instruct:
 	def __init__(self, opcode: int, arg: int = -1, /, give_id: bool = True):
 		self.opcode = opcode
 		self.arg = arg
+		self.previous = self.next = None # Neighbours while in an InstructList
+		self.target = None # Instruct jumped to, its argument is worked out when written back to bytes
+		self.line = None # Source line, one without a line is on the line of the instruction before it
 		if give_id:
 			self.id = Instruct.INDEX
 			Instruct.INDEX += 1
@@ -99,335 +125,1304 @@ class Instruct:
 	def __repr__(self) -> str:
 		return f"{self.id} {self.opcode} {self.arg}"
 
-class Function:
+# Instructs of co_code with every jump pointed at the Instruct it jumps to
+def read_instructs(codes: bytes) -> List[Instruct]:
+	opcodes, args = decode(codes)
+	instructs = []
+	starts = {} # Offset of an instruction's first EXTENDED_ARG -> instruct
+	jumps = []
+	start = position = 0
 
-	def __init__(self, instructs: list, init_code: CodeType = None, debug: bool = False):
-		self.instructs = instructs
-		self.code = init_code
-		self.single_use_vars = self.constant_ops = self.dead_consts = self.dead_vars = None
-		self.__debug = debug
+	while position < opcodes.__len__():
+		code = opcodes[position]
+		if code == EXTENDED_ARG:
+			position += 1
+			continue
 
-	def optimize(self):
-		self.__cycle()
+		instruct = Instruct(code, args[position])
+		instructs.append(instruct)
+		starts[start << 1] = instruct
 
-	def __cycle(self):
-		ret = False
-		while not ret:
-			self.__map()
-			ret = self.__optimize()
+		target = jump_target(code, args[position], position << 1)
+		if target >= 0:
+			jumps.append((instruct, target))
 
-		self.code = self.code.replace(co_code = self.__instructs_to_bytes())
+		position += 1 + InlineCaches[code]
+		start = position
 
-	def __map(self):
-		single_use_vars = []
-		constant_ops = []
-		dead_consts = []
-		dead_vars = []
+	for instruct, target in jumps:
+		instruct.target = starts.get(target)
 
-		for instruct in self.instructs:
+	return instructs
 
-			if (instruct.opcode >= 10 and instruct.opcode <= 11) or\
-				(instruct.opcode >= 19 and instruct.opcode <= 29) or\
-				(instruct.opcode >= 55 and instruct.opcode <= 57) or\
-				(instruct.opcode >= 62 and instruct.opcode <= 63) or\
-				(instruct.opcode >= 75 and instruct.opcode <= 76) or\
-				instruct.opcode in (59, 67): #TODO: Add support for COMPARE_OP to allow for boolean resolving and then JUMP support
+# Doubly linked list of instructions that keeps track of which instructions use each local and constant and which jump where
+# Ids stay with an instruction for its whole life so removing one never renumbers the rest
+class InstructList:
 
-				if self.__are_args_const(instruct, self.__prior(instruct, 2)):
-					constant_ops.append(instruct)
+	INDEXED = (97, 98, 100, 116, 124, 125, 126) # STORE_GLOBAL, DELETE_GLOBAL, LOAD_CONST, LOAD_GLOBAL, LOAD_FAST, STORE_FAST, DELETE_FAST
 
-		if self.code is not None:
-			for loc in range(len(self.code.co_varnames)):
-				assigns, uses = len(self.__assignments(loc)), len(self.__uses(loc))
-				if assigns == 0 or uses == 0:
-					dead_vars.append(loc)
-
-				elif assigns == 1:
-					single_use_vars.append(loc)
-
-			for con in range(len(self.code.co_consts)):
-				uses = len(self.__uses_const(con))
-				if uses == 0:
-					dead_consts.append(con)
-
-		self.single_use_vars = tuple(single_use_vars)
-		self.constant_ops = tuple(constant_ops)
-		self.dead_consts = tuple(dead_consts)
-		self.dead_vars = tuple(dead_vars)
-
-	def __optimize(self):
-		singles_to_remove = {}
-		for var in self.single_use_vars:
-			store = self.__assignments(var)[0]
-			if store.id > 0 and (load_struct := self.__find(store.id - 1, self.__prior(store))) is not None:
-				if load_struct.opcode == 100:
-					singles_to_remove[var] = [store, self.__uses(var)[0], load_struct]
-					if self.__debug:
-						print(f"The single use of {self.code.co_varnames[var]} [{var}] will be replaced with a LOAD_CONST of {load_struct.arg} [{self.code.co_consts[load_struct.arg]}]")
+	def __init__(self, instructs: Iterable[Instruct] = ()):
+		self.head = self.tail = None
+		self.size = 0
+		self.ids = {}
+		self.users = {opcode: {} for opcode in InstructList.INDEXED} # Opcode -> argument -> instructs, dicts keep them in order
+		self.jumpers = {} # Instruct -> jumps to it
 
-		if len(singles_to_remove):
+		for instruct in instructs:
+			self.append(instruct)
+
+	def __len__(self): return self.size
+
+	def __iter__(self) -> Iterator[Instruct]:
+		instruct = self.head
+		while instruct is not None:
+			following = instruct.next # Lets the current instruction be removed while iterating
+			yield instruct
+			instruct = following
+
+	def __contains__(self, instruct: Instruct): return self.ids.get(instruct.id) is instruct
+
+	def __index(self, instruct: Instruct):
+		if instruct.opcode in self.users:
+			self.users[instruct.opcode].setdefault(instruct.arg, {})[instruct] = None
+		if instruct.target is not None:
+			self.jumpers.setdefault(instruct.target, {})[instruct] = None
+
+	def __unindex(self, instruct: Instruct):
+		if instruct.opcode in self.users:
+			users = self.users[instruct.opcode][instruct.arg]
+			del users[instruct]
+			if not users:
+				del self.users[instruct.opcode][instruct.arg]
+		if instruct.target is not None:
+			jumpers = self.jumpers[instruct.target]
+			del jumpers[instruct]
+			if not jumpers:
+				del self.jumpers[instruct.target]
+
+	def __retarget(self, jumpers: dict, target: Instruct):
+		for jump in jumpers:
+			jump.target = target
+		if target is not None:
+			self.jumpers.setdefault(target, {}).update(jumpers)
+
+	def __give_id(self, instruct: Instruct):
+		if instruct.id < 0 or instruct.id in self.ids:
+			instruct.id = Instruct.INDEX
+			Instruct.INDEX += 1
 
-			for var, values in singles_to_remove.items():
-				self.__replaceInstruct(values[2].id, Instruct(100, values[2].arg, give_id = False))
-				self.__removeInstruct(values[1].id)
-				self.__removeInstruct(values[0].id)
+		self.ids[instruct.id] = instruct
 
-			return False # Map and Optimize again
+	def append(self, instruct: Instruct):
+		self.insert_after(self.tail, instruct)
 
-		if self.code is not None:
-			modified = False
-			for instruct in self.constant_ops:
-				args_instructs = [i for i in self.__prior(instruct, 2)[:ValuesOnTheStack[instruct.opcode]] if i.opcode == 100]
-				args = [self.code.co_consts[i.arg] for i in args_instructs]
-				opcode = instruct.opcode
-				value = None
-				value_set = False # Can't check if None as a return could be None
+	# Puts instruct after previous, or at the start when previous is None
+	def insert_after(self, previous: Instruct, instruct: Instruct):
+		self.__give_id(instruct)
+		following = self.head if previous is None else previous.next
 
-				if opcode == 10: # UNARY_POSITIVE
-					value = +args[0]
-					value_set = True
+		instruct.previous = previous
+		instruct.next = following
 
-				elif opcode == 11: # UNARY_NEGATIVE
-					value = -args[0]
-					value_set = True
+		if previous is None:
+			self.head = instruct
+		else:
+			previous.next = instruct
 
-				elif opcode == 19: # BINARY_POWER
-					value = args[1] ** args[0]
-					value_set = True
+		if following is None:
+			self.tail = instruct
+		else:
+			following.previous = instruct
 
-				elif opcode == 20: # BINARY MULTIPLY
-					value = args[1] * args[0]
-					value_set = True
+		self.size += 1
+		self.__index(instruct)
 
-				elif opcode == 22: # BINARY_MODULO
-					value = args[1] % args[0]
-					value_set = True
+	# Jumps to a removed instruction go to the one that followed it instead
+	def remove(self, instruct: Instruct):
+		jumpers = self.jumpers.pop(instruct, None)
+		if jumpers:
+			self.__retarget(jumpers, instruct.next)
 
-				elif opcode == 23: # BINARY_ADD
-					value = args[1] + args[0]
-					value_set = True
+		if instruct.previous is None:
+			self.head = instruct.next
+		else:
+			instruct.previous.next = instruct.next
 
-				elif opcode == 24: # BINARY_SUBTRACT
-					value = args[1] - args[0]
-					value_set = True
+		if instruct.next is None:
+			self.tail = instruct.previous
+		else:
+			instruct.next.previous = instruct.previous
+
+		instruct.previous = instruct.next = None
+		del self.ids[instruct.id]
+		self.size -= 1
+		self.__unindex(instruct)
+
+	# The replacement takes over the id, place and jumps to instruct
+	def replace(self, instruct: Instruct, replacement: Instruct):
+		previous = instruct.previous
+		jumpers = self.jumpers.pop(instruct, None)
+		self.remove(instruct)
+		replacement.id = instruct.id
+		if replacement.line is None:
+			replacement.line = instruct.line
+		self.insert_after(previous, replacement)
+
+		if jumpers:
+			self.__retarget(jumpers, replacement)
+
+	# Moves the run of instructions from first to last after previous, or to the start when previous is None
+	# Everything jumping to or from them keeps going where it went
+	def move(self, first: Instruct, last: Instruct, previous: Instruct):
+		before, after = first.previous, last.next
+
+		if before is None:
+			self.head = after
+		else:
+			before.next = after
 
-				elif opcode == 25: # BINARY_SUBSCR
-					value = args[1][args[0]]
-					value_set = True
+		if after is None:
+			self.tail = before
+		else:
+			after.previous = before
 
-				elif opcode == 26: # BINARY_FLOOR_DIVIDE
-					value = args[1] // args[0]
-					value_set = True
+		following = self.head if previous is None else previous.next
+		first.previous = previous
+		last.next = following
 
-				elif opcode == 27: # BINARY_TRUE_DIVIDE
-					value = args[1] / args[0]
-					value_set = True
+		if previous is None:
+			self.head = first
+		else:
+			previous.next = first
 
-				elif opcode == 28: # INPLACE_FLOOR_DIVIDE
-					args[1] //= args[0]
+		if following is None:
+			self.tail = last
+		else:
+			following.previous = last
 
-				elif opcode == 29: # INPLACE_TRUE_DIVIDE
-					args[1] /= args[0]
+	def find(self, id: int) -> Instruct:
+		return self.ids.get(id)
 
-				elif opcode == 55: # INPLACE_ADD
-					args[1] += args[0]
+	def uses(self, opcode: int, arg: int) -> List[Instruct]:
+		return list(self.users[opcode].get(arg, ()))
 
-				elif opcode == 56: # INPLACE_SUBTRACT
-					args[1] -= args[0]
+	def jumped_to(self, instruct: Instruct) -> bool:
+		return instruct in self.jumpers
 
-				elif opcode == 57: # INPLACE_MULTIPLY
-					args[1] *= args[0]
+	def set_target(self, jump: Instruct, target: Instruct):
+		self.__unindex(jump)
+		jump.target = target
+		self.__index(jump)
 
-				elif opcode == 59: # INPLACE_MODULO
-					args[1] %= args[0]
+	# Whether second comes somewhere after first
+	def precedes(self, first: Instruct, second: Instruct) -> bool:
+		instruct = first.next
+		while instruct is not None and instruct is not second:
+			instruct = instruct.next
+		return instruct is not None
 
-				elif opcode == 62: # BINARY_LSHIFT
-					value = args[1] << args[0]
-					value_set = True
+	# Up to count instructions before instruct, nearest first
+	def prior(self, instruct: Instruct, count: int) -> List[Instruct]:
+		gotten = []
+		instruct = instruct.previous
 
-				elif opcode == 63: # BINARY_RSHIFT
-					value = args[1] >> args[0]
-					value_set = True
+		while instruct is not None and gotten.__len__() < count:
+			gotten.append(instruct)
+			instruct = instruct.previous
 
-				elif opcode == 67: # INPLACE_POWER
-					args[1] **= args[0]
+		return gotten
 
-				elif opcode == 75: # INPLACE_LSHIFT
-					args[1] <<= args[0]
+	# Shifts arguments down to close the gaps left by the deleted locals or constants in removed
+	def renumber(self, opcodes: Iterable[int], removed: Iterable[int]):
+		removed = sorted(removed)
+
+		for opcode in opcodes:
+			renumbered = {}
+
+			for arg, users in self.users[opcode].items():
+				shifted = arg - bisect_left(removed, arg)
+				if shifted != arg:
+					for instruct in users:
+						instruct.arg = shifted
+				renumbered.setdefault(shifted, {}).update(users)
+
+			self.users[opcode] = renumbered
+
+	# Basic blocks of the instructions and the indexes of the blocks each one can go to next
+	def blocks(self) -> Tuple[List[List[Instruct]], List[List[int]]]:
+		blocks = []
+		block_of = {}
+
+		for instruct in self:
+			if not blocks or self.jumped_to(instruct) or blocks[-1][-1].target is not None or blocks[-1][-1].opcode in Terminators:
+				blocks.append([])
+			blocks[-1].append(instruct)
+			block_of[instruct] = blocks.__len__() - 1
+
+		successors = []
+		for i, block in enumerate(blocks):
+			last = block[-1]
+			following = []
+
+			if last.target in block_of:
+				following.append(block_of[last.target])
+			if last.opcode not in Terminators and i + 1 < blocks.__len__():
+				following.append(i + 1)
+
+			successors.append(following)
+
+		return blocks, successors
+
+	# co_code for the instructions with every jump's argument relocated to where its target ends up
+	def to_bytes(self) -> bytes:
+		return self.layout()[0]
+
+	# co_code along with the offset each instruction ends up at
+	def layout(self) -> Tuple[bytes, dict]:
+		instructs = list(self)
+		sizes = [instruction_size(instruct.opcode, 0 if instruct.target is not None else instruct.arg) for instruct in instructs]
+
+		# A jump argument that grows an EXTENDED_ARG moves everything after it, so repeat until the sizes settle
+		# Sizes only ever grow, a jump that needs fewer prefixes later on keeps an EXTENDED_ARG 0 so two jumps can't keep resizing each other
+		changed = True
+		while changed:
+			changed = False
+			offsets = {}
+			offset = 0
+
+			for instruct, size in zip(instructs, sizes):
+				offsets[instruct] = offset
+				offset += size << 1
+
+			for i, instruct in enumerate(instructs):
+				if instruct.target is None:
+					continue
 
-				elif opcode == 76: # INPLACE_RSHIFT
-					args[1] >>= args[0]
+				prefixes = sizes[i] - 1 - InlineCaches[instruct.opcode]
+				instruct.arg = jump_argument(instruct.opcode, offsets[instruct.target], offsets[instruct] + (prefixes << 1))
 
-				else:
+				# Pointing the wrong way for a relative jump, it becomes the jump going the other way
+				if instruct.arg < 0 and instruct.opcode in Turned:
+					instruct.opcode = Turned[instruct.opcode]
+					sizes[i] = max(sizes[i], instruction_size(instruct.opcode, 0))
+					changed = True
 					continue
 
-				consts = list(self.code.co_consts)
+				size = instruction_size(instruct.opcode, instruct.arg)
+				if size > sizes[i]:
+					sizes[i] = size
+					changed = True
 
-				for i in range(ValuesOnTheStack[opcode]):
-					consts[args_instructs[i].arg] = args[i]
-					self.__removeInstruct(instruct.id - 1)
+		return encode([(instruct.opcode, instruct.arg) for instruct in instructs], sizes), offsets
 
-				if value_set:
-					if value not in consts:
-						consts.append(value)
-						index = len(consts) - 1
-					else:
-						index = consts.index(value)
+# Queue of items waiting to be looked at, each one queued at most once at a time
+class Worklist:
 
-					self.__replaceInstruct(instruct.id, Instruct(100, index, give_id = False))
+	def __init__(self, items: Iterable = ()):
+		self.queue = deque()
+		self.queued = set()
+		self.extend(items)
 
-					if self.__debug:
-						print(f"The operation {opname[instruct.opcode]} has a static result and will be replaced with a {opname[100]} of {index} [{consts[index]}]")
-				else:
-					self.__removeInstruct(instruct.id)
+	def __len__(self): return self.queue.__len__()
 
-					if self.__debug:
-						print(f"The operation {opname[instruct.opcode]} has a static result and will be replaced with the constant {args[1]}")
+	def push(self, item):
+		if item not in self.queued:
+			self.queued.add(item)
+			self.queue.append(item)
+
+	def extend(self, items: Iterable):
+		for item in items:
+			self.push(item)
+
+	def pop(self):
+		item = self.queue.popleft()
+		self.queued.discard(item)
+		return item
+
+# Key telling constants apart the way co_consts has to, 1, 1.0 and True are equal but can't share an entry and neither can 0.0 and -0.0
+def constant_key(value) -> Hashable:
+	if isinstance(value, (tuple, frozenset)):
+		return type(value), type(value)(constant_key(item) for item in value)
+	if isinstance(value, (float, complex)):
+		return type(value), repr(value)
+
+	try:
+		hash(value)
+	except TypeError:
+		return type(value), id(value)
+	return type(value), value
+
+# co_consts of a Function, new constants are found through a hash index instead of comparing against every one
+class ConstantPool:
+
+	# Largest results of folding that get put in, the same limits as the compiler's own folding
+	MAX_INT_BITS = 128
+	MAX_LENGTH = 4096 # Characters of a str or bytes
+	MAX_ITEMS = 256   # Items of a tuple or frozenset
+
+	def __init__(self, consts: Iterable = ()):
+		self.consts = list(consts)
+		self.indexes = {}
+		for index, const in enumerate(self.consts):
+			self.indexes.setdefault(constant_key(const), index)
+
+	def __len__(self): return self.consts.__len__()
+
+	def __getitem__(self, index: int): return self.consts[index]
+
+	# Index of the value, added to the end when it isn't there yet
+	def index(self, value) -> int:
+		key = constant_key(value)
+		index = self.indexes.get(key)
+
+		if index is None:
+			index = self.indexes[key] = self.consts.__len__()
+			self.consts.append(value)
 
-				self.code = self.code.replace(co_consts = tuple(consts))
-				modified = True
+		return index
 
-			if modified:
-				return False # Map and Optimize again
+	@staticmethod
+	def fits(value) -> bool:
+		if isinstance(value, int):
+			return value.bit_length() <= ConstantPool.MAX_INT_BITS
+		if isinstance(value, (str, bytes)):
+			return value.__len__() <= ConstantPool.MAX_LENGTH
+		if isinstance(value, (tuple, frozenset)):
+			return value.__len__() <= ConstantPool.MAX_ITEMS and all(ConstantPool.fits(item) for item in value)
+		return True
+
+	# Takes out every constant not in used in one pass and returns their old indexes
+	# The first is always kept as a function takes its docstring from it
+	def compact(self, used: Iterable[int]) -> List[int]:
+		used = set(used)
+		used.add(0)
+		removed = [index for index in range(self.consts.__len__()) if index not in used]
+
+		if removed:
+			self.consts = [const for index, const in enumerate(self.consts) if index in used]
+			self.indexes = {}
+			for index, const in enumerate(self.consts):
+				self.indexes.setdefault(constant_key(const), index)
+
+		return removed
+
+	def to_tuple(self) -> tuple: return tuple(self.consts)
+
+# Opcodes by name as the numbering changes between versions, None for the ones the running version doesn't have
+JUMP_FORWARD = opmap["JUMP_FORWARD"] # Laid out as the jump going back when it has to, see InstructList.layout
+RETURN_VALUE = opmap["RETURN_VALUE"]
+COMPARE_OP = opmap["COMPARE_OP"]
+IS_OP = opmap.get("IS_OP")
+CONTAINS_OP = opmap.get("CONTAINS_OP")
+LOAD_ATTR = opmap["LOAD_ATTR"]
+LOAD_METHOD = opmap.get("LOAD_METHOD")
+CALL_FUNCTION = opmap.get("CALL_FUNCTION")
+CALL_METHOD = opmap.get("CALL_METHOD")
+GEN_START = opmap.get("GEN_START")
+RESUME = opmap.get("RESUME")
+
+def _by_name(table: dict) -> dict:
+	return {opmap[name]: value for name, value in table.items() if name in opmap}
+
+# COMPARE_OP arguments, 3.8 also does is/in through it
+Comparisons = {
+	"<": lt, "<=": le, "==": eq, "!=": ne, ">": gt, ">=": ge,
+	"in": lambda a, b: a in b, "not in": lambda a, b: a not in b,
+	"is": is_, "is not": is_not
+}
+
+UnaryOperations = _by_name({"UNARY_POSITIVE": pos, "UNARY_NEGATIVE": neg, "UNARY_NOT": not_})
+
+# Called with the left operand first, in place operations give back what's left in place of it
+BinaryOperations = _by_name({
+	"BINARY_POWER": pow,         "BINARY_MULTIPLY": mul,       "BINARY_MODULO": mod,         "BINARY_ADD": add,
+	"BINARY_SUBTRACT": sub,      "BINARY_SUBSCR": getitem,     "BINARY_FLOOR_DIVIDE": floordiv, "BINARY_TRUE_DIVIDE": truediv,
+	"BINARY_LSHIFT": lshift,     "BINARY_RSHIFT": rshift,      "INPLACE_FLOOR_DIVIDE": ifloordiv, "INPLACE_TRUE_DIVIDE": itruediv,
+	"INPLACE_ADD": iadd,         "INPLACE_SUBTRACT": isub,     "INPLACE_MULTIPLY": imul,     "INPLACE_MODULO": imod,
+	"INPLACE_POWER": ipow,       "INPLACE_LSHIFT": ilshift,    "INPLACE_RSHIFT": irshift
+})
+
+# Operations folded when all of their operands are constants
+FoldableOperations = frozenset(UnaryOperations) | frozenset(BinaryOperations) | frozenset(opcode for opcode in (COMPARE_OP, IS_OP, CONTAINS_OP) if opcode is not None)
+
+# Whether the result would be too large to keep as a constant, worked out from the operands so 'a' * 10**8 or 2 ** 10**6 is never built
+def _oversized(opcode: int, left, right) -> bool:
+	integers = isinstance(left, int) and isinstance(right, int)
+	operation = BinaryOperations[opcode]
+
+	if operation in (pow, ipow) and integers and right > 0:
+		return left.bit_length() * right > ConstantPool.MAX_INT_BITS
+	if operation in (lshift, ilshift) and integers and right > 0:
+		return left.bit_length() + right > ConstantPool.MAX_INT_BITS
+	if operation in (mul, imul):
+		if integers:
+			return left.bit_length() + right.bit_length() > ConstantPool.MAX_INT_BITS
+		for sequence, count in ((left, right), (right, left)):
+			if isinstance(sequence, (str, bytes, tuple)) and isinstance(count, int):
+				return sequence.__len__() * count > ConstantPool.MAX_LENGTH
+
+	return False
+
+# Result of an operation on constant operands, args[0] is the top of the stack
+# Raises what the operation would, or a ValueError when it isn't one that can be worked out ahead of time
+def evaluate(opcode: int, arg: int, args: list):
+	if opcode in UnaryOperations:
+		return UnaryOperations[opcode](args[0])
+	if opcode in BinaryOperations:
+		if _oversized(opcode, args[1], args[0]):
+			raise ValueError(f"{opname[opcode]} would make too large a constant")
+		return BinaryOperations[opcode](args[1], args[0])
+	if opcode == COMPARE_OP and cmp_op[arg] in Comparisons:
+		return Comparisons[cmp_op[arg]](args[1], args[0])
+	if opcode == IS_OP:
+		return (args[1] is args[0]) != bool(arg)
+	if opcode == CONTAINS_OP:
+		return (args[1] in args[0]) != bool(arg)
+
+	raise ValueError(f"{opname[opcode]} can't be worked out ahead of time")
+
+# Their targets are where exceptions raised after them go
+SetupHandlers = frozenset(_by_name(dict.fromkeys(("SETUP_FINALLY", "SETUP_WITH", "SETUP_ASYNC_WITH"))))
+
+# Conditional jumps -> (jumps when the value is true, value is kept when jumping)
+ConditionalJumps = _by_name({
+	"JUMP_IF_FALSE_OR_POP": (False, True),       "JUMP_IF_TRUE_OR_POP": (True, True),
+	"POP_JUMP_IF_FALSE": (False, False),          "POP_JUMP_IF_TRUE": (True, False),
+	"POP_JUMP_FORWARD_IF_FALSE": (False, False),  "POP_JUMP_FORWARD_IF_TRUE": (True, False),
+	"POP_JUMP_BACKWARD_IF_FALSE": (False, False), "POP_JUMP_BACKWARD_IF_TRUE": (True, False)
+})
+
+# Conditional jump that pops its value -> the one jumping on the opposite test
+Negated = {jump: opmap[opname[jump].replace("FALSE", "TRUE") if jump_when is False else opname[jump].replace("TRUE", "FALSE")]
+	for jump, (jump_when, keeps_value) in ConditionalJumps.items() if not keeps_value}
+
+# Opcodes that only move values about, nothing outside the function can tell they ran
+Unseen = frozenset(_by_name(dict.fromkeys(("POP_TOP", "ROT_TWO", "ROT_THREE", "ROT_FOUR", "DUP_TOP", "SWAP", "COPY", "LOAD_CONST", "BUILD_TUPLE"))))
+
+# Opcodes that can run other code while the loop is part way through
+Reentrant = frozenset(_by_name(dict.fromkeys((
+	"CALL_FUNCTION", "CALL_FUNCTION_KW", "CALL_FUNCTION_EX", "CALL_METHOD", "PRECALL", "CALL", "YIELD_VALUE", "YIELD_FROM", "SEND",
+	"GET_AWAITABLE", "IMPORT_NAME", "SETUP_WITH", "SETUP_ASYNC_WITH", "BEFORE_WITH", "BEFORE_ASYNC_WITH"
+))))
+
+# A value on the stack the loop invariant pass follows, made by the instructions from first to last
+class StackValue:
+
+	def __init__(self, first: Instruct, last: Instruct, invariant: bool = False, raises: bool = False, worthwhile: bool = False, constant: bool = False, value = None):
+		self.first = first
+		self.last = last
+		self.invariant = invariant   # The same every time round the loop
+		self.raises = raises         # Could raise an error
+		self.worthwhile = worthwhile # Costs more than the LOAD_FAST it'd be replaced with
+		self.constant = constant     # Only made out of constants, value is what it works out to
+		self.value = value
+		self.method = None           # Its LOAD_METHOD when it's a method waiting to be called
+
+# Whether the values were made one right after the other, just before instruct
+def _adjacent(values: List[StackValue], instruct: Instruct) -> bool:
+	for value, following in zip(values, values[1:]):
+		if value.last.next is not following.first:
+			return False
+	return values[-1].last.next is instruct
+
+# Loops of the decompiler's tree, outer ones before the loops inside them
+def _loops(body: Body) -> Iterator[Loop]:
+	for code in body.content:
+		if isinstance(code, Loop):
+			yield code
+			yield from _loops(code.loop)
+		elif isinstance(code, Branch):
+			yield from _loops(code.true)
+			yield from _loops(code.false)
+		elif isinstance(code, If):
+			yield from _loops(code.exec)
+
+# Branches of the decompiler's tree, outer ones before the branches inside them
+def _branches(body: Body) -> Iterator[Branch]:
+	for code in body.content:
+		if isinstance(code, Branch):
+			yield code
+			yield from _branches(code.true)
+			yield from _branches(code.false)
+		elif isinstance(code, Loop):
+			yield from _branches(code.loop)
+		elif isinstance(code, If):
+			yield from _branches(code.exec)
+
+MIN_TRIPS = 2 # Times round a loop on average for hoisting out of it to pay for itself, with a profile
+
+# From 3.11 lines are kept with their columns and exception handlers in co_exceptiontable, neither of which can be written yet
+# Code there is given back as it is, with a warning the first time
+WRITABLE = VERSION < (3, 11)
+_unwritable_warned = False
+
+def _warn_unwritable():
+	global _unwritable_warned
+	if not _unwritable_warned:
+		_unwritable_warned = True
+		warn(f"Code can't be optimized on Python {VERSION[0]}.{VERSION[1]} yet and is left as it is", RuntimeWarning, stacklevel = 3)
+
+class Function:
 
-		modified = False
+	# peepholes names the entries of Peepholes to run, all of them when None
+	# profile has the branch and loop counts of a run of init_code, when given branches are laid out and loops hoisted by it
+	# hoist_attributes lets attribute loads be hoisted out of loops, which is only right for code meeting the README's attribute precondition
+	def __init__(self, instructs: Iterable[Instruct], init_code: CodeType = None, debug: bool = False, peepholes: Iterable[str] = None, hoist_invariants: bool = True, profile: CodeProfile = None, hoist_attributes: bool = False):
+		self.instructs = InstructList(instructs)
+		self.code = init_code
+		self.consts = ConstantPool(init_code.co_consts if init_code is not None else ())
+		self.peepholes = tuple(peepholes) if peepholes is not None else None
+		self.hoist_invariants = hoist_invariants
+		self.hoist_attributes = hoist_attributes
+		self.profile = profile
+		self.branches = {} # Id of a conditional jump -> (times taken, times not taken)
+		self.trips = {}    # Id of a loop's FOR_ITER or test -> times round it each time it's started
+		self.entry = self.loops = None
+		self.__debug = debug
+
+		if init_code is not None:
+			self.__read_lines()
+			if profile is not None:
+				self.__read_profile()
 
+	def report(self, message: str):
+		if self.__debug:
+			print(message)
+
+	# Every instruction is looked at once, after that only the ones whose inputs a rewrite changed are looked at again
+	# Taking out a branch can make more rewrites possible so it starts over while code keeps being removed
+	def optimize(self):
+		if not WRITABLE:
+			_warn_unwritable()
+			return
+
+		rewrites = ()
 		if self.code is not None:
-			new_vars = list(self.code.co_varnames)
-			for var in sorted(self.dead_vars, reverse=True):
-				if self.__debug:
-					print(f"Local variable {new_vars[var]} [{var}] is unused so it will be removed")
+			peepholes = [Peepholes[name] for name in (Peepholes if self.peepholes is None else self.peepholes)]
+			rewrites = (self.__fold_constants, self.__fold_branch, self.__inline_constant_store) + \
+				tuple(lambda instruct, peephole = peephole: peephole(self, instruct) for peephole in peepholes)
+
+		removed = True
+
+		while removed:
+			self.entry = self.__entry_order()
+			self.loops = self.__loop_members()
+			work = Worklist(self.instructs)
+
+			while work:
+				instruct = work.pop()
+				if instruct not in self.instructs:
+					continue # Taken out by an earlier rewrite
 
-				for instruct in self.instructs:
-					if instruct is None:
-						continue
-					if instruct.arg > var and instruct.opcode in (124, 125):
-						instruct.arg -= 1
+				for rewrite in rewrites:
+					changed = rewrite(instruct)
+					if changed is not None:
+						work.extend(changed)
+						break
 
-				del new_vars[var]
+			removed = self.__remove_unreachable()
 
-			if len(new_vars) != len(self.code.co_varnames):
-				self.code = self.code.replace(co_nlocals = len(new_vars), co_varnames = tuple(new_vars))
-				modified = True
+		if self.code is not None and self.branches:
+			self.__reorder_branches()
+
+		if self.code is not None and self.hoist_invariants:
+			self.entry = self.__entry_order()
+			self.__hoist_invariants()
 
 		if self.code is not None:
-			new_consts = list(self.code.co_consts)
-			for var in sorted(self.dead_consts, reverse=True):
+			self.__remove_dead_stores()
+			self.__remove_unused()
+			codes, offsets = self.instructs.layout()
+			lines = encode_lines(self.code.co_firstlineno, self.__line_starts(offsets), codes.__len__())
+			self.code = self.code.replace(co_code = codes, co_consts = self.consts.to_tuple(), **{LINE_TABLE: lines})
+			self.code = self.code.replace(co_stacksize = stack_size(self.code)) # Raises a ValueError for code that can't run
+
+	# Gives every instruction the line it's on in the initial code
+	def __read_lines(self):
+		program = list(instructions(self.code.co_code))
+		if program.__len__() != self.instructs.__len__():
+			return # Instructions that weren't read from the code
+
+		starts = dict(findlinestarts(self.code))
+		line = None
+		for (offset, _, _), instruct in zip(program, self.instructs):
+			line = starts.get(offset, line)
+			instruct.line = line
+
+	# Gives the counts of the profile to the instructions at their offsets, which are of the jump itself after any EXTENDED_ARG
+	def __read_profile(self):
+		codes = self.code.co_code
+		program = list(instructions(codes))
+		if program.__len__() != self.instructs.__len__():
+			return
+
+		for (offset, _, _), instruct in zip(program, self.instructs):
+			while codes[offset] == EXTENDED_ARG:
+				offset += 2
+
+			if offset in self.profile.branches:
+				self.branches[instruct.id] = self.profile.branches[offset]
+			if offset in self.profile.loops:
+				self.trips[instruct.id] = self.profile.trips(offset)
+
+	# (offset, line) of every instruction that starts a line, instructions added by the rewrites stay on the line before them
+	# Ones added before the first instruction with a line are put on that line rather than the def's
+	def __line_starts(self, offsets: dict) -> List[Tuple[int, int]]:
+		starts = []
+		line = None
+		for instruct in self.instructs:
+			if instruct.line is not None and instruct.line != line:
+				line = instruct.line
+				starts.append((offsets[instruct] if starts else 0, line))
+		return starts
+
+	# Ids of the instructions every call runs through once, in order, before any jump or jump target
+	def __entry_order(self) -> dict:
+		entry = {}
+		for instruct in self.instructs:
+			if instruct.target is not None or self.instructs.jumped_to(instruct):
+				break
+			entry[instruct.id] = entry.__len__()
+		return entry
+
+	# Ids of the instructions between a backwards jump and where it goes
+	def __loop_members(self) -> set:
+		order = {instruct: position for position, instruct in enumerate(self.instructs)}
+		depth = [0] * (order.__len__() + 1)
+
+		for instruct, position in order.items():
+			if instruct.target in order and order[instruct.target] <= position:
+				depth[order[instruct.target]] += 1
+				depth[position + 1] -= 1
+
+		members = set()
+		inside = 0
+		for instruct, position in order.items():
+			inside += depth[position]
+			if inside > 0:
+				members.add(instruct.id)
+
+		return members
+
+	# Index of a new local, numbered when a local of that name is already there
+	def new_local(self, name: str) -> int:
+		names = self.code.co_varnames
+		unique = name
+		count = 1
+		while unique in names:
+			count += 1
+			unique = f"{name}{count}"
+
+		self.code = self.code.replace(co_varnames = names + (unique,), co_nlocals = self.code.co_nlocals + 1)
+		return names.__len__()
+
+	# Whether the local is always set by the time the load runs, so loading it can't fail
+	def assigned(self, load: Instruct) -> bool:
+		var = load.arg
+		if var < self.__argument_count():
+			return True
+		if self.instructs.uses(126, var):
+			return False
+
+		position = self.entry.get(load.id)
+		return any(store.id in self.entry and (position is None or self.entry[store.id] < position) for store in self.instructs.uses(125, var))
+
+	# Drops code no path reaches, then jumps that only go to the next instruction
+	def __remove_unreachable(self) -> bool:
+		reachable = set()
+		pending = [self.instructs.head]
+
+		while pending:
+			instruct = pending.pop()
+			while instruct is not None and instruct not in reachable:
+				reachable.add(instruct)
+				if instruct.target is not None:
+					pending.append(instruct.target)
+				if instruct.opcode in Terminators:
+					break
+				instruct = instruct.next
+
+		removed = False
+		for instruct in self.instructs:
+			if instruct not in reachable:
 				if self.__debug:
-					print(f"Constant variable {new_consts[var]} [{var}] is unused so it will be removed")
+					print(f"The instruction {opname[instruct.opcode]} [{instruct.id}] can't be reached and will be removed")
+				self.instructs.remove(instruct)
+				removed = True
 
-				for instruct in self.instructs:
-					if instruct is None:
-						continue
+		for instruct in self.instructs:
+			if instruct.opcode in UnconditionalJumps and instruct.target is instruct.next:
+				self.instructs.remove(instruct)
+				removed = True
 
-					if instruct.opcode == 100 and instruct.arg > var:
-						instruct.arg -= 1
+		return removed
 
-				del new_consts[var]
+	# Instructions that could take a new constant at instruct as an operand
+	def __consumers(self, instruct: Instruct) -> List[Instruct]:
+		consumers = []
+		while instruct is not None and consumers.__len__() < 2:
+			instruct = instruct.next
+			if instruct is not None:
+				consumers.append(instruct)
+		return consumers
 
-			if len(new_consts) != len(self.code.co_consts):
-				self.code = self.code.replace(co_consts = tuple(new_consts))
-				modified = True
+	def __load_const(self, value) -> Instruct:
+		return Instruct(100, self.consts.index(value), give_id = False)
 
-		return not modified
+	# Replaces an operation on constants with a LOAD_CONST of its result
+	def __fold_constants(self, instruct: Instruct) -> List[Instruct]:
+		if instruct.opcode not in FoldableOperations or not self.__are_args_const(instruct, self.instructs.prior(instruct, 2)):
+			return None
 
-	def __instructs_to_bytes(self, instructs: list = None):
-		if instructs is None:
-			instructs = self.instructs
+		args_instructs = self.instructs.prior(instruct, 2)[:ValuesOnTheStack[instruct.opcode]]
 
-		output = []
-		for instruct in self.instructs:
-			output.append(instruct.opcode)
-			output.append(instruct.arg)
+		# Only the first operand can be jumped to, anything later could be reached with other values on the stack
+		if any(self.instructs.jumped_to(i) for i in [instruct] + args_instructs[:-1]):
+			return None
 
-		return bytes(output)
+		args = [self.consts[i.arg] for i in args_instructs]
+		opcode = instruct.opcode
 
-	def __are_args_const(self, operation: Instruct, instructs: list = None):
-		const_needed = ValuesOnTheStack[operation.opcode]
-		const_gotten = sum([1 for instruct in instructs[:const_needed] if instruct.opcode == 100])
-		return const_gotten >= const_needed
+		try:
+			value = evaluate(opcode, instruct.arg, args)
+		except Exception:
+			return None # Left for the error to be raised when the code runs
+
+		if not ConstantPool.fits(value):
+			return None
+
+		for arg_instruct in args_instructs:
+			self.instructs.remove(arg_instruct)
 
-	def __removeInstruct(self, id: int):
-		for i in range(len(self.instructs)):
-			instruct = self.instructs[i]
-			if instruct is None:
-				continue
+		load = self.__load_const(value)
+		self.instructs.replace(instruct, load)
 
-			if instruct.id == id:
-				self.instructs[i] = None
-			elif instruct.id > -1 and instruct.id > id:
-				instruct.id -= 1
+		if self.__debug:
+			print(f"The operation {opname[opcode]} has a static result and will be replaced with a {opname[100]} of {load.arg} [{self.consts[load.arg]}]")
+
+		return self.__consumers(load)
+
+	# Turns a conditional jump on a constant into a jump, or takes it out when it would never jump
+	def __fold_branch(self, instruct: Instruct) -> List[Instruct]:
+		condition = instruct.previous
+		if instruct.opcode not in ConditionalJumps or condition is None or condition.opcode != 100 or self.instructs.jumped_to(instruct):
+			return None
 
 		try:
-			while (i := self.instructs.index(None)) >= 0:
-				del self.instructs[i]
-		except ValueError:
-			pass
-
-	def __replaceInstruct(self, id: int, replacement: Instruct):
-		for i in range(len(self.instructs)):
-			instruct = self.instructs[i]
-			if instruct is None:
-				continue
-
-			if instruct.id == id:
-				replacement.id = id
-				self.instructs[i] = replacement
+			truth = bool(self.consts[condition.arg])
+		except Exception:
+			return None
+
+		jump_when, keeps_value = ConditionalJumps[instruct.opcode]
+		following = instruct.next
+
+		if truth == jump_when:
+			if self.__debug:
+				print(f"The branch {opname[instruct.opcode]} [{instruct.id}] always jumps and will be replaced with a jump")
+
+			jump = Instruct(JUMP_FORWARD, 0, give_id = False)
+			jump.target = instruct.target
+			self.instructs.replace(instruct, jump)
+			if not keeps_value:
+				self.instructs.remove(condition)
+		else:
+			if self.__debug:
+				print(f"The branch {opname[instruct.opcode]} [{instruct.id}] never jumps and will be removed")
+
+			self.instructs.remove(instruct)
+			self.instructs.remove(condition)
+
+		return [] if following is None else [following]
+
+	# Replaces the loads of a local that's only ever assigned a constant with that constant
+	# The store has to run before anything else can happen so it's the value every load sees
+	def __inline_constant_store(self, instruct: Instruct) -> List[Instruct]:
+		if instruct.opcode != 125 or instruct.arg < self.__argument_count() or instruct.id not in self.entry:
+			return None
+
+		var = instruct.arg
+		load_struct = instruct.previous
+		if load_struct is None or load_struct.opcode != 100 or len(self.instructs.uses(125, var)) != 1 or self.instructs.uses(126, var):
+			return None
+
+		position = self.entry[instruct.id]
+		if any(self.entry.get(use.id, position + 1) < position for use in self.instructs.uses(124, var)):
+			return None # Loaded before it's ever set
+
+		if self.__debug:
+			print(f"The single use of {self.code.co_varnames[var]} [{var}] will be replaced with a LOAD_CONST of {load_struct.arg} [{self.consts[load_struct.arg]}]")
+
+		changed = []
+		for use in self.instructs.uses(124, var):
+			load = Instruct(100, load_struct.arg, give_id = False)
+			self.instructs.replace(use, load)
+			changed.extend(self.__consumers(load))
+
+		self.instructs.remove(load_struct)
+		self.instructs.remove(instruct)
+		return changed
+
+	# Whether a LOAD_GLOBAL with the argument always gets a builtin, the function never sets or deletes a global of that name
+	def builtin(self, arg: int) -> bool:
+		index = name_index(116, arg)
+		return hasattr(builtins, self.code.co_names[index]) and not self.instructs.uses(97, index) and not self.instructs.uses(98, index) # STORE_GLOBAL, DELETE_GLOBAL
+
+	# The decompiler's tree of the instructions as they are now, with the instruction at the offset of every code unit
+	# The tree is None when the decompiler can't follow the code yet
+	def __tree(self) -> Tuple[Body, dict]:
+		codes, offsets = self.instructs.layout()
+		at = {} # Offset of every code unit, prefixes included -> instruct
+
+		for instruct, offset in offsets.items():
+			for unit in range(instruction_size(instruct.opcode, instruct.arg)):
+				at[offset + (unit << 1)] = instruct
+
+		try:
+			return build_tree(codes), at
+		except NotImplementedError:
+			return None, at
+
+	# Lays the arm of each if/else the profile saw run more often straight after its test, so the usual way through doesn't jump
+	# The arms are those of the Branch nodes of the decompiler's tree, which is the same as turning its true_first around
+	def __reorder_branches(self):
+		tree, at = self.__tree()
+		if tree is None:
+			return
+
+		# Kept as ids as moving an outer branch's arms takes the branches inside them along
+		jumps = []
+		for branch in _branches(tree):
+			jump = at[branch.omitted.id]
+			taken, not_taken = self.branches.get(jump.id, (0, 0))
+			if taken > not_taken:
+				jumps.append(jump.id)
+
+		for id in jumps:
+			self.__swap_arms(self.instructs.find(id))
+
+	# test; POP_JUMP_IF_FALSE second; first ...; JUMP_FORWARD end; second ...; end
+	# test; POP_JUMP_IF_TRUE first; second ...; JUMP_FORWARD end; first ...; end
+	def __swap_arms(self, jump: Instruct):
+		if jump is None or jump.opcode not in Negated or jump.target is None:
+			return
+
+		second = jump.target
+		exit = second.previous
+		first = jump.next
+		if exit is None or exit is jump or first is exit or exit.opcode not in UnconditionalJumps or exit.target is None:
+			return
+
+		end = exit.target
+		if not self.instructs.precedes(jump, second) or not self.instructs.precedes(second, end):
+			return
+
+		arms = ([], [])
+		for arm, start, stop in ((arms[0], first, second), (arms[1], second, end)):
+			instruct = start
+			while instruct is not stop:
+				arm.append(instruct)
+				instruct = instruct.next
+
+		# The arms can only be moved when nothing outside of them jumps in, other than the test to the start of the second
+		for arm in arms:
+			inside = set(arm)
+			for instruct in arm:
+				if any(jumper not in inside and not (jumper is jump and instruct is second) for jumper in self.instructs.jumpers.get(instruct, ())):
+					return
+
+		last = arms[1][-1]
+		self.report(f"The {opname[jump.opcode]} [{jump.id}] usually jumps, its arms will be swapped so the usual one follows the test")
+
+		turned = Instruct(Negated[jump.opcode], 0, give_id = False)
+		turned.target = first
+		taken, not_taken = self.branches.pop(jump.id)
+		self.instructs.replace(jump, turned)
+		self.branches[turned.id] = (not_taken, taken)
+
+		# The first arm now runs into end, so what went to its jump out goes straight there
+		for jumper in list(self.instructs.jumpers.get(exit, ())):
+			self.instructs.set_target(jumper, end)
+		self.instructs.remove(exit)
+
+		self.instructs.move(second, last, turned)
+		if last.opcode not in Terminators:
+			join = Instruct(JUMP_FORWARD, 0, give_id = False)
+			join.target = end
+			self.instructs.insert_after(last, join)
+
+	# Moves what works out the same every time round a loop in front of it, into a new local
+	# The loops are the For and While nodes of the decompiler's tree
+	def __hoist_invariants(self):
+		if not self.code.co_flags & CO_OPTIMIZED:
+			return # Only functions have fast locals to keep the values in
+
+		tree, at = self.__tree()
+		if tree is None:
+			return
+
+		# Kept as ids as those stay with an instruction when it's replaced, outer loops change before the ones inside them
+		loops = []
+		for loop in _loops(tree):
+			omitted = at[loop.omitted.id]
+			conditional = []
+
+			if not isinstance(loop, For): # A while's condition runs every time round too
+				instruct = at[next(iter(loop.conditional)).id] if loop.conditional.__len__() else omitted
+				while instruct is not omitted:
+					conditional.append(instruct.id)
+					instruct = instruct.next
+
+			if self.profile is not None and self.trips.get(omitted.id, 0) < MIN_TRIPS:
+				continue # Hardly goes round, if it ran at all
+
+			head = self.instructs.find(conditional[0]) if conditional else omitted
+			loops.append((head.id, omitted.id, conditional))
+
+		for loop in loops:
+			self.__hoist_loop(*loop)
+
+	# The loop is everything from its head up to where its test leaves it
+	def __hoist_loop(self, head_id: int, omitted_id: int, conditional_ids: List[int]):
+		head, omitted = self.instructs.find(head_id), self.instructs.find(omitted_id)
+		conditional = [self.instructs.find(id) for id in conditional_ids]
+		if head is None or omitted is None or omitted.target is None or None in conditional:
+			return
+
+		members = []
+		instruct = head
+		while instruct is not None and instruct is not omitted.target:
+			members.append(instruct)
+			instruct = instruct.next
+
+		inside = set(members)
+
+		if instruct is None or not any(member.target is head for member in members):
+			return # Not a loop anymore
+
+		# Anywhere but the head being jumped to from outside would be coming into the loop part way through
+		if any(jump not in inside for member in members[1:] for jump in self.instructs.jumpers.get(member, ())):
+			return
+
+		# Locals set in the straight run leading up to the loop are set every time it's started
+		defined = set()
+		if all(jump in inside for jump in self.instructs.jumpers.get(head, ())):
+			seen = set()
+			instruct = head.previous
+
+			while instruct is not None and instruct.target is None and instruct.opcode not in Terminators:
+				if instruct.opcode in (125, 126) and instruct.arg not in seen: # STORE_FAST, DELETE_FAST
+					seen.add(instruct.arg)
+					if instruct.opcode == 125:
+						defined.add(instruct.arg)
+				if self.instructs.jumped_to(instruct):
+					break
+				instruct = instruct.previous
+
+		stored = {member.arg for member in members if member.opcode in (125, 126)}    # STORE_FAST, DELETE_FAST
+		attributes = {member.arg for member in members if member.opcode in (95, 96)} # STORE_ATTR, DELETE_ATTR
+		reentrant = any(member.opcode in Reentrant for member in members)
+		candidates = self.__invariants(members, stored, defined, attributes, reentrant)
+
+		# What could raise can't run before the loop as the loop might never run it, instead the loop's first test is copied
+		# and it runs once that passes. The body has to start with it after nothing that can be seen, so an error still comes first
+		body = omitted.next
+		raising = {value.last for value, call in candidates if value.raises}
+		anticipated = set()
+		stores = set()
+		instruct = body
+
+		if any(member.target is not None for member in conditional):
+			raising = set() # Can only be copied when it's one straight run
+
+		while raising and instruct in inside:
+			if instruct.target is not None or (instruct is not body and self.instructs.jumped_to(instruct)):
 				break
 
-	""" Unused
-	def __insertInstruct(self, id: int, insert: Instruct):
-		for i in range(len(self.instructs)):
-			instruct = self.instructs[i]
+			if instruct in raising:
+				anticipated.add(instruct)
+			elif instruct.opcode == 125: # STORE_FAST
+				stores.add(instruct.arg)
+			elif instruct.opcode == 124: # LOAD_FAST
+				if instruct.arg not in stores and instruct.arg not in defined and not self.assigned(instruct):
+					break
+			elif instruct.opcode == 116: # LOAD_GLOBAL
+				if not self.builtin(instruct.arg):
+					break
+			elif instruct.opcode not in Unseen:
+				break
 
-			if instruct.id > id:
-				instruct.id += 1
-			elif instruct.id == id:
-				insert.id = id
-				instruct.id += 1
-				self.instructs.insert(i, insert)
-	"""
+			instruct = instruct.next
+
+		candidates = [(value, call) for value, call in candidates if not value.raises or value.last in anticipated]
+		if not candidates:
+			return
+
+		kept = {} # Instructions of an expression -> local it's kept in
+		expressions = []
+		preheader = []
+
+		for value, call in candidates:
+			expression = [value.first]
+			while expression[-1] is not value.last:
+				expression.append(expression[-1].next)
+
+			code = tuple((instruct.opcode, instruct.arg) for instruct in expression)
+			if code not in kept:
+				kept[code] = self.new_local(self.__describe(expression))
+				self.report(f"{' '.join(opname[opcode] for opcode, _ in code)} gives the same every time round the loop at [{head.id}] and will be kept in {self.code.co_varnames[kept[code]]} [{kept[code]}]")
+
+				copies = [Instruct(opcode, arg, give_id = False) for opcode, arg in code]
+				if call is not None:
+					copies[-1].opcode = LOAD_ATTR # Gives the bound method LOAD_METHOD would have called
+				preheader.extend(copies)
+				preheader.append(Instruct(125, kept[code], give_id = False)) # STORE_FAST
+
+			expressions.append((expression, kept[code], call))
+
+		if anticipated:
+			entry = [Instruct(instruct.opcode, instruct.arg, give_id = False) for instruct in conditional + [omitted]]
+			entry[-1].target = omitted.target
+
+			jump = Instruct(JUMP_FORWARD, 0, give_id = False)
+			jump.target = body
+			preheader = entry + preheader + [jump] # A copied FOR_ITER leaves its value under the hoisted ones, optimize counts it in co_stacksize
+
+		previous = head.previous
+		for instruct in preheader:
+			self.instructs.insert_after(previous, instruct)
+			previous = instruct
+
+		for jump in list(self.instructs.jumpers.get(head, ())):
+			if jump not in inside:
+				self.instructs.set_target(jump, preheader[0])
+
+		for expression, var, call in expressions:
+			self.instructs.replace(expression[0], Instruct(124, var, give_id = False)) # LOAD_FAST
+			for instruct in expression[1:]:
+				self.instructs.remove(instruct)
+			if call is not None:
+				self.instructs.replace(call, Instruct(CALL_FUNCTION, call.arg, give_id = False))
+
+	# Expressions in the loop that give the same value every time, followed on a stack through each run of instructions between jumps
+	# Along with the CALL_METHOD of the ones that are methods
+	def __invariants(self, members: List[Instruct], stored: set, defined: set, attributes: set, reentrant: bool) -> List[Tuple["StackValue", Instruct]]:
+		candidates = []
+		stack = []
+
+		# Values leaving the stack are kept when nothing bigger is made out of them
+		def settle(values: Iterable[StackValue]):
+			for value in values:
+				if value.invariant and value.worthwhile and value.method is None:
+					candidates.append((value, None))
+
+		# Top count values, None when some were there before the run started
+		def take(count: int) -> List[StackValue]:
+			if count > stack.__len__():
+				settle(stack)
+				stack.clear()
+				return None
+
+			taken = stack[stack.__len__() - count:]
+			del stack[stack.__len__() - count:]
+			return taken
+
+		for instruct in members:
+			if self.instructs.jumped_to(instruct):
+				settle(stack)
+				stack.clear()
+
+			opcode = instruct.opcode
+			arg = instruct.arg
+
+			if opcode == 100: # LOAD_CONST
+				stack.append(StackValue(instruct, instruct, True, constant = True, value = self.consts[arg]))
+
+			elif opcode == 124: # LOAD_FAST
+				stack.append(StackValue(instruct, instruct, arg not in stored and (arg in defined or self.assigned(instruct))))
+
+			elif opcode == 116: # LOAD_GLOBAL
+				builtin = self.builtin(arg)
+				stack.append(StackValue(instruct, instruct, builtin, worthwhile = builtin))
+
+			# Only with hoist_attributes, an attribute is then taken to only change when it's set, the README's attribute precondition
+			# A value can't be trusted past anything that could run other code, though methods aren't reassigned
+			elif opcode == LOAD_ATTR or opcode == LOAD_METHOD:
+				operands = take(1)
+				invariant = self.hoist_attributes and operands is not None and operands[0].invariant and _adjacent(operands, instruct) and arg not in attributes and (opcode == LOAD_METHOD or not reentrant)
+				if not invariant:
+					settle(operands or ())
+
+				value = StackValue(operands[0].first if invariant else instruct, instruct, invariant, raises = True, worthwhile = True)
+				stack.append(value)
+
+				if opcode == LOAD_METHOD:
+					value.method = instruct
+					stack.append(StackValue(instruct, instruct))
+
+			elif opcode in FoldableOperations:
+				operands = take(ValuesOnTheStack[opcode])
+				value = StackValue(instruct, instruct)
+
+				# Only worked out from constants, which it's already been proven can be, anything else could run other code
+				if operands is not None and all(operand.constant for operand in operands) and _adjacent(operands, instruct):
+					try:
+						result = evaluate(opcode, arg, [operand.value for operand in reversed(operands)])
+						value = StackValue(operands[0].first, instruct, True, worthwhile = True, constant = True, value = result)
+					except Exception:
+						pass
+
+				if not value.invariant:
+					settle(operands or ())
+				stack.append(value)
+
+			elif opcode == 102: # BUILD_TUPLE
+				operands = take(arg)
+				value = StackValue(instruct, instruct)
+
+				if operands and all(operand.invariant for operand in operands) and _adjacent(operands, instruct):
+					constant = all(operand.constant for operand in operands)
+					value = StackValue(operands[0].first, instruct, True, any(operand.raises for operand in operands), True, constant, tuple(operand.value for operand in operands) if constant else None)
+				else:
+					settle(operands or ())
+				stack.append(value)
+
+			elif opcode in (1, 125): # POP_TOP, STORE_FAST
+				settle(take(1) or ())
+
+			elif opcode == CALL_FUNCTION:
+				settle(take(arg + 1) or ())
+				stack.append(StackValue(instruct, instruct))
+
+			elif opcode == CALL_METHOD:
+				operands = take(arg + 2)
+				if operands is not None:
+					if operands[0].invariant and operands[0].method is not None:
+						candidates.append((operands[0], instruct))
+					settle(operands[2:])
+				stack.append(StackValue(instruct, instruct))
+
+			else: # Not followed, what it does with the stack is unknown from here
+				settle(stack)
+				stack.clear()
+
+			if instruct.target is not None or opcode in Terminators:
+				settle(stack)
+				stack.clear()
+
+		settle(stack)
+		return candidates
+
+	# Name of the local an expression is kept in, from the names it uses
+	def __describe(self, expression: List[Instruct]) -> str:
+		names = []
+		for instruct in expression:
+			if instruct.opcode == 124: # LOAD_FAST
+				names.append(self.code.co_varnames[instruct.arg])
+			elif instruct.opcode in (LOAD_ATTR, LOAD_METHOD, 116): # LOAD_GLOBAL
+				names.append(self.code.co_names[instruct.arg])
+
+		return "." + ".".join(names) if names else ".invariant"
+
+	# Locals that might still be loaded at the start and end of each block, worked out backwards to a fixed point
+	def __liveness(self, blocks: List[List[Instruct]], successors: List[List[int]]) -> Tuple[List[set], List[set]]:
+		uses, kills = [], []
+		predecessors = [[] for _ in blocks]
+
+		for i, block in enumerate(blocks):
+			used, killed = set(), set()
+			for instruct in block:
+				if instruct.opcode in (124, 126) and instruct.arg not in killed: # DELETE_FAST fails on an unset local so it counts as a load
+					used.add(instruct.arg)
+				elif instruct.opcode == 125:
+					killed.add(instruct.arg)
+			uses.append(used)
+			kills.append(killed)
+
+			for successor in successors[i]:
+				predecessors[successor].append(i)
+
+		live_in = [set() for _ in blocks]
+		live_out = [set() for _ in blocks]
+		work = Worklist(reversed(range(blocks.__len__())))
+
+		while work:
+			i = work.pop()
+			live_out[i] = set().union(*(live_in[successor] for successor in successors[i]))
+			live = uses[i] | (live_out[i] - kills[i])
+
+			if live != live_in[i]:
+				live_in[i] = live
+				work.extend(predecessors[i])
+
+		return live_in, live_out
+
+	# Takes out stores of values no later load can see
+	# The value still has to come off the stack, only a constant or argument put there right before is dropped with it
+	def __remove_dead_stores(self):
+		blocks, successors = self.instructs.blocks()
+		live_in, live_out = self.__liveness(blocks, successors)
+		arguments = self.__argument_count()
+
+		# An exception can leave a try from anywhere in it, so what its handler loads stays live the whole time
+		leaders = {block[0]: i for i, block in enumerate(blocks)}
+		handled = set().union(*(live_in[leaders[instruct.target]] for block in blocks for instruct in block if instruct.opcode in SetupHandlers and instruct.target in leaders))
+
+		for block, live in zip(blocks, live_out):
+			live = set(live)
+
+			for instruct in reversed(block):
+				if instruct.opcode in (124, 126):
+					live.add(instruct.arg)
+					continue
 
-	def __find(self, id: int, instructs: list = None):
-		if instructs is None: instructs = self.instructs
+				if instruct.opcode != 125 or instruct not in self.instructs:
+					continue
 
-		for instruct in instructs:
-			if instruct.id == id:
-				return instruct
+				var = instruct.arg
+				if var not in live and var not in handled:
+					if self.__debug:
+						print(f"The store to {self.code.co_varnames[var]} [{var}] is never loaded and will be removed")
 
-	def __uses_const(self, index: int, instructs: list = None):
-		if instructs is None:
-			instructs = self.instructs
+					producer = instruct.previous
+					if producer is not None and (producer.opcode == 100 or (producer.opcode == 124 and producer.arg < arguments)) and not self.instructs.jumped_to(instruct):
+						self.instructs.remove(producer)
+						self.instructs.remove(instruct)
+					else:
+						self.instructs.replace(instruct, Instruct(1, 0, give_id = False)) # POP_TOP
 
-		return [instruct for instruct in instructs if instruct is not None and instruct.arg == index and instruct.opcode in (100,)]
+				live.discard(var)
 
-	def __assignments(self, index: int, instructs: list = None):
-		if instructs is None:
-			instructs = self.instructs
+	# Drops locals that are no longer used at all and constants that are never loaded
+	def __remove_unused(self):
+		dead_vars = [var for var in range(self.__argument_count(), len(self.code.co_varnames)) if not any(self.instructs.uses(opcode, var) for opcode in (124, 125, 126))]
+		new_vars = list(self.code.co_varnames)
 
-		return [instruct for instruct in instructs if instruct is not None and instruct.arg == index and instruct.opcode in (125,)]
+		for var in reversed(dead_vars):
+			if self.__debug:
+				print(f"Local variable {new_vars[var]} [{var}] is unused so it will be removed")
 
-	def __uses(self, index: int, instructs: list = None):
-		if instructs is None:
-			instructs = self.instructs
+			del new_vars[var]
 
-		return [instruct for instruct in instructs if instruct is not None and instruct.arg == index and instruct.opcode in (124,)]
+		self.instructs.renumber((124, 125, 126), dead_vars)
 
-	def __prior(self, final: Instruct, seek: int = 0, instructs: list = None):
-		if instructs is None:
-			instructs = self.instructs
+		if len(new_vars) != len(self.code.co_varnames):
+			self.code = self.code.replace(co_nlocals = len(new_vars), co_varnames = tuple(new_vars))
 
-		found = 0
-		gotten = []
+		if self.__debug:
+			for con in range(len(self.consts)):
+				if con and not self.instructs.uses(100, con):
+					print(f"Constant variable {self.consts[con]} [{con}] is unused so it will be removed")
 
-		for instruct in instructs:
-			if instruct is None:
-				continue
+		self.instructs.renumber((100,), self.consts.compact(self.instructs.users[100]))
 
-			if (seek < 1 or found < seek) and instruct.id < final.id:
-				gotten.append(instruct)
+	def __argument_count(self) -> int:
+		code = self.code
+		return code.co_argcount + code.co_kwonlyargcount + bool(code.co_flags & CO_VARARGS) + bool(code.co_flags & CO_VARKEYWORDS)
 
-		return gotten
+	def __are_args_const(self, operation: Instruct, instructs: list = None):
+		const_needed = ValuesOnTheStack[operation.opcode]
+		const_gotten = sum([1 for instruct in instructs[:const_needed] if instruct.opcode == 100])
+		return const_gotten >= const_needed
 
 	def __str__(self):
 		output = ""
@@ -435,57 +1430,472 @@ class Function:
 			output += f"{instruct.id:<3} {instruct.opcode:>3} {instruct.arg:<3}\n"
 		return output.rstrip("\n")
 
-def speeds(compiled: CodeType, runs: int = 512, tolerance: float = 5, refinements: int = 2) -> Tuple[float]:
-	def refine_data():
-		_avg = avg()
-		deviation = calc_standard_deviation()
-		return [speed for speed in speeds if abs(speed - _avg) < deviation]
+"""
+Peepholes
+
+Small rewrites looked at one instruction at a time by Function.optimize, each can be switched off by leaving its name out of Function's peepholes
+A peephole gets the Function and an instruction, and returns None when it doesn't apply or the instructions whose inputs it changed when it does
+"""
+
+Peepholes = {}
+
+def peephole(name: str):
+	def register(rewrite: Callable[[Function, Instruct], List[Instruct]]):
+		Peepholes[name] = rewrite
+		return rewrite
+	return register
+
+# Instructions after the ones a peephole just took out
+def _following(instruct: Instruct) -> List[Instruct]:
+	return [instruct] if instruct is not None else []
+
+# LOAD_FAST x; STORE_FAST x
+@peephole("redundant_store")
+def _redundant_store(func: Function, instruct: Instruct) -> List[Instruct]:
+	load = instruct.previous
+	if instruct.opcode != 125 or load is None or load.opcode != 124 or load.arg != instruct.arg or func.instructs.jumped_to(instruct) or not func.assigned(load):
+		return None
+
+	func.report(f"Storing {func.code.co_varnames[instruct.arg]} [{instruct.arg}] back into itself does nothing and will be removed")
+	following = instruct.next
+	func.instructs.remove(load)
+	func.instructs.remove(instruct)
+	return _following(following)
+
+# LOAD_CONST, LOAD_FAST of a set local or DUP_TOP straight into POP_TOP
+@peephole("pop_pushed")
+def _pop_pushed(func: Function, instruct: Instruct) -> List[Instruct]:
+	push = instruct.previous
+	if instruct.opcode != 1 or push is None or func.instructs.jumped_to(instruct):
+		return None
+	if not (push.opcode in (4, 100) or (push.opcode == 124 and func.assigned(push))): # DUP_TOP, LOAD_CONST, LOAD_FAST
+		return None
+
+	func.report(f"The {opname[push.opcode]} [{push.id}] is popped straight away and will be removed")
+	following = instruct.next
+	func.instructs.remove(push)
+	func.instructs.remove(instruct)
+	return _following(following)
+
+# Rotating the top n values n times puts them back where they were
+Rotations = _by_name({"ROT_TWO": 2, "ROT_THREE": 3, "ROT_FOUR": 4}) # -> values rotated
+
+@peephole("double_rotation")
+def _double_rotation(func: Function, instruct: Instruct) -> List[Instruct]:
+	if instruct.opcode not in Rotations:
+		return None
+
+	rotations = [instruct] + func.instructs.prior(instruct, Rotations[instruct.opcode] - 1)
+	if rotations.__len__() < Rotations[instruct.opcode] or any(rotation.opcode != instruct.opcode for rotation in rotations):
+		return None
+	if any(func.instructs.jumped_to(rotation) for rotation in rotations[:-1]):
+		return None
+
+	func.report(f"{rotations.__len__()} {opname[instruct.opcode]}s in a row cancel out and will be removed")
+	following = instruct.next
+	for rotation in rotations:
+		func.instructs.remove(rotation)
+	return _following(following)
+
+# Jumps to an unconditional jump go straight to where the last jump in the chain goes
+# An unconditional jump to a RETURN_VALUE returns right away
+@peephole("jump_threading")
+def _jump_threading(func: Function, instruct: Instruct) -> List[Instruct]:
+	target = instruct.target
+	if target is None:
+		return None
+
+	seen = {instruct}
+	while target.opcode in UnconditionalJumps and target.target is not None and target not in seen:
+		seen.add(target)
+		target = target.target
+
+	if target in seen: # Jumps that go round in a circle are left alone
+		target = None
+
+	if target is not None and target is not instruct.target:
+		# A relative jump can only go the way it points, unless there's a jump going the other way for layout to turn it into
+		forwards = func.instructs.precedes(instruct, target)
+		kind = JumpKinds[instruct.opcode]
+		if ((kind == FORWARD and not forwards) or (kind == BACKWARD and forwards)) and instruct.opcode not in Turned:
+			return None
+
+		func.report(f"The {opname[instruct.opcode]} [{instruct.id}] lands on another jump and will go straight to its target")
+		func.instructs.set_target(instruct, target)
+		return [instruct]
+
+	if instruct.opcode in UnconditionalJumps and instruct.target.opcode == RETURN_VALUE:
+		func.report(f"The {opname[instruct.opcode]} [{instruct.id}] only goes to a return and will return instead")
+		func.instructs.replace(instruct, Instruct(RETURN_VALUE, 0, give_id = False))
+		return []
+
+	return None
+
+# BUILD_TUPLE/BUILD_LIST n; UNPACK_SEQUENCE n only reorders the top n values
+@peephole("swap_unpack")
+def _swap_unpack(func: Function, instruct: Instruct) -> List[Instruct]:
+	build = instruct.previous
+	if instruct.opcode != 92 or build is None or build.opcode not in (102, 103) or build.arg != instruct.arg or instruct.arg > 3 or func.instructs.jumped_to(build) or func.instructs.jumped_to(instruct):
+		return None
+
+	func.report(f"Packing and unpacking {instruct.arg} values will be replaced with rotations")
+	previous = build.previous
+	func.instructs.remove(build)
+	func.instructs.remove(instruct)
+
+	# Unpacking puts the last value built on the bottom, so the top values come back reversed
+	# 3.11 has no rotations, swapping the top value with the nth one reverses up to 3 values
+	if "ROT_TWO" in opmap:
+		rotations = {1: (), 2: (("ROT_TWO", 0),), 3: (("ROT_THREE", 0), ("ROT_TWO", 0))}[instruct.arg]
+	else:
+		rotations = {1: (), 2: (("SWAP", 2),), 3: (("SWAP", 3),)}[instruct.arg]
+
+	for name, arg in rotations:
+		rotation = Instruct(opmap[name], arg, give_id = False)
+		func.instructs.insert_after(previous, rotation)
+		previous = rotation
+
+	return _following(previous.next if previous is not None else func.instructs.head)
+
+# Instruction the function's own code starts after, the GEN_START of a 3.10 generator or the first RESUME on 3.11, None when it starts at the top
+# Whatever runs first has to go after it, a generator only starts at its GEN_START
+def _prologue(func: Function) -> Instruct:
+	if GEN_START is None and RESUME is None:
+		return None
 
-	def calc_standard_deviation():
-		_avg = avg()
-		sum_squared_deviations = sum(((speed - _avg) ** 2 for speed in speeds))
-		return (sum_squared_deviations / runs) ** 0.5
+	instruct = func.instructs.head
+	while instruct is not None:
+		if instruct.opcode == GEN_START or (instruct.opcode == RESUME and instruct.arg == 0):
+			return instruct
+		instruct = instruct.next
 
-	speeds = []
-	avg = lambda: sum(speeds) / runs
+	return None
 
-	with open(devnull, "w") as null:
-		stdout = sys.stdout
-		sys.stdout = null
+# LOAD_GLOBAL of a builtin inside a loop loads it once into a local at the start of the function instead
+@peephole("hoist_builtins")
+def _hoist_builtins(func: Function, instruct: Instruct) -> List[Instruct]:
+	if instruct.opcode != 116 or instruct.id not in func.loops or not func.code.co_flags & CO_OPTIMIZED:
+		return None
 
-		i = 0
-		while i < runs:
-			start = process_time()
-			exec(compiled)
-			end = process_time()
-			speeds.append(end - start)
-			i += 1
+	# On 3.11 the low bit of the argument pushes a NULL for a call along with the builtin, which a LOAD_FAST can't do
+	if instruct.arg != name_index(116, instruct.arg) << NameShifts[116]:
+		return None
 
-		sys.stdout = stdout
+	name = func.code.co_names[name_index(116, instruct.arg)]
+	if not func.builtin(instruct.arg):
+		return None
+
+	func.report(f"The builtin {name} is looked up inside a loop and will be loaded into a local once instead")
+
+	var = func.new_local(f".{name}")
+
+	start = _prologue(func)
+	store = Instruct(125, var, give_id = False)
+	func.instructs.insert_after(start, store)
+	func.instructs.insert_after(start, Instruct(116, instruct.arg, give_id = False))
+
+	changed = []
+	for load in func.instructs.uses(116, instruct.arg):
+		if load.id in func.loops:
+			local = Instruct(124, var, give_id = False)
+			func.instructs.replace(load, local)
+			changed.append(local)
+
+	return changed
+
+# Passes that grow the code to make loops faster, with a profile they only run on hot code
+Aggressive = frozenset(("hoist_invariants", "hoist_builtins"))
+
+# Passes that only run when they're named, they need more of the code than the README's precondition
+OptIn = frozenset(("hoist_attributes",))
+
+# Code object run through Function, given back as it was where it can't be written
+def optimize_code(code: CodeType, debug: bool = False, peepholes: Iterable[str] = None, hoist_invariants: bool = True, profile: CodeProfile = None, hoist_attributes: bool = False) -> CodeType:
+	func = Function(read_instructs(code.co_code), code, debug, peepholes, hoist_invariants, profile, hoist_attributes)
+	func.optimize()
+	return func.code
+
+# Names that can be given to optimize's passes, the constant folding and dead store removal always run
+def available_passes() -> List[str]:
+	return ["hoist_invariants", "hoist_attributes"] + list(Peepholes)
+
+# Passes run when none are named, everything but the OptIn ones
+def default_passes() -> List[str]:
+	return [name for name in available_passes() if name not in OptIn]
+
+def _checked_passes(passes: Iterable[str]) -> List[str]:
+	names = default_passes() if passes is None else list(passes)
+	unknown = [name for name in names if name not in available_passes()]
+	if unknown:
+		raise ValueError(f"Unknown optimizer passes: {', '.join(unknown)}")
+	return names
+
+# The code and every code object inside it optimized, each one checked when verify is set
+# With a profile, code it found hot has its branches laid out by the profile and the rest skips the Aggressive passes
+def optimize_all(code: CodeType, peepholes: Iterable[str] = None, hoist_invariants: bool = True, verify: bool = True, debug: bool = False, profile: Profile = None, hoist_attributes: bool = False) -> CodeType:
+	consts = tuple(optimize_all(const, peepholes, hoist_invariants, verify, debug, profile, hoist_attributes) if hasattr(const, "co_code") else const for const in code.co_consts)
+	counts = None
+
+	if profile is not None:
+		if profile.hot(code):
+			counts = profile.get(code)
+		else:
+			peepholes = [name for name in (Peepholes if peepholes is None else peepholes) if name not in Aggressive]
+			hoist_invariants = False
+
+	optimized = optimize_code(code.replace(co_consts = consts), debug, peepholes, hoist_invariants, counts, hoist_attributes)
+
+	if verify:
+		verify_code(optimized)
+
+	return optimized
+
+# Digest of this file, what it optimizes to changes along with it
+with open(path.realpath(__file__), "rb") as file:
+	OPTIMIZER = sha256(file.read()).hexdigest()
+del file
+
+# Everything about a code object that makes it run differently, the body alone is in code_key
+# Along with the version of the optimizer, the disk cache's folder only changes with the optimizer folder's own code
+def _code_key(code: CodeType, settings: str) -> str:
+	shape = (code.co_name, code.co_filename, code.co_firstlineno, code.co_argcount, code.co_posonlyargcount, code.co_kwonlyargcount,
+		code.co_nlocals, code.co_stacksize, code.co_flags, code.co_freevars, code.co_cellvars, code.co_lnotab)
+	return "optimized-" + sha256(f"{code_key(code)}:{shape!r}:{settings}:{OPTIMIZER}".encode()).hexdigest()
+
+# Optimized code, looked up in the shared cache first so equal code from a reload or re-import isn't optimized again
+# When it can't be optimized, or the result doesn't verify, the code is kept as it was
+def optimized_code(code: CodeType, passes: Iterable[str] = None, verify: bool = True, debug: bool = False, profile: Profile = None) -> CodeType:
+	names = _checked_passes(passes)
+	peepholes = [name for name in names if name in Peepholes]
+	hoist_invariants = "hoist_invariants" in names
+	hoist_attributes = "hoist_attributes" in names
+
+	def compute() -> bytes:
+		try:
+			return dumps(optimize_all(code, peepholes, hoist_invariants, verify, debug, profile, hoist_attributes))
+		except Exception as e:
+			warn(f"{code.co_name} was left as it was, it couldn't be optimized: {type(e).__name__}: {e}", RuntimeWarning, stacklevel = 4)
+			return dumps(code)
+
+	settings = f"{sorted(names)!r}:{verify}:{profile.digest() if profile is not None else None}"
+	return loads(cache.default_cache.get_or_compute(_code_key(code, settings), compute))
+
+# Generators and coroutines are told apart by their code's flags so those can't wait for a first call
+Suspending = CO_GENERATOR | CO_COROUTINE | CO_ITERABLE_COROUTINE | CO_ASYNC_GENERATOR
+
+_FIRST_CALL = "__optimize_first_call__"
+
+# Code taking the same arguments as the function that hands them all on to first_call
+def _stub(func: FunctionType, first_call: Callable) -> CodeType:
+	code = func.__code__
+	names = code.co_varnames
+	positional = list(names[:code.co_argcount])
+	keywords = list(names[code.co_argcount:code.co_argcount + code.co_kwonlyargcount])
+	index = code.co_argcount + code.co_kwonlyargcount
+
+	parameters = list(positional)
+	passed = list(positional)
+	if code.co_posonlyargcount:
+		parameters.insert(code.co_posonlyargcount, "/")
+
+	if code.co_flags & CO_VARARGS:
+		parameters.append("*" + names[index])
+		passed.append("*" + names[index])
+		index += 1
+	elif keywords:
+		parameters.append("*")
+
+	parameters.extend(keywords)
+	passed.extend(f"{keyword} = {keyword}" for keyword in keywords)
+
+	if code.co_flags & CO_VARKEYWORDS:
+		parameters.append("**" + names[index])
+		passed.append("**" + names[index])
+
+	source = f"def {code.co_name if code.co_name.isidentifier() else 'stub'}({', '.join(parameters)}):\n\treturn {_FIRST_CALL}({', '.join(passed)})"
+	stub = next(const for const in compile(source, code.co_filename, "exec").co_consts if hasattr(const, "co_code"))
+
+	# first_call is put in as a constant as the stub runs in the function's own globals
+	codes = bytearray(stub.co_code)
+	for offset, opcode, arg in instructions(stub.co_code):
+		if opcode == 116 and stub.co_names[name_index(opcode, arg)] == _FIRST_CALL: # LOAD_GLOBAL
+			codes[offset] = 100 # LOAD_CONST
+			codes[offset + 1] = stub.co_consts.__len__()
+
+	return stub.replace(co_code = bytes(codes), co_consts = stub.co_consts + (first_call,), co_freevars = code.co_freevars, co_firstlineno = code.co_firstlineno)
+
+# Decorator replacing the function's code with an optimized version
+# passes names which of available_passes() to run, the default_passes() when None
+# Lazily the function is optimized the first time it's called, otherwise straight away, generators and coroutines always are straight away
+# A stub with the same arguments stands in until the first call, after that calls go straight to the optimized code
+# profile is a pgo.Profile recorded from the function as it's written, see optimize_all
+def optimize(func: FunctionType = None, /, passes: Iterable[str] = None, verify: bool = True, lazy: bool = True, debug: bool = False, profile: Profile = None):
+	if func is None:
+		return lambda func: optimize(func, passes = passes, verify = verify, lazy = lazy, debug = debug, profile = profile)
+
+	if not isinstance(func, FunctionType):
+		raise TypeError(f"optimize can only be used on functions, not {type(func).__name__}")
+
+	original = func.__code__
+	passes = _checked_passes(passes)
+
+	# Nothing would be optimized, and the stub's LOAD_CONST would be missing the NULL and inline caches CALL expects from 3.11 on
+	if not WRITABLE:
+		_warn_unwritable()
+		return func
+
+	if not lazy or original.co_flags & Suspending:
+		func.__code__ = optimized_code(original, passes, verify, debug, profile)
+		return func
+
+	def first_call(*args, **kwargs):
+		if func.__code__ is stub:
+			func.__code__ = optimized_code(original, passes, verify, debug, profile)
+		return func(*args, **kwargs)
+
+	stub = _stub(func, first_call)
+	func.__code__ = stub
+	return func
+
+# Module code with every function and class body inside it optimized, the module's own code runs once so it's left as it is
+def optimized_module(code: CodeType, passes: Iterable[str] = None, verify: bool = True) -> CodeType:
+	consts = tuple(optimized_code(const, passes, verify) if hasattr(const, "co_code") else const for const in code.co_consts)
+	return code.replace(co_consts = consts)
+
+# Loads a module from its source with optimized code, kept in its own .pyc next to the normal one
+# name.cpython-39.opt-fast<hash>.pyc where the hash covers the passes and this file so a change to either compiles again
+class OptimizingLoader(SourceFileLoader):
+
+	def __init__(self, fullname: str, path: str, passes: List[str], verify: bool, tag: str):
+		super().__init__(fullname, path)
+		self.passes = passes
+		self.verify = verify
+		self.tag = tag
+
+	def cache_path(self, source_path: str) -> str:
+		try:
+			return cache_from_source(source_path, optimization = self.tag)
+		except NotImplementedError: # No cache_tag so nothing can be cached
+			return None
+
+	def source_to_code(self, data: bytes, path: str, *, _optimize: int = -1) -> CodeType:
+		return optimized_module(super().source_to_code(data, path, _optimize = _optimize), self.passes, self.verify)
+
+	# Same layout as the interpreter's own .pyc, checked against the source's modification time and size
+	def get_code(self, fullname: str) -> CodeType:
+		source_path = self.get_filename(fullname)
+		bytecode_path = self.cache_path(source_path)
+		stats = self.path_stats(source_path)
+		header = MAGIC_NUMBER + bytes(4) + (int(stats["mtime"]) & 0xFFFFFFFF).to_bytes(4, "little") + (stats["size"] & 0xFFFFFFFF).to_bytes(4, "little")
+
+		if bytecode_path is not None:
+			try:
+				data = self.get_data(bytecode_path)
+			except OSError:
+				pass
+			else:
+				if data[:16] == header:
+					try:
+						code = loads(data[16:])
+					except (EOFError, ValueError, TypeError):
+						pass
+					else:
+						if isinstance(code, CodeType):
+							return code
+
+		code = self.source_to_code(self.get_data(source_path), source_path)
+
+		if bytecode_path is not None and not sys.dont_write_bytecode:
+			self.set_data(bytecode_path, header + dumps(code)) # Fails silently when the folder can't be written to
+
+		return code
+
+# Finds modules the normal way and has the ones from the given packages loaded by OptimizingLoader
+# With no packages every module loaded from source is optimized
+class OptimizingFinder(MetaPathFinder):
+
+	def __init__(self, packages: Iterable[str] = (), passes: Iterable[str] = None, verify: bool = True):
+		self.packages = tuple(packages)
+		self.passes = _checked_passes(passes)
+		self.verify = verify
+
+		self.tag = "fast" + sha256(f"{sorted(self.passes)!r}:{verify}:{OPTIMIZER}".encode()).hexdigest()[:16]
+
+	def optimizes(self, fullname: str) -> bool:
+		return not self.packages or any(fullname == package or fullname.startswith(package + ".") for package in self.packages)
+
+	def find_spec(self, fullname: str, path: List[str] = None, target = None):
+		if not self.optimizes(fullname):
+			return None
+
+		spec = PathFinder.find_spec(fullname, path, target)
+		if spec is None or type(spec.loader) is not SourceFileLoader:
+			return spec
+
+		spec.loader = OptimizingLoader(fullname, spec.origin, self.passes, self.verify, self.tag)
+		spec.cached = spec.loader.cache_path(spec.origin)
+		return spec
+
+	def invalidate_caches(self):
+		PathFinder.invalidate_caches()
+
+# Optimizes the packages from now on when they're imported, modules that are already imported stay as they are
+def install(*packages: str, passes: Iterable[str] = None, verify: bool = True) -> OptimizingFinder:
+	finder = OptimizingFinder(packages, passes, verify)
+	sys.meta_path.insert(0, finder)
+	return finder
+
+def uninstall(finder: OptimizingFinder):
+	if finder in sys.meta_path:
+		sys.meta_path.remove(finder)
+
+# Speeds of the module with its functions optimized without any peepholes and then with each peephole on its own
+def peephole_speeds(compiled: CodeType, runs: int = 512, tolerance: float = 5, refinements: int = 2, workers: int = None) -> Dict[str, Tuple[Tuple[float], Tuple[float]]]:
+	def with_peepholes(peepholes: Iterable[str]) -> CodeType:
+		consts = [optimize_code(const, peepholes = peepholes) if hasattr(const, "co_code") else const for const in compiled.co_consts]
+		return compiled.replace(co_consts = tuple(consts))
+
+	baseline = speeds(with_peepholes(()), runs, tolerance, refinements, workers)
+	return {name: (baseline, speeds(with_peepholes((name,)), runs, tolerance, refinements, workers)) for name in Peepholes}
+
+# With workers the runs are spread over that many processes, each exec timed on its own
+def speeds(compiled: CodeType, runs: int = 512, tolerance: float = 5, refinements: int = 2, workers: int = None) -> Tuple[float]:
+	if workers is not None:
+		speeds = scale(run_benchmarks({compiled.co_name: compiled}, runs, 0, loops = 1, workers = workers)[compiled.co_name].samples, 1e-9)
+
+	else:
+		speeds = buffer(runs)
+
+		with open(devnull, "w") as null:
+			stdout = sys.stdout
+			sys.stdout = null
+
+			i = 0
+			while i < runs:
+				start = process_time()
+				exec(compiled)
+				end = process_time()
+				speeds[i] = end - start
+				i += 1
+
+			sys.stdout = stdout
 
 	for i in range(refinements):
-		speeds = refine_data()
+		refined = refine(speeds)
+		if len(refined):
+			speeds = refined
 
-	speeds_min = min(speeds)
-	speeds_max = max(speeds)
+	speeds_min, speeds_max = extremes(speeds)
 
 	if tolerance <= 0:
-		return (speeds_min, speeds_max, avg())
+		return (speeds_min, speeds_max, mean(speeds))
 
 	else:
-		speeds_min_close = speeds_max_close = 0
-
 		speeds_range = speeds_max - speeds_min
 		speeds_max_percent = speeds_max - speeds_range * (tolerance / 100.0)
 		speeds_min_percent = speeds_min + speeds_range * (tolerance / 100.0)
 
-		for speed in speeds:
-			if speed < speeds_min_percent:
-				speeds_min_close += 1
-			elif speed > speeds_max_percent:
-				speeds_max_close += 1
-
-		return (speeds_min, speeds_max, avg(), speeds_min_close, speeds_max_close)
+		return (speeds_min, speeds_max, mean(speeds), count_below(speeds, speeds_min_percent), count_above(speeds, speeds_max_percent))
 
 def simple_dis(obj, headers = None):
 	consts_strings = False
@@ -581,24 +1991,24 @@ def simple_dis(obj, headers = None):
 		if names_strings:
 			print(*names_strings, sep="\n", end="\n\n")
 
-		codes = obj.co_code
-		for i in range(0, len(codes), 2):
-			instruction = codes[i]
+		opcodes, args = decode(obj.co_code)
+		for i in range(len(opcodes)):
+			instruction = opcodes[i]
 			print(f"\t[{instruction:>3}] {opname[instruction]:<16}", end="")
 			if instruction in ArgumentsNeeded:
-				print(f" {codes[i + 1]}", end="")
+				print(f" {args[i]}", end="")
 
 				if instruction == 100:
-					const_load_value = obj.co_consts[codes[i + 1]]
+					const_load_value = obj.co_consts[args[i]]
 					if hasattr(const_load_value, "co_code"):
 						const_name = const_load_value.co_name
 						const_type = "Code"
 					else:
-						const_name = str(obj.co_consts[codes[i + 1]])
-						const_type = type(obj.co_consts[codes[i + 1]]).__name__
+						const_name = str(obj.co_consts[args[i]])
+						const_type = type(obj.co_consts[args[i]]).__name__
 					print(f" [{const_name:<{longest_const_name}} ({const_type:>{longest_const_type}})]", end="")
 				elif instruction == 90 or instruction == 101:
-					names_name = obj.co_names[codes[i + 1]]
+					names_name = obj.co_names[args[i]]
 					print(f" [{names_name:<{longest_names_name}}]", end="")
 			print()
 
@@ -611,6 +2021,12 @@ def main():
 	tolerance: float = 0   # Percent with min/max to count
 	refinements: int = 1 # Number of times to clean outliers
 	runs: int = 2 ** 22  # Number of datapoints to collect
+	workers: int = cpu_count() # Processes to collect them in, None to run them all here
+
+	# Optimization settings
+	peepholes: list = None        # Names of the Peepholes to run, None for all of them
+	check_peepholes: bool = False # Time the code with each peephole on its own against none at all
+	hoist_invariants: bool = True # Move what's the same every time round a loop in front of it
 
 	initial_function: str = \
 """def test():
@@ -634,16 +2050,17 @@ print(test())"""
 		print("\nInitial Compiled Code:")
 		simple_dis(the_compile)
 
+	initial_module = the_compile
 	co_consts = list(the_compile.co_consts)
 
 	initial_compiled = the_compile.co_consts[0]
 	codes: bytes = initial_compiled.co_code
-	instructs: list = [Instruct(codes[i], codes[i + 1]) for i in range(0, len(codes), 2)]
+	instructs: list = read_instructs(codes)
 	del codes
 
 	Instruct.Reset()
 
-	func: Function = Function(instructs, initial_compiled, debug)
+	func: Function = Function(instructs, initial_compiled, debug, peepholes, hoist_invariants)
 	del instructs
 
 	optimize_start = process_time()
@@ -659,7 +2076,7 @@ print(test())"""
 	co_consts[0] = func.code
 	del func
 
-	initial_speeds = speeds(the_compile, runs, tolerance, refinements)
+	initial_speeds = speeds(the_compile, runs, tolerance, refinements, workers)
 
 	the_compile = the_compile.replace(co_consts = tuple(co_consts))
 	del co_consts
@@ -668,7 +2085,7 @@ print(test())"""
 		print("\nFinal Compiled Code:")
 		simple_dis(the_compile)
 
-	final_speeds = speeds(the_compile, runs, tolerance, refinements)
+	final_speeds = speeds(the_compile, runs, tolerance, refinements, workers)
 	del the_compile
 
 	min_delta = final_speeds[0] - initial_speeds[0]
@@ -708,7 +2125,16 @@ Optimizer ran with the following settings:\n\
 \tTolerance: {tolerance if tolerance > 0 else 'Disabled'}\n\
 \tData Refinements {refinements}\n\
 \tRuns: {runs}\n\
+\tWorkers: {workers if workers else 'None'}\n\
+\tPeepholes: {', '.join(peepholes) if peepholes is not None else 'All'}\n\
+\tHoist Invariants: {'Yes' if hoist_invariants else 'No'}\n\
 \tDebug: {'Yes' if debug else 'No'}")
 
+	if check_peepholes:
+		print("\nPeephole Speeds (Avg against no peepholes):")
+		for name, (baseline, alone) in peephole_speeds(initial_module, runs, tolerance, refinements, workers).items():
+			delta = alone[2] - baseline[2]
+			print(f"\t{name}: {quant(alone[2])} [{'Better' if delta < 0 else ('Worse' if delta else 'Same')} by {quant(abs(delta))}]")
+
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,557 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, replace
+from itertools import repeat
+from math import exp, log
+from os import cpu_count, path
+from random import Random
+from signal import ITIMER_REAL, SIGALRM, setitimer, signal
+from types import CodeType
+from typing import Iterator, List, Optional, Tuple
+import builtins
+import sys
+
+sys.path.append(path.join(path.dirname(path.dirname(path.realpath(__file__))), "optimizer"))
+from bytecodes import Peepholes, available_passes, default_passes, optimize, optimize_all
+from profiler import compare
+
+"""
+Differential fuzzing of the optimizer
+
+Random functions shaped like the test_1 - test_12 cases of decompiler's __main__ (nested and chained ifs over constants, and/or tests,
+for loops over arguments and ranges, while loops with counters, nested loops, reassignments and inner functions) along with try blocks,
+break/continue, early returns and the attributes of a Box object, read, set and changed by its methods, are run before and after being optimized
+Anything the optimized version does differently, its result, the exception it raises, not finishing or the optimizer failing on it, is a failure
+and gets shrunk to the smallest function that still fails the same way
+Every case is also called through the @optimize decorator, which goes through its lazy stub first
+"""
+
+Names = ("a", "b", "c", "d")  # Locals every case starts out with
+Constants = ("e", "f")        # Locals only ever assigned a constant once, like test_1's a, so tests on them fold
+Targets = ("i", "j", "k")     # Loop variables
+Attributes = ("p", "q")       # Attributes of the Box every case has in o
+
+# Plain attributes only, hoist_attributes is allowed to assume there aren't any descriptors or __getattr__
+BOX = """class Box:
+	def __init__(self, p, q):
+		self.p = p
+		self.q = q
+
+	def bump(self, value):
+		self.p += value
+		return self.p
+
+	def swap(self):
+		self.p, self.q = self.q, self.p
+		return self.p
+"""
+
+PASSED, SKIPPED, MISMATCH, OPTIMIZER_ERROR, HANG, CRASH = "passed", "skipped", "mismatch", "optimizer error", "hang", "crash"
+
+@dataclass(frozen = True)
+class Expression:
+	template: str # Source with a {} for each operand
+	operands: Tuple["Expression", ...] = ()
+
+	def render(self) -> str:
+		return self.template.format(*(operand.render() for operand in self.operands))
+
+	# Simpler expressions to try in its place, 0 first then its operands
+	def smaller(self) -> Iterator["Expression"]:
+		if self != ZERO:
+			yield ZERO
+		yield from self.operands
+
+		for i, operand in enumerate(self.operands):
+			for simpler in operand.smaller():
+				yield replace(self, operands = self.operands[:i] + (simpler,) + self.operands[i + 1:])
+
+ZERO = Expression("0")
+
+Block = Tuple["Statement", ...]
+
+def _render_block(block: Block, depth: int) -> List[str]:
+	if not block:
+		return ["\t" * depth + "pass"]
+	return [line for statement in block for line in statement.render(depth)]
+
+# Every block that has one statement taken out or made simpler
+def _smaller_blocks(block: Block) -> Iterator[Block]:
+	for i, statement in enumerate(block):
+		for replacement in statement.smaller():
+			yield block[:i] + replacement + block[i + 1:]
+
+# Statements render to lines of source and shrink into the statements that can stand in for them, nothing at all first
+class Statement:
+
+	def render(self, depth: int) -> List[str]: raise NotImplementedError
+
+	def smaller(self) -> Iterator[Block]: raise NotImplementedError
+
+@dataclass(frozen = True)
+class Line(Statement):
+	template: str
+	expressions: Tuple[Expression, ...] = ()
+
+	def render(self, depth: int) -> List[str]:
+		return ["\t" * depth + self.template.format(*(expression.render() for expression in self.expressions))]
+
+	def smaller(self) -> Iterator[Block]:
+		yield ()
+		for i, expression in enumerate(self.expressions):
+			for simpler in expression.smaller():
+				yield (replace(self, expressions = self.expressions[:i] + (simpler,) + self.expressions[i + 1:]),)
+
+@dataclass(frozen = True)
+class If(Statement):
+	test: Expression
+	body: Block
+	orelse: Block = ()
+
+	def render(self, depth: int) -> List[str]:
+		lines = ["\t" * depth + f"if {self.test.render()}:"] + _render_block(self.body, depth + 1)
+		if self.orelse:
+			lines += ["\t" * depth + "else:"] + _render_block(self.orelse, depth + 1)
+		return lines
+
+	def smaller(self) -> Iterator[Block]:
+		yield ()
+		yield self.body
+		yield self.orelse
+		for test in self.test.smaller():
+			yield (replace(self, test = test),)
+		for body in _smaller_blocks(self.body):
+			yield (replace(self, body = body),)
+		for orelse in _smaller_blocks(self.orelse):
+			yield (replace(self, orelse = orelse),)
+
+@dataclass(frozen = True)
+class For(Statement):
+	target: str
+	iterable: Expression
+	body: Block
+
+	def render(self, depth: int) -> List[str]:
+		return ["\t" * depth + f"for {self.target} in {self.iterable.render()}:"] + _render_block(self.body, depth + 1)
+
+	def smaller(self) -> Iterator[Block]:
+		yield ()
+		yield self.body
+		for body in _smaller_blocks(self.body):
+			yield (replace(self, body = body),)
+
+# The counter goes up first thing in the body so continue can't keep it going forever
+@dataclass(frozen = True)
+class While(Statement):
+	counter: str
+	bound: int
+	test: Expression
+	body: Block
+
+	def render(self, depth: int) -> List[str]:
+		indent = "\t" * depth
+		return [f"{indent}{self.counter} = 0", f"{indent}while {self.counter} < {self.bound} and {self.test.render()}:", f"{indent}\t{self.counter} += 1"] + \
+			_render_block(self.body, depth + 1)
+
+	def smaller(self) -> Iterator[Block]:
+		yield ()
+		yield self.body
+		if self.bound > 1:
+			yield (replace(self, bound = 1),)
+		if self.test != ONE:
+			yield (replace(self, test = ONE),)
+		for body in _smaller_blocks(self.body):
+			yield (replace(self, body = body),)
+
+ONE = Expression("1")
+
+@dataclass(frozen = True)
+class Try(Statement):
+	body: Block
+	handler: Block
+
+	def render(self, depth: int) -> List[str]:
+		indent = "\t" * depth
+		return [indent + "try:"] + _render_block(self.body, depth + 1) + [indent + "except (ArithmeticError, LookupError):"] + _render_block(self.handler, depth + 1)
+
+	def smaller(self) -> Iterator[Block]:
+		yield ()
+		yield self.body
+		yield self.handler
+		for body in _smaller_blocks(self.body):
+			yield (replace(self, body = body),)
+		for handler in _smaller_blocks(self.handler):
+			yield (replace(self, handler = handler),)
+
+@dataclass(frozen = True)
+class Def(Statement):
+	name: str
+	body: Block
+
+	def render(self, depth: int) -> List[str]:
+		return ["\t" * depth + f"def {self.name}():"] + _render_block(self.body, depth + 1)
+
+	def smaller(self) -> Iterator[Block]:
+		yield ()
+		for body in _smaller_blocks(self.body):
+			yield (replace(self, body = body),)
+
+@dataclass(frozen = True)
+class Program:
+	seed: int
+	body: Block
+	values: Tuple[int, ...] # Arguments the function is called with
+	n: int
+
+	def source(self) -> str:
+		return BOX + "\n" + "\n".join(["def case(values, n):"] + _render_block(self.body, 1)) + "\n"
+
+	def call(self) -> str:
+		return f"case({list(self.values)!r}, {self.n!r})"
+
+	def smaller(self) -> Iterator["Program"]:
+		for body in _smaller_blocks(self.body):
+			yield replace(self, body = body)
+		for i in range(self.values.__len__()):
+			yield replace(self, values = self.values[:i] + self.values[i + 1:])
+		if self.n:
+			yield replace(self, n = 0)
+
+class _Generator:
+
+	def __init__(self, seed: int):
+		self.random = Random(seed)
+		self.counters = 0
+		self.inner = False
+		self.box = True # Whether o can be used, inner functions leave it alone so it stays a fast local of the case
+
+	def leaf(self, names: Tuple[str, ...]) -> Expression:
+		if self.box and self.random.random() < 0.15:
+			return Expression(f"o.{self.random.choice(Attributes)}")
+		if self.random.random() < 0.6:
+			return Expression(self.random.choice(names))
+		return Expression(repr(self.random.randint(-3, 9)))
+
+	# Multiplying and shifting are only ever by small constants so loops can't build huge numbers
+	def expression(self, names: Tuple[str, ...], depth: int = 0) -> Expression:
+		if depth >= 3 or self.random.random() < 0.35:
+			return self.leaf(names)
+
+		operand = lambda: self.expression(names, depth + 1)
+		choice = self.random.randrange(15)
+
+		if choice < 6:
+			operator = self.random.choice(("+", "-", "//", "%", "&", "|", "^", "+", "-"))
+			return Expression(f"({{}} {operator} {{}})", (operand(), operand()))
+		if choice == 6:
+			return Expression(f"({{}} * {self.random.randint(0, 3)})", (operand(),))
+		if choice == 7:
+			return Expression(f"({{}} {self.random.choice(('<<', '>>'))} {self.random.randint(0, 3)})", (operand(),))
+		if choice == 8:
+			return Expression(f"{self.random.choice(('min', 'max'))}({{}}, {{}})", (operand(), operand()))
+		if choice == 9:
+			return Expression("abs({})", (operand(),))
+		if choice == 10:
+			return Expression("values[{}]", (operand(),))
+		if choice == 11:
+			return Expression(self.random.choice(("len(values)", "len(out)", "sum(values)", "(-n)")))
+		if choice == 12:
+			return Expression("({} if {} else {})", (operand(), self.condition(names, depth + 1), operand()))
+		if choice == 13 and self.box: # Calls that change o's attributes while they're being read
+			if self.random.random() < 0.7:
+				return Expression("o.bump({})", (operand(),))
+			return Expression("o.swap()")
+		return Expression("(-{})", (operand(),))
+
+	def condition(self, names: Tuple[str, ...], depth: int = 0) -> Expression:
+		choice = self.random.randrange(8)
+
+		if choice < 4 or depth >= 2:
+			operator = self.random.choice(("<", "<=", "==", "!=", ">", ">="))
+			return Expression(f"({{}} {operator} {{}})", (self.expression(names, depth + 1), self.expression(names, depth + 1)))
+		if choice < 6:
+			operator = self.random.choice(("and", "or"))
+			return Expression(f"({{}} {operator} {{}})", (self.condition(names, depth + 1), self.condition(names, depth + 1)))
+		if choice == 6:
+			return Expression("(not {})", (self.condition(names, depth + 1),))
+		return Expression("({} in values)", (self.expression(names, depth + 1),))
+
+	def block(self, names: Tuple[str, ...], depth: int, loops: int, size: int) -> Block:
+		return tuple(self.statement(names, depth, loops) for _ in range(self.random.randint(1, size)))
+
+	def statement(self, names: Tuple[str, ...], depth: int, loops: int) -> Statement:
+		choice = self.random.randrange(20)
+		nested = depth < 3
+
+		if choice < 5 or not nested and choice < 12:
+			return Line(f"{self.random.choice(Names)} = {{}}", (self.expression(names),))
+		if choice < 7 or not nested and choice < 16:
+			operator = self.random.choice(("+=", "-=", "+=", "*= 2", "//= 2"))
+			if "2" in operator:
+				return Line(f"{self.random.choice(Names)} {operator}")
+			return Line(f"{self.random.choice(Names)} {operator} {{}}", (self.expression(names),))
+		if choice < 8 or not nested:
+			if self.box and self.random.random() < 0.4:
+				attribute = self.random.choice(Attributes)
+				return Line(f"o.{attribute} {self.random.choice(('=', '+=', '-='))} {{}}", (self.expression(names),))
+			return Line("out.append({})", (self.expression(names),))
+
+		if choice < 11:
+			orelse = ()
+			if self.random.random() < 0.5:
+				orelse = self.block(names, depth + 1, loops, 3)
+			elif self.random.random() < 0.4: # elif
+				orelse = (self.statement(names, depth, loops),)
+			return If(self.condition(names), self.block(names, depth + 1, loops, 3), orelse)
+
+		free = [target for target in Targets if target not in names]
+		if choice < 13 and free and loops < 2:
+			target = free[0]
+			iterable = Expression(self.random.choice(("values", f"range({self.random.randint(0, 5)})", "range(n % 4)", "out[:3]")))
+			body = self.block(names + (target,), depth + 1, loops + 1, 4)
+
+			# Reading an attribute of o first thing is what hoist_attributes takes out of the loop, often with something changing it later on
+			if self.box and self.random.random() < 0.4:
+				attribute = self.random.choice(Attributes)
+				body = (Line(f"{self.random.choice(Names)} += o.{attribute}"),) + body
+				if self.random.random() < 0.6:
+					body += (Line(self.random.choice((f"o.{attribute} += {target}", f"o.bump({target})", "o.swap()"))),)
+
+			return For(target, iterable, body)
+		if choice < 14 and loops < 2:
+			counter = f"w{self.counters}"
+			self.counters += 1
+			return While(counter, self.random.randint(0, 5), self.condition(names) if self.random.random() < 0.5 else ONE, self.block(names, depth + 1, loops + 1, 4))
+		if choice < 16:
+			return Try(self.block(names, depth + 1, loops, 3), self.block(names, depth + 1, loops, 2))
+		if choice < 18 and loops:
+			return If(self.condition(names), (Line(self.random.choice(("break", "continue"))),))
+		if choice < 19 and not self.inner and depth == 0:
+			self.box = False
+			body = self.block(Names + Constants, 1, 0, 3) + (Line("return {}", (self.expression(Names + Constants),)),)
+			self.box = True
+			self.inner = True # Calls to it come after so it never calls itself
+			return Def("inner", body)
+		if choice < 19 and self.inner:
+			return Line(f"{self.random.choice(Names)} = inner()")
+		return If(self.condition(names), (Line("return {}", (self.expression(names),)),))
+
+def generate(seed: int) -> Program:
+	generator = _Generator(seed)
+	random = generator.random
+
+	prelude = tuple(Line(f"{name} = {random.randint(-3, 9)}") for name in Names + Constants) + (Line("out = []"), Line(f"o = Box({random.randint(-3, 9)}, {random.randint(-3, 9)})"))
+	body = generator.block(Names + Constants, 0, 0, 8)
+	values = tuple(random.randint(-5, 9) for _ in range(random.randint(0, 5)))
+	return Program(seed, prelude + body + (Line("return (a, b, c, d, out, o.p, o.q)"),), values, random.randint(-2, 9))
+
+@dataclass(frozen = True)
+class Settings:
+	peepholes: Tuple[str, ...]
+	hoist_invariants: bool
+	timeout: float = 2.0      # Seconds a case can run for
+	samples: int = 0          # Timed samples of each version, no timing when 0
+	min_time: int = 200_000   # Nanoseconds each sample should take
+	hoist_attributes: bool = False
+
+@dataclass(frozen = True)
+class Outcome:
+	kind: str
+	message: str = ""
+	speedup: float = None
+	significant: bool = False
+
+class _Timeout(BaseException): # Not an Exception so the case's own handlers can't catch it
+	pass
+
+def _alarm(signum, frame):
+	raise _Timeout()
+
+# Raises _Timeout in whatever is running once timeout seconds are up
+@contextmanager
+def _deadline(timeout: float) -> Iterator[None]:
+	previous = signal(SIGALRM, _alarm)
+	setitimer(ITIMER_REAL, timeout)
+	try:
+		yield
+	finally:
+		setitimer(ITIMER_REAL, 0)
+		signal(SIGALRM, previous)
+
+# What calling the case did, None when it didn't finish in time
+# With settings the case is decorated with @optimize running the same passes first
+def _run(module: CodeType, program: Program, timeout: float, settings: Settings = None) -> Optional[tuple]:
+	namespace = {"__builtins__": builtins, "__name__": "__fuzzing__"}
+	exec(module, namespace) # Unsafe
+	function = namespace["case"]
+
+	if settings is not None:
+		passes = list(settings.peepholes) + ["hoist_invariants"] * settings.hoist_invariants + ["hoist_attributes"] * settings.hoist_attributes
+		function = optimize(function, passes = passes)
+
+	try:
+		with _deadline(timeout):
+			return ("return", repr(function(list(program.values), program.n)))
+	except _Timeout:
+		return None
+	except Exception as e:
+		return ("raise", type(e).__name__, str(e))
+
+def _optimized(module: CodeType, settings: Settings) -> CodeType:
+	consts = tuple(optimize_all(const, settings.peepholes, settings.hoist_invariants, hoist_attributes = settings.hoist_attributes) if hasattr(const, "co_code") else const for const in module.co_consts)
+	return module.replace(co_consts = consts)
+
+def check(program: Program, settings: Settings) -> Outcome:
+	source = program.source()
+	try:
+		module = compile(source, "<case>", "exec")
+	except SyntaxError as e: # Shrinking can take a loop away from its break
+		return Outcome(SKIPPED, f"SyntaxError: {e}")
+
+	before = _run(module, program, settings.timeout)
+	if before is None:
+		return Outcome(SKIPPED, "doesn't finish before being optimized")
+
+	try:
+		with _deadline(settings.timeout * 2):
+			optimized = _optimized(module, settings)
+	except _Timeout:
+		return Outcome(HANG, "the optimizer doesn't finish")
+	except Exception as e:
+		return Outcome(OPTIMIZER_ERROR, f"{type(e).__name__}: {e}")
+
+	after = _run(optimized, program, settings.timeout)
+	if after is None:
+		return Outcome(HANG, f"doesn't finish once optimized, it gave {before}")
+	if after != before:
+		return Outcome(MISMATCH, f"{before} became {after}")
+
+	decorated = _run(module, program, settings.timeout * 2, settings)
+	if decorated is None:
+		return Outcome(HANG, f"doesn't finish through @optimize, it gave {before}")
+	if decorated != before:
+		return Outcome(MISMATCH, f"{before} became {decorated} through @optimize")
+
+	if settings.samples <= 0 or before[0] != "return":
+		return Outcome(PASSED)
+
+	call = compile(source + program.call(), "<case>", "exec")
+	comparison = compare(call, _optimized(call, settings), settings.samples, 2, settings.min_time)
+	return Outcome(PASSED, speedup = comparison.speedup, significant = comparison.significant)
+
+# Checks programs in worker processes, a worker dying takes down the pool so its programs are checked again one at a time to find the one that did it
+class _Checker:
+
+	def __init__(self, settings: Settings, workers: int = None):
+		self.settings = settings
+		self.workers = workers or cpu_count() or 1
+		self.executor = ProcessPoolExecutor(self.workers)
+
+	def check_all(self, programs: List[Program]) -> List[Outcome]:
+		chunksize = max(1, programs.__len__() // (self.workers * 4))
+		try:
+			return list(self.executor.map(check, programs, repeat(self.settings), chunksize = chunksize))
+		except BrokenProcessPool:
+			self.executor.shutdown()
+			self.executor = ProcessPoolExecutor(self.workers)
+			return [self.__isolated(program) for program in programs]
+
+	def __isolated(self, program: Program) -> Outcome:
+		with ProcessPoolExecutor(1) as executor:
+			try:
+				return executor.submit(check, program, self.settings).result()
+			except BrokenProcessPool:
+				return Outcome(CRASH, "the interpreter crashed")
+
+	def shutdown(self):
+		self.executor.shutdown()
+
+# Smallest program found that still fails the same way, every simpler version of the current one is tried a batch at a time
+def shrink(program: Program, kind: str, checker: _Checker) -> Tuple[Program, Outcome]:
+	outcome = None
+	improved = True
+
+	while improved:
+		improved = False
+		candidates = list(program.smaller())
+
+		for start in range(0, candidates.__len__(), checker.workers * 4):
+			batch = candidates[start:start + checker.workers * 4]
+			for candidate, result in zip(batch, checker.check_all(batch)):
+				if result.kind == kind:
+					program, outcome, improved = candidate, result, True
+					break
+			if improved:
+				break
+
+	return program, outcome
+
+def fuzz(cases: int, seed: int = 0, settings: Settings = None, workers: int = None, batch: int = 256) -> Tuple[List[Tuple[Program, Outcome]], List[Tuple[Program, Outcome]]]:
+	if settings is None:
+		settings = Settings(tuple(Peepholes), True)
+
+	checker = _Checker(settings, workers)
+	results = []
+	failures = []
+
+	try:
+		for start in range(seed, seed + cases, batch):
+			programs = [generate(case) for case in range(start, min(start + batch, seed + cases))]
+			for program, outcome in zip(programs, checker.check_all(programs)):
+				results.append((program, outcome))
+				if outcome.kind not in (PASSED, SKIPPED):
+					smallest, smallest_outcome = shrink(program, outcome.kind, checker)
+					failures.append((smallest, smallest_outcome or outcome))
+	finally:
+		checker.shutdown()
+
+	return results, failures
+
+def main():
+	parser = ArgumentParser(description = "Checks the optimizer against random functions and times how much faster they run")
+	parser.add_argument("-n", "--cases", type = int, default = 1000, help = "Number of random functions to check (default: 1000)")
+	parser.add_argument("-s", "--seed", type = int, default = 0, help = "Seed of the first function, the rest follow on from it")
+	parser.add_argument("-j", "--jobs", type = int, default = None, help = "Number of worker processes (default: all cores)")
+	parser.add_argument("-p", "--passes", default = None, help = f"Comma separated passes to run out of {', '.join(available_passes())} (default: {', '.join(default_passes())})")
+	parser.add_argument("-t", "--timeout", type = float, default = 2.0, help = "Seconds a function can run for before it counts as hanging")
+	parser.add_argument("--samples", type = int, default = 0, help = "Timed samples per function to measure the speedup with (default: 0, no timing)")
+	parser.add_argument("--show", type = int, default = None, help = "Only print the source of the function with this seed")
+	args = parser.parse_args()
+
+	if args.show is not None:
+		print(generate(args.show).source())
+		return
+
+	passes = default_passes() if args.passes is None else [name for name in args.passes.split(",") if name]
+	unknown = [name for name in passes if name not in available_passes()]
+	if unknown:
+		parser.error(f"unknown passes: {', '.join(unknown)}")
+
+	settings = Settings(tuple(name for name in passes if name in Peepholes), "hoist_invariants" in passes, args.timeout, args.samples, hoist_attributes = "hoist_attributes" in passes)
+	results, failures = fuzz(args.cases, args.seed, settings, args.jobs)
+
+	counts = {}
+	for _, outcome in results:
+		counts[outcome.kind] = counts.get(outcome.kind, 0) + 1
+	print(f"Cases: {results.__len__()}, " + ", ".join(f"{kind}: {count}" for kind, count in sorted(counts.items())))
+
+	timed = [(program, outcome) for program, outcome in results if outcome.speedup is not None]
+	if timed:
+		mean = exp(sum(log(outcome.speedup) for _, outcome in timed) / timed.__len__())
+		faster = sum(1 for _, outcome in timed if outcome.significant and outcome.speedup > 1)
+		slower = sum(1 for _, outcome in timed if outcome.significant and outcome.speedup < 1)
+		best = max(timed, key = lambda result: result[1].speedup)
+		worst = min(timed, key = lambda result: result[1].speedup)
+		print(f"Speedup: {mean:.4f}x geometric mean, {faster} significantly faster, {slower} significantly slower, "
+			f"best {best[1].speedup:.4f}x (seed {best[0].seed}), worst {worst[1].speedup:.4f}x (seed {worst[0].seed})")
+
+	for program, outcome in failures:
+		print(f"\nSeed {program.seed}, {outcome.kind}: {outcome.message}")
+		print(program.source() + program.call())
+
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()